@@ -0,0 +1,415 @@
+##  Module aggregator.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+"""
+Aggregate the metrics of several processes in a single one, over a unix socket.
+
+The worker processes use an AggregatorClient, which sends the notifications in
+batches; the aggregator process runs an AggregatorServer, which notifies the metrics
+in its own registry: they can be read by the usual API (or the WSGI middleware).
+
+Each batch is sent as a frame (the payload's size followed by the payload), made up
+by two kinds of records: the definitions, binding a metric's name and kind to an id
+valid for the connection, and the notifications of a numeric value to a metric id.
+"""
+
+import atexit
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import weakref
+
+from . import metrics, exceptions, py3comp
+
+
+log = logging.getLogger("appmetrics.aggregator")
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+FRAME = struct.Struct("!I")
+
+# operation, id, kind length, name length, followed by the kind and the name
+DEFINE = struct.Struct("!cIBH")
+DEFINE_OP = b"D"
+
+# operation, id, value
+NOTIFY = struct.Struct("!cId")
+NOTIFY_OP = b"N"
+
+# open clients, to be flushed at exit
+CLIENTS = weakref.WeakSet()
+
+
+def pack_define(id_, name, kind):
+    name = name.encode("utf8")
+    kind = kind.encode("ascii")
+
+    return DEFINE.pack(DEFINE_OP, id_, len(kind), len(name)) + kind + name
+
+
+class AggregatorHandler(py3comp.socketserver.StreamRequestHandler):
+    """
+    Read the frames sent by a client
+    """
+
+    def setup(self):
+        py3comp.socketserver.StreamRequestHandler.setup(self)
+        self.server.add_connection(self.request)
+
+    def finish(self):
+        self.server.remove_connection(self.request)
+        py3comp.socketserver.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        # the metrics defined by the client, by id
+        defined = {}
+
+        while True:
+            header = self.rfile.read(FRAME.size)
+            if len(header) < FRAME.size:
+                return
+
+            size = FRAME.unpack(header)[0]
+            payload = self.rfile.read(size)
+            if len(payload) < size:
+                return
+
+            try:
+                self.server.process(payload, defined)
+            except (ValueError, struct.error) as e:
+                log.error("Invalid frame, closing the connection: %s", e)
+                return
+
+
+class AggregatorServer(py3comp.socketserver.ThreadingMixIn, py3comp.socketserver.UnixStreamServer):
+    """
+    Receive the notifications sent by the clients on the given unix socket and
+    notify the metrics in this process' registry. The metrics are created on
+    their first definition, if they don't exist yet
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        # remove the socket left by a previous run
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.path = path
+        self.thread = None
+
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+        py3comp.socketserver.UnixStreamServer.__init__(self, path, AggregatorHandler)
+
+    def add_connection(self, connection):
+        with self.connections_lock:
+            self.connections.add(connection)
+
+    def remove_connection(self, connection):
+        with self.connections_lock:
+            self.connections.discard(connection)
+
+    def get_metric(self, name, kind):
+        """
+        Return the named metric, creating it with the given kind if needed
+        """
+
+        try:
+            return metrics.metric(name)
+        except exceptions.InvalidMetricError:
+            pass
+
+        try:
+            factory = metrics.METRIC_TYPES[kind]
+        except KeyError:
+            raise ValueError("Invalid metric kind: {}".format(kind))
+
+        try:
+            return factory(name)
+        except exceptions.DuplicateMetricError:
+            # created in the meantime by another connection
+            return metrics.metric(name)
+
+    def process(self, payload, defined):
+        """
+        Process the records in the given payload
+        """
+
+        pos = 0
+        while pos < len(payload):
+            op = payload[pos:pos + 1]
+
+            if op == NOTIFY_OP:
+                _, id_, value = NOTIFY.unpack_from(payload, pos)
+                pos += NOTIFY.size
+
+                try:
+                    metric = defined[id_]
+                except KeyError:
+                    raise ValueError("Undefined metric id: {}".format(id_))
+
+                try:
+                    metric.notify(value)
+                except Exception:
+                    log.exception("Error notifying %s", metric)
+
+            elif op == DEFINE_OP:
+                _, id_, kind_size, name_size = DEFINE.unpack_from(payload, pos)
+                pos += DEFINE.size
+
+                kind = payload[pos:pos + kind_size].decode("ascii")
+                pos += kind_size
+                name = payload[pos:pos + name_size].decode("utf8")
+                pos += name_size
+
+                defined[id_] = self.get_metric(name, kind)
+
+            else:
+                raise ValueError("Invalid operation: {!r}".format(op))
+
+    def start(self, poll_interval=0.5):
+        """
+        Serve the clients in a background thread
+        """
+
+        self.thread = threading.Thread(
+            target=self.serve_forever, args=(poll_interval,), name="appmetrics-aggregator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving, close the open connections and remove the socket
+        """
+
+        self.shutdown()
+        self.server_close()
+
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+        if self.thread is not None:
+            self.thread.join()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AggregatorClient(object):
+    """
+    Send the notifications to an AggregatorServer listening on the given unix socket.
+    The notifications are buffered and sent every "batch_size" notifications, and
+    every "flush_interval" seconds by a background thread (if given).
+    The client can be created before forking: each process gets its own connection.
+    The socket is non-blocking: if the aggregator is not reachable, or it doesn't
+    read fast enough, the notifications are discarded and the connection is reset
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+
+        # name: (id, kind)
+        self.defined = {}
+
+        self._buffer = bytearray()
+        self._pending = 0
+        self._socket = None
+        self._pid = None
+        self._stopped = threading.Event()
+
+        CLIENTS.add(self)
+
+    def _check_pid(self):
+        """
+        Reset the state inherited by a forked process, to be called under the lock
+        """
+
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+
+        # the parent process will send its own notifications
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+        self._buffer = bytearray()
+        self._pending = 0
+        self._pid = pid
+
+        if self.flush_interval:
+            flusher = threading.Thread(target=self._run_flusher, name="appmetrics-aggregator-client")
+            flusher.daemon = True
+            flusher.start()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def define(self, name, kind):
+        """
+        Define the named metric of the given kind in the aggregator
+        """
+
+        if kind not in metrics.METRIC_TYPES:
+            raise exceptions.InvalidMetricError("Invalid metric kind: {}".format(kind))
+
+        with self.lock:
+            self._check_pid()
+
+            if name in self.defined:
+                return
+
+            id_ = len(self.defined)
+            self.defined[name] = (id_, kind)
+            self._buffer += pack_define(id_, name, kind)
+
+    def new_counter(self, name):
+        self.define(name, "counter")
+
+    def new_gauge(self, name):
+        self.define(name, "gauge")
+
+    def new_meter(self, name):
+        self.define(name, "meter")
+
+    def new_histogram(self, name):
+        self.define(name, "histogram")
+
+    def notify(self, name, value):
+        """
+        Send the given numeric value to the named metric
+        Raise InvalidMetricError if the given name has not been defined
+        """
+
+        try:
+            id_ = self.defined[name][0]
+        except KeyError:
+            raise exceptions.InvalidMetricError("Metric {} not defined!".format(name))
+
+        record = NOTIFY.pack(NOTIFY_OP, id_, value)
+
+        with self.lock:
+            self._check_pid()
+
+            self._buffer += record
+            self._pending += 1
+
+            if self._pending >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """
+        Send the buffered notifications
+        """
+
+        with self.lock:
+            self._check_pid()
+            self._flush()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+
+        self._socket = sock
+
+        # the ids are valid for a single connection
+        definitions = bytearray()
+        for name, (id_, kind) in py3comp.iteritems(self.defined):
+            definitions += pack_define(id_, name, kind)
+
+        return definitions
+
+    def _send(self, data):
+        """
+        Send the given data without blocking, return False if the socket's buffer is full
+        """
+
+        view = memoryview(data)
+        while len(view):
+            try:
+                sent = self._socket.send(view)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+
+            view = view[sent:]
+
+        return True
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        payload, self._buffer, self._pending = self._buffer, bytearray(), 0
+
+        try:
+            if self._socket is None:
+                payload = self._connect() + payload
+
+            if self._send(FRAME.pack(len(payload)) + payload):
+                return
+
+            # the aggregator is not keeping up: the partially sent frame is discarded by the
+            # aggregator when the connection is closed, the next one defines the metrics again
+            log.debug("The aggregator at %s is not reading, discarding the notifications", self.path)
+        except socket.error as e:
+            log.debug("Cannot send the notifications to %s: %s", self.path, e)
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def close(self):
+        """
+        Send the buffered notifications and close the connection
+        """
+
+        self._stopped.set()
+
+        with self.lock:
+            if self._pid == os.getpid():
+                self._flush()
+
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+
+@atexit.register
+def cleanup():
+    for client in list(CLIENTS):
+        client.close()
@@ -0,0 +1,308 @@
+##  Module asgi.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+
+"""
+ASGI middleware (python >= 3.5), without external dependencies
+
+It exposes the same resources as the WSGI middleware, except ``/batch``. The handlers
+run in an executor, so that computing the values of a big histogram (or waiting for
+a metric's lock) doesn't block the event loop.
+"""
+
+import asyncio
+import json
+import logging
+import urllib.parse
+
+from . import metrics, prometheus, handlers
+
+
+log = logging.getLogger("appmetrics.asgi")
+
+STATUS_DESCRIPTIONS = {
+    400: "The browser (or proxy) sent a request that this server could not understand.",
+    404: "The requested URL was not found on the server.",
+    405: "The method is not allowed for the requested URL.",
+    415: "The server does not support the media type transmitted in the request.",
+}
+
+
+# a route's segment matching the rest of the path
+ANY_PATH = object()
+
+# the error returned to the client as a JSON string, with the given status
+HTTPError = handlers.HTTPError
+
+
+class Request(object):
+    """
+    The data of a request, as read from the ASGI scope
+    """
+
+    def __init__(self, scope, body=b""):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+
+        query = scope.get('query_string', b"").decode("latin-1")
+        self.args = dict((k, v[0]) for k, v in urllib.parse.parse_qs(query).items())
+
+        self.headers = dict(
+            (k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in scope.get('headers', []))
+
+        content_type = self.headers.get('content-type', "").split(";")
+        self.mimetype = content_type[0].strip().lower()
+
+        self.charset = "utf-8"
+        for param in content_type[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "charset":
+                self.charset = value.strip().strip('"')
+
+
+class Response(object):
+    """
+    A response with a custom status or content type
+    """
+
+    def __init__(self, body="", status=200, content_type=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+
+
+class AppMetricsMiddleware(object):
+    """
+    ASGI middleware for AppMetrics
+
+    Instantiate me with the wrapped ASGI application. This middleware looks for http request paths
+    starting with "/_app-metrics": if not found, the wrapped application is called.
+    The resources are the same as the WSGI middleware's (see ``appmetrics.wsgi.AppMetricsMiddleware``),
+    except ``/_app-metrics/batch``; the ``ETag`` of ``/_app-metrics/metrics`` is not computed.
+
+    The handlers run in the given executor (the event loop's default one if None).
+    """
+
+    def __init__(self, app, root="_app-metrics", extra_headers=None, mimetype="application/json",
+                 prometheus_ttl=prometheus.DEFAULT_TTL, executor=None):
+        """
+        parameters:
+        - app: wrapped ASGI application
+        - root: path root to look for
+        - extra_headers: extra headers that will be appended to the return headers
+        - prometheus_ttl: seconds the Prometheus output is cached for
+        - executor: the concurrent.futures executor running the handlers
+        """
+        self.app = app
+        self.root = "/" + root.strip("/").strip()
+        self.extra_headers = extra_headers or {}
+        self.mimetype = mimetype
+        self.prometheus = prometheus.Renderer(prometheus_ttl)
+        self.executor = executor
+
+        # prefix of the metrics paths, all the paths match on the root
+        self.prefix = self.root + "/" if self.root != "/" else ""
+
+        # (path segments, {method: handler}), None matches any segment and a final
+        # ANY_PATH the rest of the path, since the metric names may contain slashes
+        self.routes = [
+            (("metrics",), dict(GET=handle_metrics_list)),
+            (("metrics", ANY_PATH), dict(
+                GET=handle_metric_show, PUT=handle_metric_new, POST=handle_metric_update,
+                DELETE=handle_metric_delete)),
+            (("tags",), dict(GET=handle_tags_list)),
+            (("tags", None), dict(GET=handle_tag_show)),
+            (("tags", None, ANY_PATH), dict(PUT=handle_tag_add, DELETE=handle_untag)),
+            (("profiles",), dict(GET=handle_profiles_list)),
+            (("profiles", ANY_PATH), dict(GET=handle_profiles_show)),
+            (("prometheus",), dict(GET=self.handle_prometheus)),
+        ]
+
+    def match(self, method, path):
+        """
+        Return the handler and the arguments for the given request, None if the path doesn't match.
+        Raise HTTPError if the method is not allowed
+        """
+
+        if not path.startswith(self.prefix):
+            return None
+
+        segments = path[len(self.root.rstrip("/")) + 1:].split("/")
+
+        for pattern, methods in self.routes:
+            if pattern[-1] is ANY_PATH and len(segments) > len(pattern):
+                candidate = segments[:len(pattern) - 1] + ["/".join(segments[len(pattern) - 1:])]
+            elif len(pattern) == len(segments):
+                candidate = segments
+            else:
+                continue
+
+            args = []
+            for expected, segment in zip(pattern, candidate):
+                if (expected is None or expected is ANY_PATH) and segment:
+                    args.append(segment)
+                elif expected != segment:
+                    break
+            else:
+                if method not in methods:
+                    allowed = ", ".join(sorted(methods))
+                    raise HTTPError(405, headers=[("Allow", allowed)])
+
+                return methods[method], args
+
+        return None
+
+    def handle_prometheus(self, request):
+        return Response("".join(self.prometheus()), content_type=prometheus.CONTENT_TYPE)
+
+    async def __call__(self, scope, receive, send):
+        """ASGI application interface"""
+
+        # don't route the application's requests
+        if scope['type'] != "http" or not scope['path'].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            route = self.match(scope['method'], scope['path'])
+        except HTTPError as e:
+            await self.send_error(send, e)
+            return
+
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        handler, args = route
+        request = Request(scope, await read_body(receive))
+        loop = asyncio.get_event_loop()
+
+        try:
+            body = await loop.run_in_executor(self.executor, lambda: handler(request, *args))
+        except HTTPError as e:
+            await self.send_error(send, e)
+            return
+        except Exception as e:
+            log.debug("Unhandled exception: %s", e, exc_info=True)
+            await self.send_response(send, "Internal Server Error", 500)
+            return
+
+        if isinstance(body, Response):
+            await self.send_response(send, body.body, body.status, content_type=body.content_type)
+        else:
+            await self.send_response(send, body, 200)
+
+    async def send_error(self, send, error):
+        description = error.description or STATUS_DESCRIPTIONS.get(error.status, "")
+        await self.send_response(send, json.dumps(description), error.status, error.headers)
+
+    async def send_response(self, send, body, status, headers=None, content_type=None):
+        body = body.encode("utf8")
+
+        headers = dict(headers or [])
+        headers.update(self.extra_headers)
+        headers = [
+            ("Content-Type", content_type or self.mimetype),
+            ("Content-Length", str(len(body)))] + list(headers.items())
+
+        await send({
+            'type': "http.response.start",
+            'status': status,
+            'headers': [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+        })
+        await send({'type': "http.response.body", 'body': body})
+
+
+async def read_body(receive):
+    chunks = []
+
+    while True:
+        message = await receive()
+        if message['type'] != "http.request":
+            break
+
+        chunks.append(message.get('body', b""))
+        if not message.get('more_body', False):
+            break
+
+    return b"".join(chunks)
+
+
+def get_body(request):
+    if request.mimetype != "application/json":
+        raise HTTPError(415)
+
+    try:
+        return json.loads(request.body.decode(request.charset))
+    except (ValueError, LookupError) as e:
+        log.debug("Invalid body: %s", e)
+        raise HTTPError(400, "invalid json")
+
+
+def handle_metrics_list(request):
+    if request.args.get('all', 'false') == 'true':
+        return json.dumps(metrics.metrics_by_name_list(metrics.metrics()))
+    elif request.args.get('names'):
+        names = sorted(set(x for x in request.args['names'].split(",") if x))
+        return json.dumps(metrics.metrics_by_name_list(names))
+
+    return json.dumps(metrics.metrics())
+
+
+def handle_metric_show(request, name):
+    return handlers.metric_show(name)
+
+
+def handle_metric_delete(request, name):
+    return handlers.metric_delete(name)
+
+
+def handle_metric_new(request, name):
+    return handlers.metric_new(name, get_body(request))
+
+
+def handle_metric_update(request, name):
+    return handlers.metric_update(name, get_body(request))
+
+
+def handle_tags_list(request):
+    return handlers.tags_list()
+
+
+def handle_tag_show(request, tag_name):
+    names = handlers.tag_metrics(tag_name)
+
+    if request.args.get('expand', 'false') == 'true':
+        return json.dumps(metrics.metrics_by_name_list(names))
+    else:
+        return json.dumps(names)
+
+
+def handle_tag_add(request, tag_name, metric_name):
+    return handlers.tag_add(tag_name, metric_name)
+
+
+def handle_untag(request, tag_name, metric_name):
+    return handlers.untag(tag_name, metric_name)
+
+
+def handle_profiles_list(request):
+    return handlers.profiles_list()
+
+
+def handle_profiles_show(request, name):
+    return handlers.profiles_show(name)
@@ -0,0 +1,152 @@
+##  Module handlers.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+
+"""
+The resources exposed by the WSGI and the ASGI middlewares, independent of the framework
+
+The functions return the response's body and raise HTTPError, which each
+middleware translates into its own error response.
+"""
+
+import json
+import logging
+
+from . import metrics, exceptions, profiling
+
+
+log = logging.getLogger("appmetrics.handlers")
+
+
+class HTTPError(Exception):
+    """
+    Error to be returned to the client with the given status; without a
+    description the middleware uses the status' default one
+    """
+
+    def __init__(self, status, description=None, headers=None):
+        self.status = status
+        self.description = description
+        self.headers = headers or []
+        super(HTTPError, self).__init__(status, description)
+
+
+def metric_show(name):
+    try:
+        metric = metrics.metric(name)
+    except KeyError:
+        raise HTTPError(404, "No such metric: {!r}".format(name))
+
+    return json.dumps(metric.get())
+
+
+def metric_delete(name):
+    res = metrics.delete_metric(name)
+
+    return "deleted" if res else "not deleted"
+
+
+def metric_new(name, data):
+    """
+    Create the named metric from the given request's body
+    """
+
+    if not isinstance(data, dict):
+        raise HTTPError(400, "invalid body")
+
+    type_ = data.pop('type', None)
+    if not type_:
+        raise HTTPError(400, "metric type not provided")
+
+    metric_type = metrics.METRIC_TYPES.get(type_)
+
+    if not metric_type:
+        raise HTTPError(400, "invalid metric type: {!r}".format(type_))
+
+    try:
+        metric_type(name, **data)
+    except exceptions.AppMetricsError as e:
+        raise HTTPError(400, "can't create metric {}({!r}): {}".format(type_, name, e))
+    except Exception as e:
+        log.debug(str(e), exc_info=True)
+        raise HTTPError(400, "can't create metric {}({!r})".format(type_, name))
+
+    return ""
+
+
+def metric_update(name, data):
+    """
+    Notify the named metric with the value in the given request's body
+    """
+
+    if not isinstance(data, dict):
+        raise HTTPError(400, "invalid body")
+
+    value = data.pop('value', None)
+    if value is None:
+        raise HTTPError(400, "metric value not provided")
+
+    try:
+        metric = metrics.metric(name)
+    except KeyError:
+        raise HTTPError(404)
+
+    metric.notify(value)
+
+    return ""
+
+
+def tags_list():
+    return json.dumps(sorted(metrics.tags().keys()))
+
+
+def tag_metrics(tag_name):
+    """
+    Return the names of the metrics with the given tag
+    """
+
+    all_tags = metrics.tags()
+    if tag_name not in all_tags:
+        raise HTTPError(404, "no such tag: {!r}".format(tag_name))
+
+    # the tag's set could change while the metrics are read
+    return sorted(all_tags[tag_name])
+
+
+def tag_add(tag_name, metric_name):
+    try:
+        metrics.tag(metric_name, tag_name)
+    except metrics.InvalidMetricError as e:
+        raise HTTPError(400, str(e))
+
+    return ""
+
+
+def untag(tag_name, metric_name):
+    res = metrics.untag(metric_name, tag_name)
+
+    return "deleted" if res else "not deleted"
+
+
+def profiles_list():
+    return json.dumps(profiling.profiled())
+
+
+def profiles_show(name):
+    try:
+        return json.dumps(profiling.profiles(name))
+    except exceptions.InvalidMetricError:
+        raise HTTPError(404, "No profiles for metric: {!r}".format(name))
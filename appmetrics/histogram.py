@@ -16,19 +16,27 @@
 
 import collections
 import random
-import threading
 import abc
 import time
 import operator
 import math
+import sys
 
-from . import statistics, exceptions, py3comp
+from . import statistics, exceptions, py3comp, locks, memory, selfmetrics
 
 
 DEFAULT_UNIFORM_RESERVOIR_SIZE = 1028
 DEFAULT_TIME_WINDOW_SIZE = 60
 DEFAULT_EXPONENTIAL_DECAY_FACTOR = 0.015
 
+# percentile levels computed by default by Histogram.get()
+DEFAULT_PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+
+# statistics that can be computed by Histogram.get(), besides "kind" and "n"
+HISTOGRAM_FIELDS = (
+    'min', 'max', 'arithmetic_mean', 'geometric_mean', 'harmonic_mean', 'median', 'variance',
+    'standard_deviation', 'skewness', 'kurtosis', 'percentile', 'histogram')
+
 
 def search_greater(values, target):
     """
@@ -56,6 +64,8 @@ class ReservoirBase(object):
     _same_parameters
     """
 
+    __slots__ = ()
+
     def add(self, value):
         """
         Add a value to the reservoir
@@ -76,6 +86,23 @@ class ReservoirBase(object):
 
         return self._get_values()
 
+    @property
+    def version(self):
+        """
+        Return a counter which changes each time the reservoir's content changes,
+        or None if the subclass doesn't keep one: the statistics are not cached then
+        """
+
+        return getattr(self, '_version', None)
+
+    def totals(self):
+        """
+        Return (count, sum) of all the values ever added, whatever the reservoir
+        keeps, or None if the subclass doesn't track them
+        """
+
+        return None
+
     @property
     def sorted_values(self):
         """
@@ -92,6 +119,14 @@ class ReservoirBase(object):
 
         return type(self) is type(other) and self._same_parameters(other)
 
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the reservoir and its values, in bytes.
+        Override in subclasses with a constant-time version
+        """
+
+        return sys.getsizeof(self) + memory.sizeof_items(self.values)
+
     @abc.abstractmethod
     def _do_add(self, value):
         """
@@ -120,11 +155,15 @@ class UniformReservoir(ReservoirBase):
     (http://www.cs.umd.edu/~samir/498/vitter.pdf)
     """
 
+    __slots__ = ('size', '_values', 'count', '_sum', '_version', 'lock')
+
     def __init__(self, size=DEFAULT_UNIFORM_RESERVOIR_SIZE):
         self.size = size
         self._values = [0] * size
         self.count = 0
-        self.lock = threading.Lock()
+        self._sum = 0.0
+        self._version = 0
+        self.lock = locks.striped_lock(timed=True)
 
     def _do_add(self, value):
         changed = False
@@ -142,12 +181,24 @@ class UniformReservoir(ReservoirBase):
                     changed = True
 
             self.count += 1
+            self._sum += value
+
+            if changed:
+                self._version += 1
 
         return changed
 
+    def totals(self):
+        with self.lock:
+            return self.count, self._sum
+
     def _get_values(self):
         return self._values[:min(self.count, self.size)]
 
+    def sizeof(self):
+        # the slots not filled yet share the same zero
+        return sys.getsizeof(self) + memory.sizeof_items(self._values, min(self.count, self.size))
+
     def _same_parameters(self, other):
         return self.size == other.size
 
@@ -160,18 +211,35 @@ class SlidingWindowReservoir(ReservoirBase):
     A simple sliding-window reservoir that keeps the last N values
     """
 
+    __slots__ = ('size', 'deque', '_version', '_count', '_sum', 'lock')
+
     def __init__(self, size=DEFAULT_UNIFORM_RESERVOIR_SIZE):
         self.size = size
         self.deque = collections.deque(maxlen=self.size)
+        self._version = 0
+        self._count = 0
+        self._sum = 0.0
+        self.lock = locks.striped_lock(timed=True)
 
     def _do_add(self, value):
-        # No need for explicit lock - deques should be thread-safe:
-        # http://docs.python.org/2/library/collections.html#collections.deque
-        self.deque.append(value)
+        # deques are thread-safe, but the version must be updated atomically
+        # with the content or a concurrent reader could cache stale values
+        with self.lock:
+            self.deque.append(value)
+            self._version += 1
+            self._count += 1
+            self._sum += value
+
+    def totals(self):
+        with self.lock:
+            return self._count, self._sum
 
     def _get_values(self):
         return list(self.deque)
 
+    def sizeof(self):
+        return sys.getsizeof(self) + memory.sizeof_items(self.deque)
+
     def _same_parameters(self, other):
         return self.size == other.size
 
@@ -184,15 +252,22 @@ class SlidingTimeWindowReservoir(ReservoirBase):
     A time-sliced reservoir that keeps the values added in the last N seconds
     """
 
+    __slots__ = ('window_size', 'lock', '_values', '_version', '_count', '_sum')
+
+    # the values are sorted by timestamp
+    key = operator.itemgetter(0)
+
     def __init__(self, window_size=DEFAULT_TIME_WINDOW_SIZE):
         """
         Build a new sliding time-window reservoir
         window_size is the time window size in seconds
         """
         self.window_size = window_size
-        self.lock = threading.Lock()
-        self.key = operator.itemgetter(0)
+        self.lock = locks.striped_lock(timed=True)
         self._values = []
+        self._version = 0
+        self._count = 0
+        self._sum = 0.0
 
     def _do_add(self, value):
         now = time.time()
@@ -200,7 +275,14 @@ class SlidingTimeWindowReservoir(ReservoirBase):
         with self.lock:
             self.tick(now)
 
-        self._values.append((now, value))
+            self._values.append((now, value))
+            self._version += 1
+            self._count += 1
+            self._sum += value
+
+    def totals(self):
+        with self.lock:
+            return self._count, self._sum
 
     def tick(self, now):
         target = now - self.window_size
@@ -212,6 +294,15 @@ class SlidingTimeWindowReservoir(ReservoirBase):
         # older values found, discard them
         if idx:
             self._values = self._values[idx:]
+            self._version += 1
+
+    @property
+    def version(self):
+        # values expire even if nothing gets added
+        with self.lock:
+            self.tick(time.time())
+
+        return self._version
 
     def _get_values(self):
         now = time.time()
@@ -221,6 +312,10 @@ class SlidingTimeWindowReservoir(ReservoirBase):
 
         return [y for x, y in self._values]
 
+    def sizeof(self):
+        # the expired values are counted until the next tick discards them
+        return sys.getsizeof(self) + memory.sizeof_items(self._values)
+
     def _same_parameters(self, other):
         return self.window_size == other.window_size
 
@@ -243,17 +338,27 @@ class ExponentialDecayingReservoir(ReservoirBase):
     RESCALE_THRESHOLD = 3600
     EPSILON = 1e-12
 
+    __slots__ = ('size', 'alpha', 'start_time', 'lock', 'count', 'next_scale_time', '_values', '_version',
+                 '_total_count', '_sum')
+
+    # the values are sorted by weighted time
+    key = operator.itemgetter(0)
+
     def __init__(self, size=DEFAULT_UNIFORM_RESERVOIR_SIZE,
                  alpha=DEFAULT_EXPONENTIAL_DECAY_FACTOR):
         self.size = size
         self.alpha = alpha
         self.start_time = time.time()
-        self.lock = threading.Lock()
+        self.lock = locks.striped_lock(timed=True)
         self.count = 0
         self.next_scale_time = self.start_time + self.RESCALE_THRESHOLD
-        self.key = operator.itemgetter(0)
 
         self._values = []
+        self._version = 0
+
+        # "count" restarts at each rescale
+        self._total_count = 0
+        self._sum = 0.0
 
     def _lookup(self, timestamp):
         """
@@ -303,9 +408,18 @@ class ExponentialDecayingReservoir(ReservoirBase):
                         changed = True
 
             self.count += 1
+            self._total_count += 1
+            self._sum += value
+
+            if changed:
+                self._version += 1
 
         return changed
 
+    def totals(self):
+        with self.lock:
+            return self._total_count, self._sum
+
     def weight(self, t):
         return math.exp(self.alpha * t)
 
@@ -319,12 +433,16 @@ class ExponentialDecayingReservoir(ReservoirBase):
                     self._put(k, v)
 
                 self.count = len(self._values)
+                self._version += 1
                 self.start_time = now
                 self.next_scale_time = self.start_time + self.RESCALE_THRESHOLD
 
     def _get_values(self):
         return [y for x, y in self._values[:max(self.count, self.size)]]
 
+    def sizeof(self):
+        return sys.getsizeof(self) + memory.sizeof_items(self._values)
+
     def _same_parameters(self, other):
         return self.size == other.size and self.alpha == other.alpha
 
@@ -332,27 +450,213 @@ class ExponentialDecayingReservoir(ReservoirBase):
         return "{}({}, {})".format(type(self).__name__, self.size, self.alpha)
 
 
+class IntervalRecorder(object):
+    """
+    A double-buffered recorder which collects the values added since the
+    latest swap, sampling them uniformly if they exceed the given size.
+    Both the writers and the reader hold the lock only for constant-time
+    operations, the statistics are computed on the swapped-out buffer.
+    """
+
+    __slots__ = ('size', 'count', 'lock', '_active')
+
+    def __init__(self, size=DEFAULT_UNIFORM_RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.lock = locks.striped_lock(timed=True)
+        self._active = []
+
+    def add(self, value):
+        """Add a floating-point value to the active buffer"""
+
+        with self.lock:
+            if self.count < self.size:
+                self._active.append(value)
+            else:
+                k = int(random.uniform(0, self.count))
+                if k < self.size:
+                    self._active[k] = value
+
+            self.count += 1
+
+    def swap(self):
+        """Replace the active buffer with an empty one and return the old one's values"""
+
+        with self.lock:
+            values, self._active = self._active, []
+            self.count = 0
+
+        return values
+
+    def sizeof(self):
+        """Return an estimate of the memory used by the recorder and its buffer, in bytes"""
+
+        return sys.getsizeof(self) + memory.sizeof_items(self._active)
+
+
+NO_RECORDERS = {}
+
+
 class Histogram(object):
     """A metric which calculates some statistics over the distribution of some
     values"""
 
-    def __init__(self, reservoir):
+    __slots__ = ('reservoir', 'fields', 'percentiles', '_snapshot', '_recorders', '_recorders_lock')
+
+    def __init__(self, reservoir, fields=None, percentiles=None):
+        """
+        Build a new histogram on the given reservoir.
+        "fields" is an iterable of statistics names (see HISTOGRAM_FIELDS) to be
+        computed by get(), "percentiles" is an iterable of percentile levels:
+        they default to all the fields and to DEFAULT_PERCENTILES
+        """
+
         self.reservoir = reservoir
 
+        if fields is None:
+            self.fields = HISTOGRAM_FIELDS
+        else:
+            fields = set(fields)
+            unknown = fields.difference(HISTOGRAM_FIELDS)
+            if unknown:
+                raise exceptions.InvalidMetricError(
+                    "Unknown histogram fields: {}".format(", ".join(sorted(unknown))))
+            self.fields = tuple(x for x in HISTOGRAM_FIELDS if x in fields)
+
+        if percentiles is None:
+            self.percentiles = DEFAULT_PERCENTILES
+        else:
+            self.percentiles = tuple(percentiles)
+            for level in self.percentiles:
+                if not 0 < level <= 100:
+                    raise exceptions.InvalidMetricError("Invalid percentile level: {}".format(level))
+
+        # (reservoir version, computed statistics)
+        self._snapshot = None
+
+        # interval recorders by key. The dictionary is never modified in place
+        # so that notify() can iterate over it without locking (and the
+        # histograms without recorders can share the same empty one)
+        self._recorders = NO_RECORDERS
+        self._recorders_lock = locks.striped_lock()
+
     def notify(self, value):
         """Add a new value to the metric"""
 
-        return self.reservoir.add(value)
+        res = self.reservoir.add(value)
+
+        recorders = self._recorders
+        if recorders:
+            value = float(value)
+            for recorder in recorders.values():
+                recorder.add(value)
+
+        return res
+
+    def totals(self):
+        """
+        Return (count, sum) of all the values notified since the histogram's
+        creation, whatever the reservoir keeps; None if the reservoir doesn't
+        track them (see ReservoirBase.totals())
+        """
+
+        return self.reservoir.totals()
 
     def raw_data(self):
         """Return the raw underlying data"""
 
         return self.reservoir.values
 
+    @property
+    def version(self):
+        """
+        Return the reservoir's version: it changes whenever the statistics may change
+        """
+
+        return self.reservoir.version
+
     def get(self):
-        """Return the computed statistics over the gathered data"""
+        """
+        Return the computed statistics over the gathered data.
+        The statistics are cached until the reservoir's content changes, if
+        the reservoir has a version.
+        """
+
+        t1 = time.time() if selfmetrics.ENABLED else None
+
+        # read the version before the values: if the reservoir changes in the
+        # meanwhile the snapshot will be recomputed on the next call
+        version = self.reservoir.version
+
+        if version is None:
+            res = self.compute(self.reservoir.sorted_values)
+        else:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot[0] != version:
+                snapshot = self._snapshot = (version, self.compute(self.reservoir.sorted_values))
+
+            # protect the cached value against accidental modifications
+            res = snapshot[1].copy()
+            for field in ('percentile', 'histogram'):
+                if field in res:
+                    res[field] = list(res[field])
+
+        if t1 is not None:
+            selfmetrics.record(selfmetrics.HISTOGRAM_GET, time.time() - t1)
+
+        return res
+
+    def get_interval(self, key):
+        """
+        Return the statistics computed over the values notified since the
+        previous call with the same key. The first call starts the recording,
+        so it always returns the statistics of an empty distribution.
+        """
 
-        values = self.reservoir.sorted_values
+        recorder = self._recorders.get(key)
+
+        if recorder is None:
+            with self._recorders_lock:
+                recorder = self._recorders.get(key)
+                if recorder is None:
+                    recorder = IntervalRecorder()
+                    recorders = self._recorders.copy()
+                    recorders[key] = recorder
+                    self._recorders = recorders
+
+        return self.compute(sorted(recorder.swap()))
+
+    def release_interval(self, key):
+        """Stop recording the values for the given interval key"""
+
+        with self._recorders_lock:
+            if key in self._recorders:
+                recorders = self._recorders.copy()
+                del recorders[key]
+                self._recorders = recorders
+
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the histogram, in bytes: the
+        reservoir, the interval recorders and the cached statistics
+        """
+
+        size = sys.getsizeof(self) + self.reservoir.sizeof()
+
+        recorders = self._recorders
+        if recorders is not NO_RECORDERS:
+            size += sys.getsizeof(recorders)
+            for recorder in list(recorders.values()):
+                size += recorder.sizeof()
+
+        snapshot = self._snapshot
+        if snapshot is not None:
+            size += sys.getsizeof(snapshot) + memory.sizeof_dict(snapshot[1])
+
+        return size
+
+    def compute(self, values):
+        """Return the configured statistics computed over the given sorted values"""
 
         def safe(f, *args):
             try:
@@ -360,28 +664,34 @@ class Histogram(object):
             except exceptions.StatisticsError:
                 return 0.0
 
-        plevels = [50, 75, 90, 95, 99, 99.9]
-        percentiles = [safe(statistics.percentile, p) for p in plevels]
-
-        try:
-            histogram = statistics.get_histogram(values)
-        except exceptions.StatisticsError:
-            histogram = [(0, 0)]
-
-        res = dict(
-            kind="histogram",
-            min=values[0] if values else 0,
-            max=values[-1] if values else 0,
-            arithmetic_mean=safe(statistics.mean),
-            geometric_mean=safe(statistics.geometric_mean),
-            harmonic_mean=safe(statistics.harmonic_mean),
-            median=safe(statistics.median),
-            variance=safe(statistics.variance),
-            standard_deviation=safe(statistics.stdev),
-            skewness=safe(statistics.skewness),
-            kurtosis=safe(statistics.kurtosis),
-            percentile=py3comp.zip(plevels, percentiles),
-            histogram=histogram,
-            n=len(values))
+        res = dict(kind="histogram", n=len(values))
+
+        for field in self.fields:
+            if field == 'min':
+                res[field] = values[0] if values else 0
+            elif field == 'max':
+                res[field] = values[-1] if values else 0
+            elif field == 'percentile':
+                percentiles = [safe(statistics.percentile, p) for p in self.percentiles]
+                res[field] = py3comp.zip(self.percentiles, percentiles)
+            elif field == 'histogram':
+                try:
+                    res[field] = statistics.get_histogram(values)
+                except exceptions.StatisticsError:
+                    res[field] = [(0, 0)]
+            else:
+                res[field] = safe(STATISTICS[field])
+
         return res
 
+
+STATISTICS = {
+    'arithmetic_mean': statistics.mean,
+    'geometric_mean': statistics.geometric_mean,
+    'harmonic_mean': statistics.harmonic_mean,
+    'median': statistics.median,
+    'variance': statistics.variance,
+    'standard_deviation': statistics.stdev,
+    'skewness': statistics.skewness,
+    'kurtosis': statistics.kurtosis,
+}
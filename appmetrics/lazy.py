@@ -0,0 +1,55 @@
+##  Module lazy.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+"""
+Lazy imports, to keep the modules not needed to record the values out of the startup time
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stand-in for the named module, imported (with the given submodules) on the
+    first access to one of its attributes
+    """
+
+    def __init__(self, name, submodules=()):
+        self._lazy_name = name
+        self._lazy_submodules = tuple(submodules)
+        self._lazy_module = None
+
+    def _lazy_load(self):
+        module = self._lazy_module
+
+        if module is None:
+            module = importlib.import_module(self._lazy_name)
+            for submodule in self._lazy_submodules:
+                importlib.import_module("{}.{}".format(self._lazy_name, submodule))
+
+            self._lazy_module = module
+
+        return module
+
+    def __getattr__(self, name):
+        # called only for the attributes not found on the stand-in
+        if name.startswith("_lazy_"):
+            raise AttributeError(name)
+
+        return getattr(self._lazy_load(), name)
+
+    def __repr__(self):
+        return "<lazy module {!r}{}>".format(self._lazy_name, "" if self._lazy_module is not None else " (not loaded)")
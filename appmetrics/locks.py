@@ -0,0 +1,92 @@
+##  Module locks.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+"""
+Striped locks, shared by the metrics instead of allocating a lock each.
+
+A striped lock must be held only for short sections which don't acquire any other
+striped lock: two objects can share the same lock, so nesting them could deadlock.
+"""
+
+import itertools
+import threading
+import time
+
+
+STRIPES = 64
+
+LOCKS = [threading.Lock() for _ in range(STRIPES)]
+
+# next() on a count is atomic
+_next_stripe = itertools.count()
+
+
+# called with the seconds spent waiting for a contended timed lock, see
+# striped_lock(). Set by the self-instrumentation (see selfmetrics.py)
+WAIT_OBSERVER = None
+
+
+def striped_lock(timed=False):
+    """
+    Return a lock of the pool, assigned round-robin so that the first STRIPES
+    callers get a lock each. If "timed" is True and WAIT_OBSERVER is set, the
+    lock is wrapped in a TimedLock reporting to it
+    """
+
+    lock = LOCKS[next(_next_stripe) % STRIPES]
+
+    observer = WAIT_OBSERVER
+    if timed and observer is not None:
+        return TimedLock(lock, observer)
+
+    return lock
+
+
+class TimedLock(object):
+    """
+    Context manager wrapping a lock: the time spent waiting for it, when it's
+    contended, is passed to the observer after the lock is released, so that
+    the observer can acquire other striped locks
+    """
+
+    __slots__ = ('lock', 'observer', '_wait')
+
+    def __init__(self, lock, observer):
+        self.lock = lock
+        self.observer = observer
+
+        # written only by the holder of the lock
+        self._wait = None
+
+    def __enter__(self):
+        lock = self.lock
+
+        if not lock.acquire(False):
+            t1 = time.time()
+            lock.acquire()
+            self._wait = time.time() - t1
+
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wait = self._wait
+
+        if wait is None:
+            self.lock.release()
+        else:
+            self._wait = None
+            self.lock.release()
+            self.observer(wait)
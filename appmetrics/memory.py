@@ -0,0 +1,70 @@
+##  Module memory.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+
+"""
+Estimates of the memory used by the metrics, see the sizeof() methods
+"""
+
+import sys
+
+
+def sizeof_item(item):
+    """
+    Return the size of a value, or of a tuple with its elements
+    """
+
+    size = sys.getsizeof(item)
+
+    if isinstance(item, tuple):
+        for x in item:
+            size += sys.getsizeof(x)
+
+    return size
+
+
+def sizeof_items(items, count=None):
+    """
+    Estimate the size of a list or deque of values of the same kind, with its items.
+    Only the first "count" items (default: all) are counted, assuming that they
+    have the same size as the first one: it's an estimate, but it's constant-time
+    """
+
+    size = sys.getsizeof(items)
+
+    if count is None:
+        count = len(items)
+
+    if count:
+        size += count * sizeof_item(items[0])
+
+    return size
+
+
+def sizeof_dict(data):
+    """
+    Return the size of a dictionary with its keys and values, not following
+    the nested objects
+    """
+
+    if data is None:
+        return 0
+
+    size = sys.getsizeof(data)
+    for k, v in list(data.items()):
+        size += sys.getsizeof(k) + sizeof_item(v)
+
+    return size
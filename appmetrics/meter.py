@@ -20,8 +20,10 @@ Meter metric - measures throughput at various time intervals
 """
 
 import math
+import sys
 import time
-import threading
+
+from . import locks, memory
 
 
 DEFAULT_TICK_INTERVAL = 5
@@ -32,8 +34,12 @@ class EWMA(object):
     Compute exponential-weighted moving average of values incoming at a fixed rate.
 
     http://en.wikipedia.org/wiki/Moving_average#Exponential_moving_average
+
+    Not thread-safe: the owner (a Meter) serializes the calls
     """
 
+    __slots__ = ('time_period', 'tick_interval', 'rate', 'value', 'initialized', 'alpha')
+
     def __init__(self, time_period, tick_interval):
         """
         time_unit is the period of time on which the moving average is computed,
@@ -49,8 +55,6 @@ class EWMA(object):
 
         self.alpha = self.compute_alpha(time_period, tick_interval)
 
-        self.lock = threading.Lock()
-
     @staticmethod
     def compute_alpha(period, interval):
         """Compute exponential smoothing factor"""
@@ -63,24 +67,25 @@ class EWMA(object):
         The value must be an integer.
         """
 
-        value = int(value)
-
-        with self.lock:
-            self.value += value
+        self.value += int(value)
 
     def tick(self):
         """Decay the current rate according to the elapsed time"""
 
         instant_rate = float(self.value) / float(self.tick_interval)
 
-        with self.lock:
-            if self.initialized:
-                self.rate += (self.alpha * (instant_rate - self.rate))
-            else:
-                self.initialized = True
-                self.rate = instant_rate
+        if self.initialized:
+            self.rate += (self.alpha * (instant_rate - self.rate))
+        else:
+            self.initialized = True
+            self.rate = instant_rate
+
+        self.value = 0
 
-            self.value = 0
+    def sizeof(self):
+        """Return an estimate of the memory used by the average, in bytes"""
+
+        return sys.getsizeof(self) + sys.getsizeof(self.rate) + sys.getsizeof(self.alpha)
 
 
 class Meter(object):
@@ -91,6 +96,10 @@ class Meter(object):
     values are expressed in number of operation per second.
     """
 
+    __slots__ = (
+        'tick_interval', 'm1', 'm5', 'm15', 'day', 'started_on', 'latest_tick', 'count', '_interval',
+        '_version', 'lock')
+
     def __init__(self, tick_interval=DEFAULT_TICK_INTERVAL):
         self.tick_interval = tick_interval
 
@@ -107,7 +116,14 @@ class Meter(object):
 
         self.count = 0
 
-        self.lock = threading.Lock()
+        # (count, time) at the latest get_interval() call, by key. Created on the first call
+        self._interval = None
+
+        # incremented at each notification
+        self._version = 0
+
+        # the EWMAs are protected by this lock too
+        self.lock = locks.striped_lock()
 
     def notify(self, value):
         """Add a new observation to the metric"""
@@ -123,6 +139,16 @@ class Meter(object):
             for avg in (self.m1, self.m5, self.m15, self.day):
                 avg.update(value)
             self.count += value
+            self._version += 1
+
+    @property
+    def version(self):
+        """
+        Return a value changing at each notification and at each tick interval, since
+        the rates decay over time. The mean throughput may change anyway
+        """
+
+        return self._version, int((time.time() - self.started_on) / self.tick_interval)
 
     def tick_all(self, times):
         """
@@ -174,5 +200,56 @@ class Meter(object):
 
         return data
 
+    def get_interval(self, key):
+        """
+        Return the computed statistics, with the count and the mean throughput
+        relative to the period since the previous call with the same key
+        (or since the metric creation)
+        """
+
+        with self.lock:
+            self.tick()
+
+            if self._interval is None:
+                self._interval = {}
+
+            now = time.time()
+            previous_count, previous_time = self._interval.get(key, (0, self.started_on))
+            self._interval[key] = (self.count, now)
+
+            count = self.count - previous_count
+            elapsed = now - previous_time
+
+            data = dict(
+                kind="meter",
+                count=count,
+                mean=count / elapsed if elapsed > 0 else 0.0,
+                one=self.m1.rate,
+                five=self.m5.rate,
+                fifteen=self.m15.rate,
+                day=self.day.rate)
+
+        return data
+
+    def release_interval(self, key):
+        """
+        Forget the state of the given interval key
+        """
+
+        with self.lock:
+            if self._interval is not None:
+                self._interval.pop(key, None)
+
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the meter and its averages, in bytes
+        """
+
+        size = sys.getsizeof(self) + memory.sizeof_dict(self._interval)
+        for avg in (self.m1, self.m5, self.m15, self.day):
+            size += avg.sizeof()
+
+        return size
+
     def __repr__(self):
         return "{}({})".format(type(self).__name__, self.tick_interval)
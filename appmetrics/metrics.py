@@ -20,11 +20,12 @@ Main interface module
 
 from contextlib import contextmanager
 import functools
+import sys
 import threading
 import time
 
 from .exceptions import DuplicateMetricError, InvalidMetricError
-from . import histogram, simple_metrics, meter, py3comp
+from . import histogram, simple_metrics, meter, py3comp, profiling
 
 
 REGISTRY = {}
@@ -94,6 +95,25 @@ def get(name):
     return metric(name).get()
 
 
+def get_interval(name, key):
+    """
+    Call "get_interval" on the metric with the given name: the returned values
+    are relative to the previous call with the same key
+    Raise InvalidMetricError if the given name has not been registered
+    """
+
+    return metric(name).get_interval(key)
+
+
+def release_interval(key):
+    """
+    Release the state kept by all the metrics for the given interval key
+    """
+
+    for item in list(REGISTRY.values()):
+        item.release_interval(key)
+
+
 def notify(name, value):
     """
     Call "notify" on the metric with the given name
@@ -103,16 +123,45 @@ def notify(name, value):
     return metric(name).notify(value)
 
 
-def new_histogram(name, reservoir=None):
+def notify_many(pairs):
+    """
+    Call "notify" for each (name, value) pair, looking up each metric once.
+    Return a list of (position, error message) for the pairs that failed
+    """
+
+    errors = []
+    found = {}
+
+    for i, (name, value) in enumerate(pairs):
+        try:
+            item = found[name]
+        except KeyError:
+            item = found[name] = REGISTRY.get(name)
+
+        if item is None:
+            errors.append((i, "Metric {} not found!".format(name)))
+            continue
+
+        try:
+            item.notify(value)
+        except Exception as e:
+            errors.append((i, "{}: {}".format(type(e).__name__, e)))
+
+    return errors
+
+
+def new_histogram(name, reservoir=None, fields=None, percentiles=None):
     """
     Build a new histogram metric with a given reservoir object
     If the reservoir is not provided, a uniform reservoir with the default size is used
+    "fields" and "percentiles" select the statistics computed by the histogram,
+    see histogram.Histogram
     """
 
     if reservoir is None:
         reservoir = histogram.UniformReservoir(histogram.DEFAULT_UNIFORM_RESERVOIR_SIZE)
 
-    return new_metric(name, histogram.Histogram, reservoir)
+    return new_metric(name, histogram.Histogram, reservoir, fields, percentiles)
 
 
 def new_counter(name):
@@ -142,10 +191,15 @@ def new_meter(name, tick_interval=5):
 def new_histogram_with_implicit_reservoir(name, reservoir_type='uniform', *reservoir_args, **reservoir_kwargs):
     """
     Build a new histogram metric and a reservoir from the given parameters
+    The "fields" and "percentiles" keyword arguments, if any, are passed to the
+    histogram instead of the reservoir
     """
 
+    fields = reservoir_kwargs.pop('fields', None)
+    percentiles = reservoir_kwargs.pop('percentiles', None)
+
     reservoir = new_reservoir(reservoir_type, *reservoir_args, **reservoir_kwargs)
-    return new_histogram(name, reservoir)
+    return new_histogram(name, reservoir, fields, percentiles)
 
 
 def new_reservoir(reservoir_type='uniform', *reservoir_args, **reservoir_kwargs):
@@ -189,10 +243,18 @@ def with_histogram(name, reservoir_type="uniform", *reservoir_args, **reservoir_
     Time-measuring decorator: the time spent in the wrapped function is measured
     and added to the named metric.
     metric_args and metric_kwargs are passed to new_histogram()
+    If the "profile" keyword argument is a percentile level, the stacks of the calls
+    slower than that percentile are sampled, see the profiling module
     """
 
+    profile = reservoir_kwargs.pop('profile', None)
+
     hmetric = get_or_create_histogram(name, reservoir_type, *reservoir_args, **reservoir_kwargs)
 
+    profiler = None
+    if profile is not None:
+        profiler = profiling.get_or_create_profiler(name, hmetric, profile)
+
     def wrapper(f):
 
         @functools.wraps(f)
@@ -204,7 +266,22 @@ def with_histogram(name, reservoir_type="uniform", *reservoir_args, **reservoir_
             hmetric.notify(t2-t1)
             return res
 
-        return fun
+        @functools.wraps(f)
+        def profiled(*args, **kwargs):
+            call = profiler.start()
+
+            t1 = time.time()
+            try:
+                res = f(*args, **kwargs)
+            finally:
+                t2 = time.time()
+                if call is not None:
+                    profiler.finish(call, t2 - t1)
+
+            hmetric.notify(t2-t1)
+            return res
+
+        return fun if profiler is None else profiled
 
     return wrapper
 
@@ -277,10 +354,11 @@ def tags():
     return TAGS.copy()
 
 
-def metrics_by_tag(tag_name):
+def metrics_by_tag(tag_name, interval_key=None):
     """
     Return a dictionary with {metric name: metric values} for all the metrics with the given tag.
     Return an empty dictionary if the given tag does not exist.
+    See metrics_by_name_list() for "interval_key".
     """
 
     try:
@@ -288,7 +366,7 @@ def metrics_by_tag(tag_name):
     except KeyError:
         return {}
 
-    return metrics_by_name_list(names)
+    return metrics_by_name_list(names, interval_key)
 
 
 def untag(name, tag_name):
@@ -313,20 +391,48 @@ def untag(name, tag_name):
             return False
 
 
-def metrics_by_name_list(names):
+def metrics_by_name_list(names, interval_key=None):
     """
     Return a dictionary with {metric name: metric value} for all the metrics with the given names.
+    If "interval_key" is not None, the values are relative to the previous call
+    with the same key (see get_interval()).
+    """
+
+    return dict(iter_metrics_by_name_list(names, interval_key))
+
+
+def iter_metrics_by_name_list(names, interval_key=None):
+    """
+    Yield the (metric name, metric value) pairs of metrics_by_name_list(), computing
+    each value only when it's reached
     """
-    results = {}
 
     for name in names:
         # no lock - a metric could have been removed in the meanwhile
         try:
-            results[name] = get(name)
+            if interval_key is None:
+                value = get(name)
+            else:
+                value = get_interval(name, interval_key)
         except InvalidMetricError:
             continue
 
-    return results
+        yield name, value
+
+
+def memory_report():
+    """
+    Return a list of (metric name, estimated size in bytes) for all the metrics,
+    the biggest first. See the metrics' sizeof()
+    """
+
+    res = []
+    for name, item in list(REGISTRY.items()):
+        sizeof = getattr(item, 'sizeof', None)
+        res.append((name, sizeof() if sizeof is not None else sys.getsizeof(item)))
+
+    res.sort(key=lambda x: (-x[1], x[0]))
+    return res
 
 
 RESERVOIR_TYPES = {
@@ -0,0 +1,734 @@
+##  Module multiprocess.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+"""
+Metrics shared between the worker processes of a pre-fork server (gunicorn, uwsgi...)
+
+Each process writes its values to its own memory-mapped files in a shared directory;
+reading a metric aggregates the values written by all the processes, so every worker
+answers with the same numbers.
+"""
+
+import bisect
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from . import metrics, meter, histogram, exceptions, py3comp, memory
+
+
+# environment variable holding the shared directory, if enable() is not called
+DIRECTORY_ENV = "APPMETRICS_MULTIPROC_DIR"
+
+DIRECTORY = None
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, float("inf"))
+
+GAUGE_MODES = ('last', 'sum', 'min', 'max')
+
+# a file holds the values of the metrics of a single process, by kind:
+# gauges are kept apart since they must be discarded when a process dies
+VALUES = "values"
+GAUGES = "gauges"
+
+INITIAL_FILE_SIZE = 64 * 1024
+
+# seconds between two scans of the shared directory: the values are always read
+# live, while the new processes and the new metrics show up within this delay
+REFRESH_INTERVAL = 1.0
+
+# used size of the file
+HEADER = struct.Struct("=I4x")
+# length of the key, followed by the utf8 key, padded so that the value is 8 bytes aligned
+KEY_LENGTH = struct.Struct("=I")
+VALUE = struct.Struct("=d")
+
+
+def enable(directory=None):
+    """
+    Set the directory shared by the processes, by default it's taken from
+    the APPMETRICS_MULTIPROC_DIR environment variable. The directory must exist and
+    should be emptied when the server (not a worker) is started
+    """
+
+    global DIRECTORY
+
+    directory = directory or os.environ.get(DIRECTORY_ENV)
+    if not directory:
+        raise ValueError("No directory given and {} is not set".format(DIRECTORY_ENV))
+
+    if not os.path.isdir(directory):
+        raise ValueError("{} is not a directory".format(directory))
+
+    DIRECTORY = directory
+
+
+def get_directory():
+    """
+    Return the directory shared by the processes
+    """
+
+    if DIRECTORY is None:
+        enable()
+
+    return DIRECTORY
+
+
+def file_name(kind, pid, directory=None):
+    return os.path.join(directory or get_directory(), "{}_{}.db".format(kind, pid))
+
+
+def mark_process_dead(pid, directory=None):
+    """
+    Discard the gauges of the given (dead) process: call it from the server's
+    child exit hook. Counters, meters and histograms are kept, so that the
+    totals don't go back
+    """
+
+    try:
+        os.remove(file_name(GAUGES, pid, directory))
+    except OSError:
+        pass
+
+
+def iter_entries(buf, start, end):
+    """
+    Yield (key, value position, next entry position) for the entries written
+    in the given buffer between start and end
+    """
+
+    pos = start
+    while pos + KEY_LENGTH.size <= end:
+        length = KEY_LENGTH.unpack_from(buf, pos)[0]
+        value_pos = pos + padded_key_size(length)
+        if value_pos + VALUE.size > end:
+            break
+
+        key = buf[pos + KEY_LENGTH.size:pos + KEY_LENGTH.size + length].decode("utf8")
+        pos = value_pos + VALUE.size
+
+        yield key, value_pos, pos
+
+
+def padded_key_size(length):
+    return (KEY_LENGTH.size + length + 7) // 8 * 8
+
+
+class ValuesFile(object):
+    """
+    A memory-mapped file of named float values, written by a single process.
+    The file grows as needed; the entries are never moved, so the readers can
+    index them once
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+
+        self.fd = os.open(file_name, os.O_RDWR | os.O_CREAT)
+        size = os.fstat(self.fd).st_size
+        if size < INITIAL_FILE_SIZE:
+            os.ftruncate(self.fd, INITIAL_FILE_SIZE)
+            size = INITIAL_FILE_SIZE
+
+        self.mmap = mmap.mmap(self.fd, size)
+        self.used = HEADER.unpack_from(self.mmap, 0)[0] or HEADER.size
+
+        # key: value position
+        self.positions = {}
+        for key, value_pos, _ in iter_entries(self.mmap, HEADER.size, self.used):
+            self.positions[key] = value_pos
+
+    def _grow(self, needed):
+        size = len(self.mmap)
+        while size < needed:
+            size *= 2
+
+        os.ftruncate(self.fd, size)
+        self.mmap.close()
+        self.mmap = mmap.mmap(self.fd, size)
+
+    def _position(self, key):
+        try:
+            return self.positions[key]
+        except KeyError:
+            pass
+
+        encoded = key.encode("utf8")
+        key_size = padded_key_size(len(encoded))
+
+        if self.used + key_size + VALUE.size > len(self.mmap):
+            self._grow(self.used + key_size + VALUE.size)
+
+        pos = self.used
+        value_pos = pos + key_size
+        struct.pack_into("={}s".format(key_size - KEY_LENGTH.size), self.mmap, pos + KEY_LENGTH.size, encoded)
+        KEY_LENGTH.pack_into(self.mmap, pos, len(encoded))
+        VALUE.pack_into(self.mmap, value_pos, 0.0)
+
+        # publish the entry only when it's complete
+        self.used = value_pos + VALUE.size
+        HEADER.pack_into(self.mmap, 0, self.used)
+
+        self.positions[key] = value_pos
+        return value_pos
+
+    def read(self, key):
+        """Return the value of the given key, 0.0 if missing"""
+
+        with self.lock:
+            # the file may grow, get the position first
+            pos = self._position(key)
+            return VALUE.unpack_from(self.mmap, pos)[0]
+
+    def write(self, key, value):
+        """Set the value of the given key"""
+
+        with self.lock:
+            pos = self._position(key)
+            VALUE.pack_into(self.mmap, pos, value)
+
+    def add(self, key, amount):
+        """Increment the value of the given key and return the new value"""
+
+        with self.lock:
+            pos = self._position(key)
+            value = VALUE.unpack_from(self.mmap, pos)[0] + amount
+            VALUE.pack_into(self.mmap, pos, value)
+
+        return value
+
+    def close(self):
+        with self.lock:
+            self.mmap.close()
+            os.close(self.fd)
+
+
+class ValuesReader(object):
+    """
+    Read the values written to a ValuesFile by another process. The new entries
+    are indexed at each refresh()
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.fd = os.open(file_name, os.O_RDONLY)
+        self.mmap = None
+        self.indexed = HEADER.size
+        self.positions = {}
+
+    def refresh(self):
+        size = os.fstat(self.fd).st_size
+        if not size:
+            return
+
+        if self.mmap is None or len(self.mmap) != size:
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+        used = min(HEADER.unpack_from(self.mmap, 0)[0], size)
+        for key, value_pos, next_pos in iter_entries(self.mmap, self.indexed, used):
+            self.positions[key] = value_pos
+            self.indexed = next_pos
+
+    def get(self, key):
+        """Return the value of the given key, None if missing"""
+
+        pos = self.positions.get(key)
+        if pos is None:
+            return None
+
+        return VALUE.unpack_from(self.mmap, pos)[0]
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        os.close(self.fd)
+
+
+class Collector(object):
+    """
+    Read the values written by all the processes in the given directory. The
+    directory is scanned and the new entries are indexed at most once every
+    "refresh_interval" seconds, not at each read
+    """
+
+    def __init__(self, directory, refresh_interval=REFRESH_INTERVAL):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.refreshed_on = None
+        self.lock = threading.Lock()
+
+        # file name: (kind, pid, reader)
+        self.readers = {}
+
+    def refresh(self):
+        names = set()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".db"):
+                continue
+
+            kind, _, pid = name[:-len(".db")].partition("_")
+            if not pid.isdigit():
+                continue
+
+            names.add(name)
+            if name not in self.readers:
+                try:
+                    reader = ValuesReader(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                self.readers[name] = (kind, int(pid), reader)
+
+        for name in set(self.readers).difference(names):
+            self.readers.pop(name)[2].close()
+
+        for _, _, reader in self.readers.values():
+            reader.refresh()
+
+    def values(self, kind, keys):
+        """
+        Return {pid: {key: value}} for the given keys, for all the
+        processes having at least one of them
+        """
+
+        with self.lock:
+            now = time.time()
+            if self.refreshed_on is None or not 0 <= now - self.refreshed_on < self.refresh_interval:
+                self.refresh()
+                self.refreshed_on = now
+
+            res = {}
+            for kind_, pid, reader in self.readers.values():
+                if kind_ != kind:
+                    continue
+
+                values = dict((key, reader.get(key)) for key in keys)
+                if any(x is not None for x in values.values()):
+                    res[pid] = values
+
+        return res
+
+
+COLLECTOR = None
+LOCK = threading.Lock()
+
+# the files written by the current process, by kind
+FILES = {}
+FILES_PID = None
+
+
+def get_collector():
+    global COLLECTOR
+
+    with LOCK:
+        directory = get_directory()
+        if COLLECTOR is None or COLLECTOR.directory != directory:
+            COLLECTOR = Collector(directory, REFRESH_INTERVAL)
+
+        return COLLECTOR
+
+
+def values_file(kind):
+    """
+    Return the file of the given kind for the current process. The pid is checked
+    at each call, so that forked processes get their own files
+    """
+
+    global FILES, FILES_PID
+
+    pid = os.getpid()
+    if pid == FILES_PID:
+        try:
+            return FILES[kind]
+        except KeyError:
+            pass
+
+    with LOCK:
+        if pid != FILES_PID:
+            # the files inherited from the parent process must not be written
+            FILES, FILES_PID = {}, pid
+
+        if kind not in FILES:
+            FILES[kind] = ValuesFile(file_name(kind, pid))
+
+        return FILES[kind]
+
+
+class MultiProcessMetric(object):
+    """
+    Base class for the multi process metrics
+    """
+
+    kind = VALUES
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def key(self, field):
+        return "{}\0{}".format(self.name, field)
+
+    def values(self, *fields):
+        """
+        Return {pid: {field: value}} for the given fields
+        """
+
+        keys = dict((self.key(x), x) for x in fields)
+        res = get_collector().values(self.kind, keys)
+
+        return dict(
+            (pid, dict((keys[k], v) for k, v in py3comp.iteritems(values)))
+            for pid, values in py3comp.iteritems(res))
+
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the metric object, in bytes: the
+        values are kept in the shared files
+        """
+
+        return sys.getsizeof(self) + memory.sizeof_dict(self.__dict__)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+class MultiProcessCounter(MultiProcessMetric):
+    """
+    A counter summed over all the processes
+    """
+
+    def __init__(self, name):
+        super(MultiProcessCounter, self).__init__(name)
+
+        self._interval = {}
+
+    def notify(self, value):
+        values_file(self.kind).add(self.key("value"), int(value))
+
+    def raw_data(self):
+        return int(sum(x['value'] or 0 for x in self.values("value").values()))
+
+    def get(self):
+        return dict(kind="counter", value=self.raw_data())
+
+    def get_interval(self, key):
+        value = self.raw_data()
+
+        with self.lock:
+            previous = self._interval.get(key, 0)
+            self._interval[key] = value
+
+        return dict(kind="counter", value=value - previous)
+
+    def release_interval(self, key):
+        with self.lock:
+            self._interval.pop(key, None)
+
+
+class MultiProcessGauge(MultiProcessMetric):
+    """
+    A numeric gauge: depending on "mode", the value is the latest one set by any
+    process or the sum, the minimum or the maximum of the processes' values.
+    The values of the dead processes are discarded by mark_process_dead()
+    """
+
+    kind = GAUGES
+
+    def __init__(self, name, mode="last"):
+        if mode not in GAUGE_MODES:
+            raise exceptions.InvalidMetricError("Invalid gauge mode: {}".format(mode))
+
+        super(MultiProcessGauge, self).__init__(name)
+
+        self.mode = mode
+
+    def notify(self, value):
+        value = float(value)
+
+        values = values_file(self.kind)
+        with self.lock:
+            values.write(self.key("value"), value)
+            values.write(self.key("time"), time.time())
+
+    def raw_data(self):
+        values = [x for x in self.values("value", "time").values() if x['value'] is not None]
+        if not values:
+            return None
+
+        if self.mode == "last":
+            return max(values, key=lambda x: x['time'] or 0)['value']
+
+        values = [x['value'] for x in values]
+        if self.mode == "sum":
+            return sum(values)
+        elif self.mode == "min":
+            return min(values)
+        else:
+            return max(values)
+
+    def get(self):
+        return dict(kind="gauge", value=self.raw_data())
+
+    def get_interval(self, key):
+        return self.get()
+
+    def release_interval(self, key):
+        pass
+
+
+class MultiProcessMeter(MultiProcessMetric):
+    """
+    A meter summed over all the processes. Each process keeps its own moving
+    averages and publishes them at each tick: the rates of the idle processes are
+    decayed when read
+    """
+
+    # field, moving average, period in minutes
+    rates = (('one', 'm1', 1), ('five', 'm5', 5), ('fifteen', 'm15', 15), ('day', 'day', 60 * 24))
+
+    def __init__(self, name, tick_interval=meter.DEFAULT_TICK_INTERVAL):
+        super(MultiProcessMeter, self).__init__(name)
+
+        self.tick_interval = tick_interval
+        self.started_on = time.time()
+
+        self._meter = None
+        self._pid = None
+        self._interval = {}
+
+    def notify(self, value):
+        values = values_file(self.kind)
+
+        with self.lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                # don't publish the rates inherited from the parent process
+                self._meter, self._pid = meter.Meter(self.tick_interval), pid
+                values.write(self.key("started"), self._meter.started_on)
+
+            latest_tick = self._meter.latest_tick
+            self._meter.notify(value)
+            values.add(self.key("count"), value)
+
+            if self._meter.latest_tick != latest_tick:
+                for field, attr, _ in self.rates:
+                    values.write(self.key(field), getattr(self._meter, attr).rate)
+                values.write(self.key("tick"), self._meter.latest_tick)
+
+    def raw_data(self):
+        return self.get()['count']
+
+    def get(self):
+        fields = ['count', 'started', 'tick'] + [x[0] for x in self.rates]
+        values = self.values(*fields).values()
+
+        now = time.time()
+        count = int(sum(x['count'] or 0 for x in values))
+        started_on = min([self.started_on] + [x['started'] for x in values if x['started']])
+
+        res = dict(kind="meter", count=count, mean=count / (now - started_on))
+
+        for field, _, period in self.rates:
+            res[field] = sum(self.decay(x[field], x['tick'], period, now) for x in values)
+
+        return res
+
+    def decay(self, rate, latest_tick, period, now):
+        """
+        Return the given rate after ticking (without any event) until now
+        """
+
+        if not rate or not latest_tick:
+            return 0.0
+
+        ticks = int((now - latest_tick) / self.tick_interval)
+        return rate * math.exp(-ticks * self.tick_interval / (60.0 * period))
+
+    def get_interval(self, key):
+        data = self.get()
+        now = time.time()
+
+        with self.lock:
+            previous_count, previous_time = self._interval.get(key, (0, self.started_on))
+            self._interval[key] = (data['count'], now)
+
+        count = data['count'] - previous_count
+        elapsed = now - previous_time
+
+        data.update(count=count, mean=count / elapsed if elapsed > 0 else 0.0)
+        return data
+
+    def release_interval(self, key):
+        with self.lock:
+            self._interval.pop(key, None)
+
+
+class MultiProcessHistogram(MultiProcessMetric):
+    """
+    A histogram counting the values in fixed buckets, summed over all the processes.
+    Each bucket counts the values less than or equal to its upper bound and greater
+    than the previous one; the percentiles are interpolated within the buckets
+    """
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS, percentiles=None):
+        buckets = [float(x) for x in buckets]
+        if not buckets or buckets != sorted(set(buckets)):
+            raise exceptions.InvalidMetricError("Buckets must be sorted and unique: {}".format(buckets))
+        if buckets[-1] != float("inf"):
+            buckets.append(float("inf"))
+
+        percentiles = tuple(percentiles or histogram.DEFAULT_PERCENTILES)
+        if any(not 0 < x <= 100 for x in percentiles):
+            raise exceptions.InvalidMetricError("Invalid percentiles: {}".format(percentiles))
+
+        super(MultiProcessHistogram, self).__init__(name)
+
+        self.buckets = tuple(buckets)
+        self.percentiles = percentiles
+        self.bucket_fields = tuple("bucket_{!r}".format(x) for x in self.buckets)
+
+        self._interval = {}
+
+    def notify(self, value):
+        value = float(value)
+
+        values = values_file(self.kind)
+        with self.lock:
+            n = values.read(self.key("n"))
+            if not n or value < values.read(self.key("min")):
+                values.write(self.key("min"), value)
+            if not n or value > values.read(self.key("max")):
+                values.write(self.key("max"), value)
+
+            values.add(self.key(self.bucket_fields[bisect.bisect_left(self.buckets, value)]), 1)
+            values.add(self.key("sum"), value)
+            values.add(self.key("n"), 1)
+
+        return value
+
+    def raw_data(self):
+        """
+        Return (n, sum, min, max, bucket counts) summed over the processes
+        """
+
+        values = [x for x in self.values(*(("n", "sum", "min", "max") + self.bucket_fields)).values() if x['n']]
+
+        n = int(sum(x['n'] for x in values))
+        total = sum(x['sum'] or 0 for x in values)
+        min_ = min(x['min'] for x in values) if values else 0.0
+        max_ = max(x['max'] for x in values) if values else 0.0
+        counts = [int(sum(x[f] or 0 for x in values)) for f in self.bucket_fields]
+
+        return n, total, min_, max_, counts
+
+    def get(self):
+        n, total, min_, max_, counts = self.raw_data()
+
+        res = self.compute(n, total, min_, max_, counts)
+        res.update(min=min_, max=max_)
+        return res
+
+    def compute(self, n, total, min_, max_, counts):
+        """
+        Return the statistics for the given bucket counts, the observed minimum and maximum
+        bound the first and the last bucket
+        """
+
+        bounds = [min(x, max_) for x in self.buckets]
+
+        res = dict(
+            kind="histogram",
+            n=n,
+            arithmetic_mean=total / n if n else 0.0,
+            histogram=[(b, c) for b, c in zip(bounds, counts) if c] or [(0, 0)])
+
+        res['percentile'] = [(p, self.percentile(p, n, min_, bounds, counts)) for p in self.percentiles]
+
+        return res
+
+    def percentile(self, p, n, min_, bounds, counts):
+        if not n:
+            return 0.0
+
+        rank = p / 100.0 * n
+        seen = 0
+        lower = min_
+        for bound, count in zip(bounds, counts):
+            if count and seen + count >= rank:
+                lower = max(lower, min_)
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+
+        return bounds[-1]
+
+    def get_interval(self, key):
+        n, total, min_, max_, counts = self.raw_data()
+
+        with self.lock:
+            previous = self._interval.get(key)
+            self._interval[key] = (n, total, counts)
+
+        if previous is not None:
+            n -= previous[0]
+            total -= previous[1]
+            counts = [x - y for x, y in zip(counts, previous[2])]
+
+        # the observed minimum and maximum are not relative to the interval
+        return self.compute(n, total, min_, max_, counts)
+
+    def release_interval(self, key):
+        with self.lock:
+            self._interval.pop(key, None)
+
+
+def new_counter(name):
+    """
+    Build a new counter shared by all the processes
+    """
+
+    return metrics.new_metric(name, MultiProcessCounter, name)
+
+
+def new_gauge(name, mode="last"):
+    """
+    Build a new numeric gauge shared by all the processes, see MultiProcessGauge
+    """
+
+    return metrics.new_metric(name, MultiProcessGauge, name, mode)
+
+
+def new_meter(name, tick_interval=meter.DEFAULT_TICK_INTERVAL):
+    """
+    Build a new meter shared by all the processes
+    """
+
+    return metrics.new_metric(name, MultiProcessMeter, name, tick_interval)
+
+
+def new_histogram(name, buckets=DEFAULT_BUCKETS, percentiles=None):
+    """
+    Build a new bucketed histogram shared by all the processes
+    """
+
+    return metrics.new_metric(name, MultiProcessHistogram, name, buckets, percentiles)
@@ -0,0 +1,325 @@
+##  Module profiling.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+
+"""
+Sampling profiler for the functions timed by metrics.with_histogram(name, profile=<percentile>).
+
+The calls lasting longer than the given percentile of the histogram's values are sampled
+by a thread, which collects their stacks every SAMPLING_INTERVAL seconds: the other calls
+pay only for the registration. The stacks of the latest slow calls are kept in a bounded
+buffer for each metric, see profiles().
+"""
+
+import collections
+import sys
+import threading
+import time
+
+from . import statistics, exceptions
+
+
+# seconds between two stack samples of a slow call
+SAMPLING_INTERVAL = 0.005
+
+# slow calls kept for each metric
+DEFAULT_CAPACITY = 16
+
+# values needed in the histogram before profiling, so that the percentile is meaningful
+MIN_VALUES = 100
+
+# seconds the percentile is cached for
+THRESHOLD_TTL = 1.0
+
+# frames kept for each stack sample, the innermost ones
+MAX_DEPTH = 64
+
+# metric name: Profiler
+PROFILERS = {}
+LOCK = threading.Lock()
+
+# the thread sampling the slow calls, see get_sampler()
+SAMPLER = None
+
+try:
+    get_ident = threading.get_ident
+except AttributeError:
+    # python 2
+    get_ident = threading._get_ident
+
+
+def get_or_create_profiler(name, histogram, percentile, capacity=DEFAULT_CAPACITY):
+    """
+    Return the profiler of the named histogram, creating it if needed.
+    Raise DuplicateMetricError if the metric is already profiled at a different percentile
+    """
+
+    if not 0 < percentile <= 100:
+        raise exceptions.InvalidMetricError("Invalid percentile level: {}".format(percentile))
+
+    with LOCK:
+        profiler = PROFILERS.get(name)
+
+        # a new histogram with the same name restarts its profiles
+        if profiler is None or profiler.histogram is not histogram:
+            profiler = PROFILERS[name] = Profiler(histogram, percentile, capacity)
+        elif profiler.percentile != percentile:
+            raise exceptions.DuplicateMetricError(
+                "Metric {!r} is already profiled at the {}th percentile".format(name, profiler.percentile))
+
+    return profiler
+
+
+def profiled():
+    """
+    Return the names of the profiled metrics
+    """
+
+    return sorted(PROFILERS.keys())
+
+
+def profiles(name):
+    """
+    Return the profiles of the latest slow calls of the named metric, the latest first.
+    Raise InvalidMetricError if the metric is not profiled
+    """
+
+    try:
+        profiler = PROFILERS[name]
+    except KeyError:
+        raise exceptions.InvalidMetricError("Metric {!r} is not profiled".format(name))
+
+    return profiler.get()
+
+
+def remove(name):
+    """
+    Stop profiling the named metric, return its profiler if any
+    """
+
+    with LOCK:
+        return PROFILERS.pop(name, None)
+
+
+def get_sampler():
+    """
+    Return the thread sampling the slow calls, starting it if needed
+    """
+
+    global SAMPLER
+
+    sampler = SAMPLER
+    if sampler is not None and sampler.is_alive():
+        return sampler
+
+    with LOCK:
+        # the thread doesn't survive a fork()
+        if SAMPLER is None or not SAMPLER.is_alive():
+            SAMPLER = Sampler()
+            SAMPLER.start()
+
+    return SAMPLER
+
+
+class Call(object):
+    """
+    A running call of a profiled function, with its stack samples
+    """
+
+    __slots__ = ('thread_id', 'frame', 'start', 'deadline', 'samples')
+
+    def __init__(self, thread_id, frame, start, deadline):
+        """
+        "frame" is the frame of the wrapper calling the profiled function, the
+        samples are taken after "deadline"
+        """
+
+        self.thread_id = thread_id
+        self.frame = frame
+        self.start = start
+        self.deadline = deadline
+
+        # stack (tuple of (file name, line, function)): number of samples, created by the first sample
+        self.samples = None
+
+    def sample(self, frame):
+        """
+        Add the stack from the given frame (the thread's current one) up to the wrapper
+        """
+
+        stack = []
+        while frame is not None and frame is not self.frame:
+            if len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+
+        # the call is over
+        if frame is None:
+            return
+
+        if self.samples is None:
+            self.samples = collections.Counter()
+
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+
+
+class Profiler(object):
+    """
+    Keep the stack samples of the slowest calls of a function timed by a histogram
+    """
+
+    def __init__(self, histogram, percentile, capacity=DEFAULT_CAPACITY):
+        self.histogram = histogram
+        self.percentile = percentile
+
+        self.captures = collections.deque(maxlen=capacity)
+
+        # calls slower than this are sampled, None until the histogram has enough values
+        self.threshold = None
+        self._threshold_time = 0
+
+    def get_threshold(self, now):
+        """
+        Return the duration above which a call is sampled, recomputed every THRESHOLD_TTL seconds
+        (at each call while the histogram has less than MIN_VALUES values)
+        """
+
+        if self.threshold is None or now >= self._threshold_time:
+            values = self.histogram.reservoir.sorted_values
+            self.threshold = statistics.percentile(values, self.percentile) if len(values) >= MIN_VALUES else None
+            self._threshold_time = now + THRESHOLD_TTL
+
+        return self.threshold
+
+    def start(self):
+        """
+        Register a call starting in the caller's frame, return the Call to be passed
+        to finish() or None if the histogram hasn't enough values yet
+        """
+
+        now = time.time()
+
+        threshold = self.get_threshold(now)
+        if threshold is None:
+            return None
+
+        call = Call(get_ident(), sys._getframe(1), now, now + threshold)
+        get_sampler().add(call)
+
+        return call
+
+    def finish(self, call, elapsed):
+        """
+        Unregister the call, keeping its profile if it has been sampled
+        """
+
+        sampler = SAMPLER
+        if sampler is not None:
+            sampler.discard(call)
+
+        # the wrapper's frame holds the call
+        call.frame = None
+
+        samples = call.samples
+        if not samples:
+            return
+
+        stacks = [
+            dict(count=count, frames=["{} ({}:{})".format(name, file_name, line) for file_name, line, name in stack])
+            for stack, count in samples.most_common()]
+
+        self.captures.append(dict(
+            time=call.start, duration=elapsed, threshold=call.deadline - call.start,
+            samples=sum(samples.values()), stacks=stacks))
+
+    def get(self):
+        """
+        Return the captured profiles, the latest first
+        """
+
+        return list(reversed(self.captures))
+
+
+class Sampler(threading.Thread):
+    """
+    A thread sampling the stacks of the registered calls once they exceed their deadline.
+    It sleeps while there are no calls
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        super(Sampler, self).__init__(name="appmetrics-profiler")
+
+        self.daemon = True
+
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.calls = set()
+
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def add(self, call):
+        with self.lock:
+            idle = not self.calls
+            self.calls.add(call)
+
+        # otherwise the thread is already waiting for the earliest deadline (the
+        # new call's one is later, unless the threshold has just decreased)
+        if idle and not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def discard(self, call):
+        with self.lock:
+            self.calls.discard(call)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def sample(self, now):
+        """
+        Sample the calls past their deadline, return the time to wait for the next
+        sample (None if there are no calls)
+        """
+
+        frames = sys._current_frames()
+
+        with self.lock:
+            # cleared under the lock: a call added later wakes up the thread
+            self._wakeup.clear()
+
+            if not self.calls:
+                return None
+
+            sampled = False
+            deadline = None
+            for call in self.calls:
+                if now >= call.deadline:
+                    call.sample(frames.get(call.thread_id))
+                    sampled = True
+                elif deadline is None or call.deadline < deadline:
+                    deadline = call.deadline
+
+        if sampled:
+            return self.interval
+
+        return deadline - now
+
+    def run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.sample(time.time()))
@@ -0,0 +1,198 @@
+##  Module prometheus.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+"""
+Render the metrics in the Prometheus text exposition format
+
+Counters are exposed as gauges, since they can be decremented; meters as a
+"<name>_total" counter and a "<name>_rate" gauge with a "window" label for each
+rate; histograms as summaries (the percentiles are the quantiles, the count and
+the sum cover all the notified values), plus the "<name>_min" and "<name>_max" gauges.
+"""
+
+import logging
+import math
+import re
+import time
+
+from . import metrics, py3comp
+
+
+log = logging.getLogger("appmetrics.prometheus")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_TTL = 1.0
+
+INVALID_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+
+METER_RATES = (('mean', 'mean'), ('one', '1m'), ('five', '5m'), ('fifteen', '15m'), ('day', '1d'))
+
+
+def metric_name(name):
+    """
+    Return a valid Prometheus metric name for the given name
+    """
+
+    name = INVALID_CHARS.sub("_", name)
+    if not name or name[0].isdigit():
+        name = "_" + name
+
+    return name
+
+
+def format_value(value):
+    """
+    Return the Prometheus representation of the given value, None if it's not a number
+    """
+
+    if isinstance(value, bool) or isinstance(value, py3comp.integer_types):
+        return str(int(value))
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(value)
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def family(name, type_, help_, samples):
+    """
+    Return the text of a metric family, given its samples as (suffix, labels, value).
+    Samples without a numeric value are skipped
+    """
+
+    lines = ["# HELP {} {}".format(name, escape(help_)), "# TYPE {} {}".format(name, type_)]
+
+    for suffix, labels, value in samples:
+        value = format_value(value)
+        if value is None:
+            continue
+
+        if labels:
+            labels = "{{{}}}".format(",".join('{}="{}"'.format(k, v) for k, v in labels))
+        lines.append("{}{}{} {}".format(name, suffix, labels or "", value))
+
+    if len(lines) == 2:
+        return ""
+
+    return "\n".join(lines) + "\n"
+
+
+def render_metric(name, obj, totals=None):
+    """
+    Return the text of the given metric's values, as returned by its get() method.
+    "totals" is the histograms' cumulative (count, sum), if available
+    """
+
+    kind = obj.get('kind')
+    prom_name = metric_name(name)
+    help_ = "appmetrics {} {}".format(kind, name)
+
+    if kind in ("counter", "gauge"):
+        return family(prom_name, "gauge", help_, [("", None, obj.get('value'))])
+
+    elif kind == "meter":
+        return (
+            family(prom_name + "_total", "counter", help_, [("", None, obj.get('count'))]) +
+            family(prom_name + "_rate", "gauge", help_, [
+                ("", [("window", window)], obj[field]) for field, window in METER_RATES if field in obj]))
+
+    elif kind == "histogram":
+        samples = [("", [("quantile", "{:.12g}".format(p / 100.0))], v) for p, v in obj.get('percentile', [])]
+        if totals is not None:
+            count, sum_ = totals
+        else:
+            count = obj.get('n', 0)
+            sum_ = obj['arithmetic_mean'] * count if 'arithmetic_mean' in obj else None
+        if sum_ is not None:
+            samples.append(("_sum", None, sum_))
+        samples.append(("_count", None, count))
+
+        res = family(prom_name, "summary", help_, samples)
+        for field in ('min', 'max'):
+            if field in obj:
+                res += family("{}_{}".format(prom_name, field), "gauge", help_, [("", None, obj[field])])
+
+        return res
+
+    return ""
+
+
+def render(items):
+    """
+    Yield the text of the given (name, metric) items, sorted by name.
+    The metrics whose name clashes with a previous one are skipped
+    """
+
+    seen = set()
+    for name, metric in sorted(items, key=lambda x: x[0]):
+        prom_name = metric_name(name)
+        if prom_name in seen:
+            log.debug("Skipping %s: duplicated Prometheus name %s", name, prom_name)
+            continue
+        seen.add(prom_name)
+
+        try:
+            totals = metric.totals() if hasattr(metric, 'totals') else None
+            text = render_metric(name, metric.get(), totals)
+        except Exception as e:
+            log.debug("Cannot render %s: %s", name, e, exc_info=True)
+            continue
+
+        if text:
+            yield text
+
+
+class Renderer(object):
+    """
+    Render the whole registry, caching the result for "ttl" seconds.
+    Calling the renderer returns an iterable of text chunks, to be streamed
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+        # (time, chunks)
+        self._cache = None
+
+    def __call__(self):
+        now = time.time()
+
+        cached = self._cache
+        if cached is not None and now - cached[0] < self.ttl:
+            return iter(cached[1])
+
+        return self.render(now)
+
+    def render(self, now):
+        chunks = []
+        for chunk in render(list(py3comp.iteritems(metrics.REGISTRY))):
+            chunks.append(chunk)
+            yield chunk
+
+        if self.ttl:
+            self._cache = (now, chunks)
@@ -19,13 +19,20 @@ Python 3 compatibility
 """
 
 import sys
-import json
+
+from .lazy import LazyModule
 
 PY3 = sys.version_info[0] == 3
 
 if PY3:
+    queue = LazyModule("queue")
+    socketserver = LazyModule("socketserver")
+
     xrange = range
 
+    integer_types = (int,)
+    string_types = (str,)
+
     def iteritems(d, **kw):
         return d.items(**kw)
 
@@ -33,8 +40,14 @@ if PY3:
 
     zip = lambda *args: list(__builtin_zip(*args))
 else:
+    queue = LazyModule("Queue")
+    socketserver = LazyModule("SocketServer")
+
     xrange = xrange
 
+    integer_types = (int, long)
+    string_types = (basestring,)
+
     def iteritems(d, **kw):
         return d.iteritems(**kw)
 
@@ -51,6 +64,8 @@ def assert_items_equal(*args):
 
 
 def json_load(stream, charset):
+    import json
+
     # thanks very much, python 3...
     if PY3:
         raw_data = stream.read()
@@ -20,14 +20,32 @@ Reporting facilities
 
 
 import os
-import csv
+import errno
 import logging
-import uuid
 import threading
 import time
 import atexit
-
-from . import metrics, py3comp
+import heapq
+import itertools
+import collections
+import weakref
+import struct
+import sys
+import re
+import math
+
+from . import metrics, histogram, py3comp, selfmetrics
+from .lazy import LazyModule
+
+# only needed by some reporters, imported on first use
+csv = LazyModule("csv")
+uuid = LazyModule("uuid")
+shutil = LazyModule("shutil")
+mmap = LazyModule("mmap")
+array = LazyModule("array")
+socket = LazyModule("socket")
+pickle = LazyModule("pickle")
+select = LazyModule("select")
 
 
 log = logging.getLogger('appmetrics.reporter')
@@ -36,11 +54,38 @@ log = logging.getLogger('appmetrics.reporter')
 REGISTRY = {}
 LOCK = threading.Lock()
 
+# the thread running all the registered callbacks, see get_scheduler()
+SCHEDULER = None
+
+# FileReporter defaults
+DEFAULT_FILE_BUFFER_SIZE = 64 * 1024
+# used when the process' limit of open files is unknown, see default_max_open_files()
+DEFAULT_MAX_OPEN_FILES = 512
+
+# StatsDReporter default: fits into the usual network MTU, without fragmentation
+DEFAULT_STATSD_MTU = 1432
+
+# GraphiteReporter defaults
+DEFAULT_GRAPHITE_TIMEOUT = 1.0
+DEFAULT_GRAPHITE_MAX_QUEUED = 100
+
+# the thread compressing the rotated csv files, see get_compressor()
+COMPRESSOR = None
+
+# open FileReporters, to be closed at exit
+FILE_REPORTERS = weakref.WeakSet()
+
+# snapshots computed less than SNAPSHOT_RESOLUTION seconds before are shared
+# between the callbacks with the same tag
+SNAPSHOT_RESOLUTION = 0.1
+
 
-def register(callback, schedule, tag=None):
+def register(callback, schedule, tag=None, interval=False):
     """
     Register a callback which will be called at scheduled intervals with
     the metrics that have the given tag (or all the metrics if None).
+    If "interval" is True, the callback gets the values recorded since its
+    previous call instead of the cumulative ones (see metrics.get_interval()).
     Return an identifier which can be used to access the registered callback later.
     """
 
@@ -52,13 +97,49 @@ def register(callback, schedule, tag=None):
     if not callable(callback):
         raise TypeError("{} is not callable".format(callback))
 
-    thread = Timer(schedule, callback, tag)
+    id_ = str(uuid.uuid4())
+
+    timer = Timer(schedule, callback, tag, id_ if interval else None)
+
+    with LOCK:
+        REGISTRY[id_] = timer
+
+    get_scheduler().add(timer)
+
+    return id_
+
+
+def register_async(callback, schedule, tag=None, interval=False, loop=None):
+    """
+    Register a coroutine function which will be called on the asyncio event loop
+    at scheduled intervals with the metrics that have the given tag (or all the
+    metrics if None). The metrics are computed in the loop's default executor,
+    so that the loop is never blocked. See register() for the other parameters.
+    If "loop" is None, the current event loop is used.
+    Return an identifier which can be used to access the registered callback later.
+    """
+
+    import asyncio
+
+    try:
+        iter(schedule)
+    except TypeError:
+        raise TypeError("{} is not iterable".format(schedule))
+
+    if not callable(callback):
+        raise TypeError("{} is not callable".format(callback))
+
+    if loop is None:
+        loop = asyncio.get_event_loop()
 
     id_ = str(uuid.uuid4())
+
+    timer = AsyncTimer(schedule, callback, tag, id_ if interval else None, loop)
+
     with LOCK:
-        REGISTRY[id_] = thread
+        REGISTRY[id_] = timer
 
-    thread.start()
+    timer.start()
 
     return id_
 
@@ -75,56 +156,69 @@ def remove(id_):
     Remove the callback and its schedule
     """
     with LOCK:
-        thread = REGISTRY.pop(id_, None)
-        if thread is not None:
-            thread.cancel()
+        timer = REGISTRY.pop(id_, None)
+        if timer is not None:
+            timer.cancel()
+            if SCHEDULER is not None:
+                SCHEDULER.snapshots.discard(timer.tag)
+
+    if timer is not None and timer.interval_key is not None:
+        metrics.release_interval(timer.interval_key)
 
-    return thread
+    return timer
 
 
-class Timer(threading.Thread):
+def get_scheduler():
+    """
+    Return the scheduler running the registered callbacks, starting it if needed
+    """
+
+    global SCHEDULER
+
+    with LOCK:
+        if SCHEDULER is None or not SCHEDULER.is_alive():
+            # the thread doesn't survive a fork(): take over the pending timers
+            pending = SCHEDULER.pending() if SCHEDULER is not None else []
+
+            SCHEDULER = Scheduler(pending)
+            SCHEDULER.start()
+
+    return SCHEDULER
+
+
+class Timer(object):
     """
     Encapsulate a callback and its parameters
     """
 
-    def __init__(self, schedule, callback, tag=None):
+    def __init__(self, schedule, callback, tag=None, interval_key=None):
         """
         "schedule" must be an iterator yielding the next "tick" at each iteration
+        If "interval_key" is not None, the callback gets interval values
         """
-        super(Timer, self).__init__()
 
-        self.schedule = schedule
+        self.schedule = iter(schedule)
         self.callback = callback
         self.tag = tag
+        self.interval_key = interval_key
+        self.scheduler = None
         self._event = threading.Event()
-        self.daemon = True
 
-    def run(self):
-        while not self._event.is_set():
-            now = time.time()
-            # skip already passed ticks
+    def next_tick(self, now):
+        """
+        Return the first scheduled time after "now", skipping the already passed ticks,
+        or None if the schedule is over. A schedule raising an error is over too, so that
+        it doesn't stop the other timers
+        """
+
+        try:
             for next_time in self.schedule:
                 if next_time > now:
-                    break
-            # the iterator was consumed, exit
-            else:
-                break
-
-            # sleep for the remaining time
-            time.sleep(next_time - now)
-
-            # the event may have been set while sleeping
-            if not self._event.is_set():
-                data = get_metrics(self.tag)
-
-                if not data:
-                    log.debug("No metrics found for tag: {}".format(self.tag))
-                else:
-                    # call the function, finally
-                    self.callback(data)
+                    return next_time
+        except Exception as e:
+            log.exception("Error in the schedule of reporter callback %r: %s", self.callback, e)
 
-        # set the event, for consistency
-        self.cancel()
+        return None
 
     def cancel(self):
         """
@@ -132,19 +226,383 @@ class Timer(threading.Thread):
         """
         self._event.set()
 
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.wakeup()
+
     @property
     def is_running(self):
         return not self._event.is_set()
 
 
-def get_metrics(tag):
+class AsyncTimer(Timer):
+    """
+    A timer driven by an asyncio event loop, calling a coroutine function
+    """
+
+    def __init__(self, schedule, callback, tag=None, interval_key=None, loop=None):
+        super(AsyncTimer, self).__init__(schedule, callback, tag, interval_key)
+
+        self.loop = loop
+
+        # the pending call_later() handle or callback task, if any
+        self._handle = None
+        self._task = None
+
+        # scheduled time of the pending tick and start time of the callback task,
+        # for the self-instrumentation
+        self._due = None
+        self._started = None
+
+    def start(self):
+        """
+        Schedule the first tick, it may be called from any thread
+        """
+
+        self.loop.call_soon_threadsafe(self._schedule_next)
+
+    def _schedule_next(self):
+        self._task = None
+
+        if not self.is_running:
+            return
+
+        now = time.time()
+        next_time = self.next_tick(now)
+        if next_time is None:
+            # the schedule was consumed
+            self.cancel()
+            return
+
+        self._due = next_time
+        self._handle = self.loop.call_later(next_time - now, self._fire)
+
+    def _fire(self):
+        self._handle = None
+
+        if not self.is_running:
+            return
+
+        if selfmetrics.ENABLED:
+            selfmetrics.record(selfmetrics.REPORTER_LAG, max(0.0, time.time() - self._due))
+
+        if self.interval_key is None:
+            future = self.loop.run_in_executor(None, SNAPSHOTS.get, self.tag)
+        else:
+            future = self.loop.run_in_executor(None, get_metrics, self.tag, self.interval_key)
+
+        future.add_done_callback(self._on_snapshot)
+
+    def _on_snapshot(self, future):
+        import asyncio
+
+        if not self.is_running:
+            return
+
+        try:
+            data = future.result()
+        except Exception as e:
+            log.exception("Error getting metrics for tag %r: %s", self.tag, e)
+            data = None
+
+        if not data:
+            log.debug("No metrics found for tag: {}".format(self.tag))
+            self._schedule_next()
+            return
+
+        self._started = None
+        if selfmetrics.ENABLED:
+            selfmetrics.record(selfmetrics.SNAPSHOT_SIZE, len(data))
+            self._started = time.time()
+
+        try:
+            self._task = asyncio.ensure_future(self.callback(data), loop=self.loop)
+        except Exception as e:
+            log.exception("Error in reporter callback %r: %s", self.callback, e)
+            self._schedule_next()
+        else:
+            self._task.add_done_callback(self._on_done)
+
+    def _on_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Error in reporter callback %r: %s", self.callback, task.exception())
+
+        if self._started is not None:
+            selfmetrics.record(selfmetrics.REPORTER_CALLBACK, time.time() - self._started)
+
+        self._schedule_next()
+
+    def cancel(self):
+        """
+        Cancel the timer and its pending call, if any. It may be called from any thread
+        """
+
+        super(AsyncTimer, self).cancel()
+
+        try:
+            self.loop.call_soon_threadsafe(self._cancel_pending)
+        except RuntimeError:
+            # the loop has been closed
+            pass
+
+    def _cancel_pending(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self._task is not None:
+            self._task.cancel()
+
+
+class Scheduler(threading.Thread):
+    """
+    A thread running all the registered timers: the next due times are kept
+    in a heap and the thread waits on an event until the earliest one, so that
+    it can be woken up as soon as a timer is added or cancelled.
+    """
+
+    def __init__(self, pending=(), snapshots=None):
+        """
+        "pending" is an iterable of (due time, timer) to be scheduled
+        "snapshots" is the SnapshotCoordinator providing the metrics, defaults to SNAPSHOTS
+        """
+        super(Scheduler, self).__init__(name="appmetrics-reporter")
+
+        self.daemon = True
+
+        self.snapshots = SNAPSHOTS if snapshots is None else snapshots
+
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        # (due time, insertion order, timer): the counter breaks ties between
+        # timers with the same due time
+        self._heap = []
+        for next_time, timer in pending:
+            timer.scheduler = self
+            self._heap.append((next_time, next(self._counter), timer))
+        heapq.heapify(self._heap)
+
+    def add(self, timer, now=None):
+        """
+        Schedule the given timer for its next tick
+        """
+
+        next_time = timer.next_tick(time.time() if now is None else now)
+        if next_time is None:
+            # the schedule was consumed
+            timer.cancel()
+            return
+
+        timer.scheduler = self
+
+        with self._lock:
+            heapq.heappush(self._heap, (next_time, next(self._counter), timer))
+
+        self.wakeup()
+
+    def pending(self):
+        """
+        Return the (due time, timer) pairs for the scheduled timers
+        """
+
+        return [(next_time, timer) for next_time, _, timer in list(self._heap) if timer.is_running]
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def stop(self):
+        """
+        Stop the scheduler: pending timers won't be run anymore
+        """
+
+        self._stopped = True
+        self.wakeup()
+
+    def pop_due(self, now):
+        """
+        Remove and return the timers due at "now", discarding the cancelled ones.
+        Return the due timers and the time to wait for the next one (None if
+        there are no timers left)
+        """
+
+        due = []
+        lags = []
+        delay = None
+
+        with self._lock:
+            while self._heap:
+                next_time, _, timer = self._heap[0]
+
+                if not timer.is_running:
+                    heapq.heappop(self._heap)
+                elif next_time <= now:
+                    heapq.heappop(self._heap)
+                    due.append(timer)
+                    lags.append(now - next_time)
+                else:
+                    delay = next_time - now
+                    break
+
+        if selfmetrics.ENABLED:
+            for lag in lags:
+                selfmetrics.record(selfmetrics.REPORTER_LAG, lag)
+
+        return due, delay
+
+    def run_pending(self, now):
+        """
+        Run the timers due at "now" and reschedule them.
+        Return the time to wait for the next timer (None if there are no timers left)
+        """
+
+        due, delay = self.pop_due(now)
+
+        if not due:
+            return delay
+
+        self.run_timers(due, now)
+
+        for timer in due:
+            if timer.is_running:
+                self.add(timer, now)
+
+        # some time passed while running the callbacks, check again
+        return 0
+
+    def run_timers(self, timers, now):
+        """
+        Call the given timers' callbacks: the timers with the same tag share
+        the metrics snapshot
+        """
+
+        for timer in timers:
+            if timer.interval_key is None:
+                data = self.snapshots.get(timer.tag, now)
+            else:
+                data = get_metrics(timer.tag, timer.interval_key)
+
+            # the timer may have been cancelled in the meanwhile
+            if not timer.is_running:
+                continue
+
+            if not data:
+                log.debug("No metrics found for tag: {}".format(timer.tag))
+                continue
+
+            t1 = None
+            if selfmetrics.ENABLED:
+                selfmetrics.record(selfmetrics.SNAPSHOT_SIZE, len(data))
+                t1 = time.time()
+
+            try:
+                # call the function, finally
+                timer.callback(data)
+            except Exception as e:
+                log.exception("Error in reporter callback %r: %s", timer.callback, e)
+
+            if t1 is not None:
+                selfmetrics.record(selfmetrics.REPORTER_CALLBACK, time.time() - t1)
+
+    def run(self):
+        while not self._stopped:
+            # clear the event before looking at the heap: a timer added in the
+            # meanwhile will wake up the thread immediately
+            self._wakeup.clear()
+
+            delay = self.run_pending(time.time())
+
+            if delay is None or delay > 0:
+                self._wakeup.wait(delay)
+
+
+def get_metrics(tag, interval_key=None):
     """
     Return the values for the metrics with the given tag or all the available metrics if None
+    If "interval_key" is not None, return the values relative to the previous call with the same key
     """
     if tag is None:
-        return metrics.metrics_by_name_list(metrics.metrics())
+        return metrics.metrics_by_name_list(metrics.metrics(), interval_key)
     else:
-        return metrics.metrics_by_tag(tag)
+        return metrics.metrics_by_tag(tag, interval_key)
+
+
+class ReadOnlyDict(dict):
+    """
+    A dictionary which can't be modified, use copy() to get a mutable one
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("{} object is read-only".format(type(self).__name__))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # make copy and pickle work without calling __setitem__
+        return type(self), (dict(self),)
+
+
+class SnapshotCoordinator(object):
+    """
+    Compute the metrics snapshot once per (tag, tick) and share it between all
+    the callbacks due at that tick. The snapshots are read-only, since they are
+    handed to several callbacks.
+    """
+
+    def __init__(self, resolution=None):
+        """
+        "resolution" is the time in seconds during which a snapshot is reused,
+        it defaults to SNAPSHOT_RESOLUTION
+        """
+
+        self.resolution = SNAPSHOT_RESOLUTION if resolution is None else resolution
+        self.lock = threading.Lock()
+
+        # tag: (computation time, snapshot)
+        self._snapshots = {}
+
+    def get(self, tag, now=None):
+        """
+        Return the snapshot of the metrics with the given tag at the "now" tick
+        """
+
+        if now is None:
+            now = time.time()
+
+        cached = self._snapshots.get(tag)
+        if cached is not None and 0 <= now - cached[0] < self.resolution:
+            return cached[1]
+
+        # compute the snapshot only once even if several threads ask for it
+        with self.lock:
+            cached = self._snapshots.get(tag)
+            if cached is not None and 0 <= now - cached[0] < self.resolution:
+                return cached[1]
+
+            data = get_metrics(tag)
+            snapshot = ReadOnlyDict((k, ReadOnlyDict(v)) for k, v in py3comp.iteritems(data))
+
+            # the snapshots of the other tags are not kept past their resolution
+            for key, (computed_on, _) in list(self._snapshots.items()):
+                if not 0 <= now - computed_on < self.resolution:
+                    del self._snapshots[key]
+
+            self._snapshots[tag] = (now, snapshot)
+
+        return snapshot
+
+    def discard(self, tag):
+        """
+        Drop the snapshot of the given tag, if any
+        """
+
+        with self.lock:
+            self._snapshots.pop(tag, None)
+
+
+SNAPSHOTS = SnapshotCoordinator()
 
 
 def fixed_interval_scheduler(interval):
@@ -159,7 +617,230 @@ def fixed_interval_scheduler(interval):
         yield next_tick
 
 
-class CSVReporter(object):
+def default_max_open_files():
+    """
+    Return half of the soft limit of open files of the process (0 if unlimited),
+    leaving the rest to the application
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return DEFAULT_MAX_OPEN_FILES
+
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 0
+
+    return max(soft // 2, 1)
+
+
+class FileReporter(object):
+    """
+    Base class for the reporter callbacks writing the metrics to files, one file
+    for each metric. Subclass and override open_file() and define a
+    dump_<kind>(name, obj) method for each supported metric kind.
+
+    The files are kept open and written through a buffer: the buffers are flushed
+    when they are full and at the end of a report if more than "flush_interval"
+    seconds passed since the latest flush (0 to flush at each report).
+    At most "max_open_files" files are kept open (by default half of the process'
+    limit, 0 for no limit): when the limit is reached the most recently used file
+    gets closed, since the reports write the files always in the same order and
+    closing the least recently used one would reopen every file at each report.
+
+    Files can be rotated when they get bigger than "max_bytes" bytes or older than
+    "rotate_interval" seconds (since their first row was written): the rotated files get a
+    timestamp suffix, and they are compressed (if "compression" is one of
+    COMPRESSORS' keys) by a background thread. Only the latest "backup_count" rotated
+    files are kept, if given.
+    """
+
+    extension = None
+
+    def __init__(self, directory, flush_interval=0, buffer_size=DEFAULT_FILE_BUFFER_SIZE,
+                 max_open_files=None, max_bytes=None, rotate_interval=None,
+                 compression=None, compress_level=9, backup_count=None):
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError("Unknown compression: {}".format(compression))
+
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_open_files = default_max_open_files() if max_open_files is None else max_open_files
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compression = compression
+        self.compress_level = compress_level
+        self.backup_count = backup_count
+
+        self.lock = threading.Lock()
+        self.latest_flush = time.time()
+
+        # file name: (file object, writer), in usage order
+        self._files = collections.OrderedDict()
+
+        # file name: start time of the current segment, kept apart from the open files
+        # since the files get closed and reopened when there are more than max_open_files
+        self._segments = {}
+
+        FILE_REPORTERS.add(self)
+
+    def file_name(self, name, kind):
+        return os.path.join(self.directory, "{}_{}.{}".format(name, kind, self.extension))
+
+    def open_file(self, file_name, header):
+        """
+        Open the given file for appending and return (file object, writer): the
+        writer must have a writerow(dict) method. Override in subclasses
+        """
+
+        raise NotImplementedError()
+
+    def get_writer(self, file_name, header):
+        """
+        Return the writer for the given file, opening the file if needed
+        """
+
+        try:
+            item = self._files.pop(file_name)
+        except KeyError:
+            while self.max_open_files and len(self._files) >= self.max_open_files:
+                self._files.popitem()[1][0].close()
+
+            # _flush() checks the size of the open files only
+            if self.max_bytes and os.path.exists(file_name) and self.must_rotate(file_name, None, time.time()):
+                self.rotate(file_name)
+
+            item = self.open_file(file_name, header)
+            if self.rotate_interval:
+                self._segments.setdefault(file_name, time.time())
+
+        self._files[file_name] = item
+
+        return item[1]
+
+    def must_rotate(self, file_name, of, now):
+        """
+        Return True if the given file must be rotated; "of" is the (flushed) file
+        object if the file is open, None otherwise
+        """
+
+        opened_on = self._segments.get(file_name)
+        if self.rotate_interval and opened_on is not None and now - opened_on >= self.rotate_interval:
+            return True
+
+        if not self.max_bytes:
+            return False
+
+        size = os.fstat(of.fileno()).st_size if of is not None else os.path.getsize(file_name)
+        return size >= self.max_bytes
+
+    def rotate(self, file_name):
+        """
+        Close the given file if open, rename it and hand it to the background compressor
+        """
+
+        item = self._files.pop(file_name, None)
+        if item is not None:
+            item[0].close()
+        self._segments.pop(file_name, None)
+
+        rotated = "{}.{}".format(file_name, time.strftime("%Y%m%d-%H%M%S"))
+        target, i = rotated, 0
+        while any(os.path.exists(target + ext) for ext in ROTATED_EXTENSIONS):
+            i += 1
+            target = "{}.{}".format(rotated, i)
+
+        os.rename(file_name, target)
+
+        get_compressor().submit(target, file_name, self.compression, self.compress_level, self.backup_count)
+
+        return target
+
+    def flush(self):
+        """
+        Flush the buffered rows to the files
+        """
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not (self.max_bytes or self.rotate_interval):
+            for of, _ in self._files.values():
+                of.flush()
+            return
+
+        now = time.time()
+        for file_name, (of, _) in list(self._files.items()):
+            of.flush()
+
+            if self.must_rotate(file_name, of, now):
+                self.rotate(file_name)
+
+        # the closed files expire as well, get_writer() checks their size when reopened
+        for file_name, opened_on in list(self._segments.items()):
+            if file_name not in self._files and now - opened_on >= self.rotate_interval:
+                if os.path.exists(file_name):
+                    self.rotate(file_name)
+                else:
+                    del self._segments[file_name]
+
+    def close(self):
+        """
+        Flush and close all the open files
+        """
+
+        with self.lock:
+            while self._files:
+                self._files.popitem()[1][0].close()
+
+    def __call__(self, objects):
+        with self.lock:
+            for name, obj in py3comp.iteritems(objects):
+                fun = getattr(self, "dump_%s" % obj.get('kind', "unknown"), None)
+                if fun:
+                    # protect the original object; a failing metric doesn't stop the others
+                    try:
+                        fun(name, obj.copy())
+                    except Exception as e:
+                        log.exception("Error writing metric %r: %s", name, e)
+
+            if not self.flush_interval:
+                self._flush()
+            else:
+                now = time.time()
+                if now - self.latest_flush >= self.flush_interval:
+                    self._flush()
+                    self.latest_flush = now
+
+
+def flatten_histogram(obj):
+    """
+    Prepare the given histogram values for a tabular format, in place
+    """
+
+    # histogram doesn't fit into a tabular format
+    obj.pop('histogram', None)
+
+    # flatten percentiles
+    percentiles = obj.pop('percentile', [])
+    for k, v in percentiles:
+        obj['percentile_{}'.format(k)] = v
+
+    return [k for k, _ in percentiles]
+
+
+class CSVReporter(FileReporter):
+    """
+    A reporter callback writing the metrics to csv files, a row for each report.
+    When the columns of a metric change (e.g. new percentiles) its file is rotated.
+    See FileReporter for the parameters.
+    """
+
+    extension = "csv"
+
     histogram_header = (
         'time', 'n', 'min', 'max', 'arithmetic_mean', 'median', 'harmonic_mean', 'geometric_mean',
         'standard_deviation', 'variance', 'percentile_50', 'percentile_75', 'percentile_90',
@@ -167,45 +848,56 @@ class CSVReporter(object):
 
     meter_header = ('time', 'count', 'mean', 'one', 'five', 'fifteen', 'day')
 
-    def __init__(self, directory):
-        self.directory = directory
+    def open_file(self, file_name, header):
+        mode = "a" if py3comp.PY3 else "ab"
+        of = open(file_name, mode, self.buffer_size)
 
-    def file_name(self, name, kind):
-        file_name = os.path.join(self.directory, "{}_{}.csv".format(name, kind))
+        if os.fstat(of.fileno()).st_size:
+            with open(file_name, "r" if py3comp.PY3 else "rb") as inf:
+                existing = next(csv.reader(inf), [])
 
-        if not os.path.exists(file_name):
-            new = True
-        else:
-            new = False
+            if existing != list(header):
+                log.warning("%s: columns changed from %s to %s, rotating the file", file_name, existing, list(header))
+                of.close()
+                self.rotate(file_name)
+                of = open(file_name, mode, self.buffer_size)
 
-        return file_name, new
+        writer = csv.DictWriter(of, header, restval='')
 
-    def dump_histogram(self, name, obj):
+        # if the file is new, write the header once
+        if not os.fstat(of.fileno()).st_size:
+            writer.writerow(dict(zip(header, header)))
+
+        return of, writer
+
+    def get_writer(self, file_name, header):
+        writer = super(CSVReporter, self).get_writer(file_name, header)
+
+        # the columns changed while the file was open: reopening it rotates it
+        if list(writer.fieldnames) != list(header):
+            self._files.pop(file_name)[0].close()
+            writer = super(CSVReporter, self).get_writer(file_name, header)
 
-        # histogram doesn't fit into a tabular format
-        obj.pop('histogram')
+        return writer
+
+    def dump_histogram(self, name, obj):
 
         # we already know its kind
         kind = obj.pop('kind')
 
-        # flatten percentiles
-        percentiles = obj.pop('percentile')
-        for k, v in percentiles:
-            obj['percentile_{}'.format(k)] = v
+        flatten_histogram(obj)
 
         # add the current time
         obj['time'] = time.time()
 
-        file_name, new = self.file_name(name, kind)
-
-        with open(file_name, "a" if py3comp.PY3 else "ab") as of:
-            writer = csv.DictWriter(of, self.histogram_header)
+        # histograms with custom percentiles get their own columns
+        header = self.histogram_header
+        extra = set(obj).difference(header)
+        if extra:
+            header += tuple(sorted(extra))
 
-            # if the file is new, write the header once
-            if new:
-                writer.writerow(dict(zip(self.histogram_header, self.histogram_header)))
-
-            writer.writerow(obj)
+        file_name = self.file_name(name, kind)
+        self.get_writer(file_name, header).writerow(obj)
 
         return file_name
 
@@ -217,28 +909,693 @@ class CSVReporter(object):
         # add the current time
         obj['time'] = time.time()
 
-        file_name, new = self.file_name(name, kind)
+        file_name = self.file_name(name, kind)
+        self.get_writer(file_name, self.meter_header).writerow(obj)
+
+        return file_name
+
+
+class BinaryReporter(FileReporter):
+    """
+    A reporter callback appending the metrics to binary files, which are much
+    faster to write and to read back than csv files. Each file starts with a
+    header describing the columns, followed by a fixed-width record of float64
+    values for each report: use ColumnReader to read the columns back.
+    When the columns of a metric change (e.g. new percentiles) its file is rotated.
+    Histograms, meters, counters and numeric gauges are supported.
+    See FileReporter for the parameters.
+    """
+
+    extension = "bin"
 
-        with open(file_name, "a" if py3comp.PY3 else "ab") as of:
-            writer = csv.DictWriter(of, self.meter_header)
+    meter_columns = ('time', 'count', 'mean', 'one', 'five', 'fifteen', 'day')
+    value_columns = ('time', 'value')
 
-            # if the file is new, write the header once
-            if new:
-                writer.writerow(dict(zip(self.meter_header, self.meter_header)))
+    def open_file(self, file_name, header):
+        of = open(file_name, "ab", self.buffer_size)
 
-            writer.writerow(obj)
+        if os.fstat(of.fileno()).st_size:
+            with open(file_name, "rb") as inf:
+                existing = read_column_header(inf)[0]
+
+            if existing != list(header):
+                log.warning("%s: columns changed from %s to %s, rotating the file", file_name, existing, list(header))
+                of.close()
+                self.rotate(file_name)
+                of = open(file_name, "ab", self.buffer_size)
+
+        if not os.fstat(of.fileno()).st_size:
+            of.write(pack_column_header(header))
+
+        return of, RecordWriter(of, header)
+
+    def dump(self, name, kind, columns, obj):
+        obj['time'] = time.time()
+
+        file_name = self.file_name(name, kind)
+        self.get_writer(file_name, columns).writerow(obj)
 
         return file_name
 
+    def dump_histogram(self, name, obj):
+        kind = obj.pop('kind')
+        levels = flatten_histogram(obj)
+
+        columns = ('time', 'n') + tuple(x for x in histogram.HISTOGRAM_FIELDS if x in obj)
+        columns += tuple('percentile_{}'.format(x) for x in levels)
+
+        return self.dump(name, kind, columns, obj)
+
+    def dump_meter(self, name, obj):
+        return self.dump(name, obj.pop('kind'), self.meter_columns, obj)
+
+    def dump_counter(self, name, obj):
+        return self.dump(name, obj.pop('kind'), self.value_columns, obj)
+
+    def dump_gauge(self, name, obj):
+        # gauges may have any value
+        try:
+            float(obj['value'])
+        except (TypeError, ValueError):
+            return None
+
+        return self.dump(name, obj.pop('kind'), self.value_columns, obj)
+
+
+COLUMN_FILE_MAGIC = b"AMCOLS01"
+
+# magic, byte order of the records, header size, number of columns
+COLUMN_FILE_PREAMBLE = struct.Struct("<8s4sII")
+
+COLUMN_FILE_BYTE_ORDERS = dict(little=b"LE\0\0", big=b"BE\0\0")
+
+
+def pack_column_header(columns):
+    """
+    Return the header of a column file with the given column names.
+    The header size is a multiple of 8 bytes, so that the records are aligned
+    """
+
+    names = "\n".join(columns).encode("utf8")
+    size = COLUMN_FILE_PREAMBLE.size + len(names)
+    padding = -size % 8
+
+    return COLUMN_FILE_PREAMBLE.pack(
+        COLUMN_FILE_MAGIC, COLUMN_FILE_BYTE_ORDERS[sys.byteorder], size + padding, len(columns)) + names + b"\0" * padding
+
+
+def read_column_header(stream):
+    """
+    Read the header of a column file from the given binary stream.
+    Return (column names, header size, byte order)
+    """
+
+    preamble = stream.read(COLUMN_FILE_PREAMBLE.size)
+    if len(preamble) < COLUMN_FILE_PREAMBLE.size:
+        raise ValueError("Truncated column file header")
+
+    magic, byteorder, size, count = COLUMN_FILE_PREAMBLE.unpack(preamble)
+    if magic != COLUMN_FILE_MAGIC:
+        raise ValueError("Not a column file")
+
+    names = stream.read(size - COLUMN_FILE_PREAMBLE.size).rstrip(b"\0").decode("utf8")
+    columns = names.split("\n") if count else []
+
+    if len(columns) != count:
+        raise ValueError("Corrupted column file header")
+
+    for name, marker in py3comp.iteritems(COLUMN_FILE_BYTE_ORDERS):
+        if marker == byteorder:
+            return columns, size, name
+
+    raise ValueError("Corrupted column file header")
+
+
+class RecordWriter(object):
+    """
+    Write dictionaries as fixed-width records of float64 values, in the machine's byte order.
+    Missing values are written as NaN.
+    """
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = tuple(columns)
+        self.record = struct.Struct("={}d".format(len(self.columns)))
+
+    def writerow(self, obj):
+        nan = float("nan")
+        self.stream.write(self.record.pack(*[float(obj.get(x, nan)) for x in self.columns]))
+
+
+class ColumnReader(object):
+    """
+    Read the files written by BinaryReporter: the file is memory-mapped and
+    each column is returned as a read-only memoryview of float64 values
+    (on python 3; an array.array on python 2), without any parsing.
+    A partially written trailing record is ignored.
+    Use it as a context manager or call close() when done.
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as inf:
+            self.columns, header_size, byteorder = read_column_header(inf)
+            self.mmap = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if byteorder != sys.byteorder:
+            self.mmap.close()
+            raise ValueError("The file was written on a {}-endian machine".format(byteorder))
+
+        record_size = 8 * len(self.columns)
+        size = len(self.mmap) - header_size
+        self.rows = size // record_size if record_size else 0
+
+        end = header_size + self.rows * record_size
+        if py3comp.PY3:
+            self._data = memoryview(self.mmap)[header_size:end].cast("d")
+        else:
+            # python 2 memoryviews don't support mmap objects, nor cast()
+            self._data = array.array("d", self.mmap[header_size:end])
+
+    def __getitem__(self, name):
+        """
+        Return the values of the given column
+        """
+
+        try:
+            idx = self.columns.index(name)
+        except ValueError:
+            raise KeyError(name)
+
+        return self._data[idx::len(self.columns)]
+
+    def as_dict(self):
+        """
+        Return a dictionary {column name: values}
+        """
+
+        return dict((x, self[x]) for x in self.columns)
+
+    def close(self):
+        self._data = None
+
+        try:
+            self.mmap.close()
+        except BufferError:
+            # some column views are still alive, let the garbage collector close it
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _compress_gzip(source, target, level):
+    import gzip
+
+    with open(source, "rb") as src:
+        with gzip.open(target, "wb", level) as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def _compress_bz2(source, target, level):
+    import bz2
+
+    with open(source, "rb") as src:
+        dst = bz2.BZ2File(target, "wb", compresslevel=level)
+        try:
+            shutil.copyfileobj(src, dst)
+        finally:
+            dst.close()
+
+
+# compression name: (file extension, compression function)
+COMPRESSORS = {
+    'gzip': ('.gz', _compress_gzip),
+    'bz2': ('.bz2', _compress_bz2),
+}
+
+ROTATED_EXTENSIONS = ('',) + tuple(ext for ext, _ in COMPRESSORS.values())
+
+
+def get_compressor():
+    """
+    Return the thread compressing the rotated files, starting it if needed
+    """
+
+    global COMPRESSOR
+
+    with LOCK:
+        if COMPRESSOR is None or not COMPRESSOR.is_alive():
+            COMPRESSOR = Compressor()
+            COMPRESSOR.start()
+
+    return COMPRESSOR
+
+
+class Compressor(threading.Thread):
+    """
+    A thread compressing the rotated files and removing the oldest ones,
+    so that the reporters are not delayed
+    """
+
+    def __init__(self):
+        super(Compressor, self).__init__(name="appmetrics-compressor")
+
+        self.daemon = True
+        self.queue = py3comp.queue.Queue()
+
+    def submit(self, file_name, base_name, compression, level, backup_count):
+        """
+        Compress "file_name" (if "compression" is not None), then keep only the
+        latest "backup_count" (if not None) rotated files of "base_name"
+        """
+
+        self.queue.put((file_name, base_name, compression, level, backup_count))
+
+    def wait(self):
+        """
+        Wait for all the submitted files to be processed
+        """
+
+        self.queue.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.process(*job)
+            except Exception as e:
+                log.exception("Error processing rotated file %s: %s", job[0], e)
+            finally:
+                self.queue.task_done()
+
+    def process(self, file_name, base_name, compression, level, backup_count):
+        if compression is not None:
+            ext, compress = COMPRESSORS[compression]
+
+            # write to a temporary file, so that a partial output is never mistaken for a valid one
+            tmp_name = file_name + ext + ".tmp"
+            compress(file_name, tmp_name, level)
+            os.rename(tmp_name, file_name + ext)
+            os.remove(file_name)
+
+        if backup_count is not None:
+            for old in rotated_files(base_name)[:-backup_count or None]:
+                os.remove(old)
+
+
+def rotated_files(base_name):
+    """
+    Return the rotated files of the given csv file, oldest first
+    """
+
+    directory, prefix = os.path.split(base_name)
+    prefix += "."
+
+    names = [
+        x for x in os.listdir(directory or ".")
+        if x.startswith(prefix) and not x.endswith(".tmp")]
+
+    def key(name):
+        # the timestamp suffix sorts chronologically, ".<n>" suffixes come after the plain ones
+        suffix = name[len(prefix):]
+        for ext in ROTATED_EXTENSIONS[1:]:
+            if suffix.endswith(ext):
+                suffix = suffix[:-len(ext)]
+
+        return [(0, int(x), "") if x.isdigit() else (1, 0, x) for x in suffix.split(".")]
+
+    names.sort(key=key)
+
+    return [os.path.join(directory, x) for x in names]
+
+
+class StatsDReporter(object):
+    """
+    A reporter callback sending the metrics to a StatsD server, in the StatsD line format.
+    The lines are packed into as few UDP datagrams as possible, each one no bigger than
+    "mtu" bytes, and they are sent on a non blocking socket: the datagrams that can't
+    be sent right away are dropped.
+
+    Counters are sent as increments since the previous report, meters as the increment
+    of their count plus a gauge for each rate, histograms as a gauge for each statistic
+    (StatsD timers need the single values, which are not available in a report).
+    Pass interval=True when the reporter is registered with interval=True: the
+    counts are then increments already, and they are sent as they are
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix=None, mtu=DEFAULT_STATSD_MTU, interval=False):
+        self.prefix = "{}.".format(prefix) if prefix else ""
+        self.mtu = mtu
+        self.interval = interval
+
+        family, _, _, _, self.address = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+        self.lock = threading.Lock()
+
+        # latest counts of counters and meters, by name
+        self.counts = {}
+
+    def name(self, *parts):
+        return self.prefix + STATSD_INVALID_CHARS.sub("_", ".".join(str(x) for x in parts))
+
+    def count(self, name, value):
+        """
+        Return the increment of the given count since the previous report
+        """
+
+        if self.interval:
+            return value
+
+        previous = self.counts.get(name, 0)
+        self.counts[name] = value
+
+        return value - previous
+
+    def lines(self, objects):
+        """
+        Yield the StatsD lines for the given metrics
+        """
+
+        for name, obj in sorted(py3comp.iteritems(objects)):
+            kind = obj.get('kind')
+
+            if kind == "counter":
+                yield statsd_line(self.name(name), self.count(name, obj['value']), "c")
+
+            elif kind == "gauge":
+                for line in statsd_gauge(self.name(name), obj['value']):
+                    yield line
+
+            elif kind == "meter":
+                yield statsd_line(self.name(name, "count"), self.count(name, obj['count']), "c")
+
+                for field in ('mean', 'one', 'five', 'fifteen', 'day'):
+                    if field in obj:
+                        for line in statsd_gauge(self.name(name, field), obj[field]):
+                            yield line
+
+            elif kind == "histogram":
+                obj = obj.copy()
+                flatten_histogram(obj)
+                obj.pop('kind')
+
+                for field, value in sorted(py3comp.iteritems(obj)):
+                    for line in statsd_gauge(self.name(name, field), value):
+                        yield line
+
+    def packets(self, lines):
+        """
+        Join the given lines into packets of at most "mtu" bytes (unless a single line is bigger)
+        """
+
+        packet = b""
+        for line in lines:
+            line = line.encode("utf8")
+
+            if packet and len(packet) + 1 + len(line) > self.mtu:
+                yield packet
+                packet = b""
+
+            packet = packet + b"\n" + line if packet else line
+
+        if packet:
+            yield packet
+
+    def send(self, packet):
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error as e:
+            log.debug("Cannot send the metrics to StatsD: %s", e)
+
+    def __call__(self, objects):
+        with self.lock:
+            for packet in self.packets(self.lines(objects)):
+                self.send(packet)
+
+    def close(self):
+        self.socket.close()
+
+
+STATSD_INVALID_CHARS = re.compile(r"[:|@\s]")
+
+
+def format_number(value):
+    """
+    Return the text representation of the given numeric value, None if it's not a finite number
+    """
+
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, py3comp.integer_types):
+        return str(value)
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if math.isnan(value) or math.isinf(value):
+        return None
+
+    return repr(value)
+
+
+def statsd_line(name, value, type_):
+    return "{}:{}|{}".format(name, format_number(value), type_)
+
+
+def statsd_gauge(name, value):
+    """
+    Yield the lines setting the given gauge. The numeric gauges only are supported
+    """
+
+    text = format_number(value)
+    if text is None:
+        return
+
+    # a signed value would be taken as an increment
+    if text.startswith("-"):
+        yield "{}:0|g".format(name)
+
+    yield "{}:{}|g".format(name, text)
+
+
+class GraphiteReporter(object):
+    """
+    A reporter callback sending the metrics to a Graphite (carbon) server, by the
+    "plaintext" or the "pickle" protocol, over a persistent TCP connection.
+    The server's address is resolved once, then the connection and the reports
+    are made without blocking: a pending connection and what the server doesn't
+    accept are completed at the next reports, and the connection is reset if the
+    server doesn't accept it or doesn't read for "timeout" seconds. While the server can't
+    be reached the reports are queued (at most "max_queued" of them, the oldest
+    are discarded) and the connection is retried with an exponential backoff,
+    from "min_backoff" to "max_backoff" seconds.
+    """
+
+    def __init__(self, host="localhost", port=2003, prefix=None, protocol="plaintext",
+                 timeout=DEFAULT_GRAPHITE_TIMEOUT, max_queued=DEFAULT_GRAPHITE_MAX_QUEUED,
+                 min_backoff=1.0, max_backoff=60.0):
+        if protocol not in ("plaintext", "pickle"):
+            raise ValueError("Unknown protocol: {}".format(protocol))
+
+        self.address = (host, port)
+        self.prefix = "{}.".format(prefix) if prefix else ""
+        self.protocol = protocol
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.queue = collections.deque(maxlen=max_queued)
+        self.lock = threading.Lock()
+
+        self.socket = None
+        self.connecting_since = None
+        self.resolved = None
+        self.backoff = 0
+        self.next_attempt = 0
+
+        # (report, offset of the first unsent byte) of the report being sent
+        self.pending = None
+        self.blocked_since = None
+
+    def values(self, objects):
+        """
+        Yield (path, value) for the numeric values of the given metrics
+        """
+
+        for name, obj in sorted(py3comp.iteritems(objects)):
+            obj = obj.copy()
+            kind = obj.pop('kind', None)
+            name = self.prefix + GRAPHITE_INVALID_CHARS.sub("_", name)
+
+            if kind == "histogram":
+                for bin_, count in obj.pop('histogram', []):
+                    obj['histogram.{}'.format(graphite_component(bin_))] = count
+                for level, value in obj.pop('percentile', []):
+                    obj['percentile.{}'.format(graphite_component(level))] = value
+
+            for field, value in sorted(py3comp.iteritems(obj)):
+                value = format_number(value)
+                if value is not None:
+                    yield "{}.{}".format(name, field), value
+
+    def serialize(self, objects, timestamp):
+        """
+        Return the given metrics in the configured protocol
+        """
+
+        values = self.values(objects)
+
+        if self.protocol == "plaintext":
+            lines = ["{} {} {}\n".format(path, value, timestamp) for path, value in values]
+            return "".join(lines).encode("utf8")
+
+        payload = pickle.dumps([(path, (timestamp, float(value))) for path, value in values], 2)
+        return struct.pack("!L", len(payload)) + payload
+
+    def resolve(self):
+        """
+        Return (family, type, proto, address) of the server, resolved on the first call only
+        """
+
+        if self.resolved is None:
+            family, type_, proto, _, address = socket.getaddrinfo(
+                self.address[0], self.address[1], 0, socket.SOCK_STREAM)[0]
+            self.resolved = (family, type_, proto, address)
+
+        return self.resolved
+
+    def connect(self, now):
+        """
+        Connect to the server without blocking, unless the next attempt is not due yet.
+        Return True if connected; a pending connection is checked again at the next call
+        """
+
+        if self.socket is not None and self.connecting_since is None:
+            return True
+
+        if self.socket is None:
+            if now < self.next_attempt:
+                return False
+
+            try:
+                family, type_, proto, address = self.resolve()
+                self.socket = socket.socket(family, type_, proto)
+                self.socket.setblocking(False)
+                error = self.socket.connect_ex(address)
+            except socket.error as e:
+                self.disconnected(now, e)
+                return False
+
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                self.disconnected(now, socket.error(error, os.strerror(error)))
+                return False
+            self.connecting_since = now
+
+        # the connection is established (or failed) when the socket becomes writable
+        if not select.select([], [self.socket], [], 0)[1]:
+            if now - self.connecting_since >= self.timeout:
+                self.disconnected(now, "connection timed out")
+            return False
+
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.disconnected(now, socket.error(error, os.strerror(error)))
+            return False
+
+        self.connecting_since = None
+        self.backoff = 0
+        return True
+
+    def disconnected(self, now, error):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.connecting_since = None
+
+        # the server discards the incomplete line (or pickle frame) of the closed connection
+        if self.pending is not None:
+            data, offset = self.pending
+            if self.protocol == "plaintext":
+                data = data[data.rfind(b"\n", 0, offset) + 1:]
+            self.queue.appendleft(data)
+            self.pending = None
+        self.blocked_since = None
+
+        self.backoff = min(self.backoff * 2, self.max_backoff) if self.backoff else self.min_backoff
+        self.next_attempt = now + self.backoff
+
+        log.warning("Graphite server %s:%s unavailable (%s), retrying in %s seconds",
+                    self.address[0], self.address[1], error, self.backoff)
+
+    def send_queued(self, now):
+        """
+        Send the queued reports, oldest first, as long as the server accepts them
+        """
+
+        while (self.pending is not None or self.queue) and self.connect(now):
+            if self.pending is None:
+                self.pending = (self.queue.popleft(), 0)
+
+            data, offset = self.pending
+            try:
+                sent = self.socket.send(memoryview(data)[offset:])
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.disconnected(now, e)
+                elif self.blocked_since is None:
+                    self.blocked_since = now
+                elif now - self.blocked_since >= self.timeout:
+                    self.disconnected(now, "not reading")
+                return
+
+            self.blocked_since = None
+            offset += sent
+            self.pending = (data, offset) if offset < len(data) else None
+
     def __call__(self, objects):
-        for name, obj in py3comp.iteritems(objects):
-            fun = getattr(self, "dump_%s" % obj.get('kind', "unknown"), None)
-            if fun:
-                # protect the original object
-                fun(name, obj.copy())
+        now = time.time()
+        data = self.serialize(objects, int(now))
+
+        with self.lock:
+            if data:
+                self.queue.append(data)
+            self.send_queued(now)
+
+    def close(self):
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            self.connecting_since = None
+            self.pending = None
+
+
+GRAPHITE_INVALID_CHARS = re.compile(r"\s")
+
+
+def graphite_component(value):
+    """
+    Return the given value as a single component of a Graphite path
+    """
+
+    return GRAPHITE_INVALID_CHARS.sub("_", str(value)).replace(".", "_")
 
 
 @atexit.register
 def cleanup():
     for v in REGISTRY.values():
         v.cancel()
+
+    for file_reporter in list(FILE_REPORTERS):
+        file_reporter.close()
+
+    if SCHEDULER is not None:
+        SCHEDULER.stop()
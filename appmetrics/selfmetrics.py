@@ -0,0 +1,121 @@
+##  Module selfmetrics.py
+##
+##  Copyright (c) 2014 Antonio Valente <y3sman@gmail.com>
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##  http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+
+
+"""
+Self-instrumentation: when enabled, appmetrics measures its own overhead into
+histograms tagged with TAG
+"""
+
+from . import locks
+from .lazy import LazyModule
+
+# these modules import this one
+metrics = LazyModule("appmetrics.metrics")
+histogram = LazyModule("appmetrics.histogram")
+
+
+TAG = "_appmetrics"
+
+# seconds spent in Histogram.get()
+HISTOGRAM_GET = TAG + ":histogram_get"
+# seconds spent waiting for a contended reservoir lock
+RESERVOIR_LOCK_WAIT = TAG + ":reservoir_lock_wait"
+# seconds spent in the reporter callbacks
+REPORTER_CALLBACK = TAG + ":reporter_callback"
+# seconds between the scheduled time of a reporter tick and its actual time
+REPORTER_LAG = TAG + ":reporter_lag"
+# number of metrics passed to a reporter callback at each tick
+SNAPSHOT_SIZE = TAG + ":snapshot_size"
+
+METRICS = (HISTOGRAM_GET, RESERVOIR_LOCK_WAIT, REPORTER_CALLBACK, REPORTER_LAG, SNAPSHOT_SIZE)
+
+# the decaying reservoir keeps the recent spikes visible and its size bounded
+RESERVOIR_TYPE = 'exp_decaying'
+
+ENABLED = False
+
+
+def enable():
+    """
+    Create the internal metrics and start recording them. The locks of the
+    existing reservoirs are timed too
+    """
+
+    global ENABLED
+
+    # the internal histograms are not timed, or they would record their own waits
+    locks.WAIT_OBSERVER = None
+
+    for name in METRICS:
+        metrics.get_or_create_histogram(name, RESERVOIR_TYPE)
+        metrics.tag(name, TAG)
+
+    for obj in timed_objects():
+        if not isinstance(obj.lock, locks.TimedLock):
+            obj.lock = locks.TimedLock(obj.lock, record_lock_wait)
+
+    locks.WAIT_OBSERVER = record_lock_wait
+    ENABLED = True
+
+
+def disable():
+    """
+    Stop recording the internal metrics, which are kept with their values
+    """
+
+    global ENABLED
+
+    ENABLED = False
+    locks.WAIT_OBSERVER = None
+
+    for obj in timed_objects():
+        if isinstance(obj.lock, locks.TimedLock):
+            obj.lock = obj.lock.lock
+
+
+def timed_objects():
+    """
+    Yield the reservoirs and the interval recorders of the registered histograms,
+    but the internal ones
+    """
+
+    reservoir_types = tuple(metrics.RESERVOIR_TYPES.values())
+
+    for name, item in list(metrics.REGISTRY.items()):
+        if name in METRICS or not isinstance(item, histogram.Histogram):
+            continue
+
+        if isinstance(item.reservoir, reservoir_types):
+            yield item.reservoir
+
+        for recorder in list(item._recorders.values()):
+            yield recorder
+
+
+def record(name, value):
+    """
+    Notify the named internal metric, unless it has been deleted
+    """
+
+    item = metrics.REGISTRY.get(name)
+    if item is not None:
+        item.notify(value)
+
+
+def record_lock_wait(wait):
+    if ENABLED:
+        record(RESERVOIR_LOCK_WAIT, wait)
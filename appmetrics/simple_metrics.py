@@ -18,7 +18,9 @@
 Implementation of simple metrics
 """
 
-import threading
+import sys
+
+from . import locks, memory
 
 
 class Counter(object):
@@ -26,10 +28,18 @@ class Counter(object):
     Counter metrics provide increment and decrement capabilities for a single integer value.
     """
 
+    __slots__ = ('value', '_interval', '_version', 'lock')
+
     def __init__(self):
         self.value = 0
 
-        self.lock = threading.Lock()
+        # latest value returned by get_interval(), by key. Created on the first call
+        self._interval = None
+
+        # incremented at each notification
+        self._version = 0
+
+        self.lock = locks.striped_lock()
 
     def notify(self, value):
         """
@@ -41,6 +51,15 @@ class Counter(object):
 
         with self.lock:
             self.value += value
+            self._version += 1
+
+    @property
+    def version(self):
+        """
+        Return a number changing whenever the counter's value may change
+        """
+
+        return self._version
 
     def get(self):
         """
@@ -48,22 +67,59 @@ class Counter(object):
         """
         return dict(kind="counter", value=self.value)
 
+    def get_interval(self, key):
+        """
+        Return the counter's increment since the previous call with the same key
+        (or since the counter's creation)
+        """
+
+        with self.lock:
+            if self._interval is None:
+                self._interval = {}
+
+            value = self.value
+            previous = self._interval.get(key, 0)
+            self._interval[key] = value
+
+        return dict(kind="counter", value=value - previous)
+
+    def release_interval(self, key):
+        """
+        Forget the state of the given interval key
+        """
+
+        with self.lock:
+            if self._interval is not None:
+                self._interval.pop(key, None)
+
     def raw_data(self):
         """
         Return the raw value
         """
         return self.value
 
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the counter, in bytes
+        """
+
+        return sys.getsizeof(self) + sys.getsizeof(self.value) + memory.sizeof_dict(self._interval)
+
 
 class Gauge(object):
     """
     Gauges are point-in-time single value metrics.
     """
 
+    __slots__ = ('value', '_version', 'lock')
+
     def __init__(self):
         self.value = None
 
-        self.lock = threading.Lock()
+        # incremented at each notification
+        self._version = 0
+
+        self.lock = locks.striped_lock()
 
     def notify(self, value):
         """
@@ -72,6 +128,15 @@ class Gauge(object):
 
         with self.lock:
             self.value = value
+            self._version += 1
+
+    @property
+    def version(self):
+        """
+        Return a number changing whenever the gauge's value may change
+        """
+
+        return self._version
 
     def get(self):
         """
@@ -80,5 +145,25 @@ class Gauge(object):
 
         return dict(kind="gauge", value=self.value)
 
+    def get_interval(self, key):
+        """
+        Return the gauge's current value: gauges are point-in-time metrics
+        """
+
+        return self.get()
+
+    def release_interval(self, key):
+        """
+        Nothing to do: gauges don't keep any interval state
+        """
+
     def raw_data(self):
         return self.value
+
+    def sizeof(self):
+        """
+        Return an estimate of the memory used by the gauge, in bytes: the value
+        is not followed if it's a container
+        """
+
+        return sys.getsizeof(self) + sys.getsizeof(self.value)
@@ -29,9 +29,6 @@ import math
 import operator
 import functools
 
-from fractions import Fraction
-from decimal import Decimal
-
 from .exceptions import StatisticsError
 from .py3comp import xrange, iteritems
 
@@ -53,6 +50,10 @@ def sum(data, start=0):
     argument ``start`` is given, it is added to the total. If ``data`` is
     empty, ``start`` (defaulting to 0) is returned.
     """
+    # not needed to record the values
+    from fractions import Fraction
+    from decimal import Decimal
+
     n, d = exact_ratio(start)
     T = type(start)
     partials = {d: n}  # map {denominator: sum of numerators}
@@ -0,0 +1,243 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+
+from nose import tools as nt
+from nose import SkipTest
+import mock
+
+from .. import aggregator as mm, metrics, exceptions
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("Timed out")
+        time.sleep(0.005)
+
+
+class TestAggregator(object):
+    def setUp(self):
+        if not hasattr(socket, "AF_UNIX"):
+            raise SkipTest("unix sockets are not available")
+
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "aggregator.sock")
+        self.server = mm.AggregatorServer(self.path)
+        self.server.start(0.01)
+
+        self.client = mm.AggregatorClient(self.path, batch_size=3, flush_interval=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+
+    def counter_value(self, name, value):
+        return lambda: name in metrics.REGISTRY and metrics.get(name)['value'] == value
+
+    def test_batch(self):
+        self.client.new_counter("c1")
+        self.client.notify("c1", 1)
+        self.client.notify("c1", 2)
+
+        time.sleep(0.05)
+        nt.assert_not_in("c1", metrics.REGISTRY)
+
+        self.client.notify("c1", 3)
+        wait_for(self.counter_value("c1", 6))
+
+    def test_flush(self):
+        self.client.new_histogram("h1")
+        self.client.new_gauge("g1")
+        self.client.new_meter("m1")
+        self.client.notify("h1", 1.5)
+        self.client.notify("g1", 2.5)
+        self.client.notify("m1", 3)
+        self.client.notify("h1", 2.5)
+        self.client.flush()
+
+        wait_for(lambda: "h1" in metrics.REGISTRY and metrics.get("h1")['n'] == 2)
+        nt.assert_equal(metrics.get("h1")['arithmetic_mean'], 2.0)
+        nt.assert_equal(metrics.get("g1")['value'], 2.5)
+        nt.assert_equal(metrics.get("m1")['count'], 3)
+
+    def test_existing_metric(self):
+        counter = metrics.new_counter("c1")
+        counter.notify(10)
+
+        self.client.new_counter("c1")
+        self.client.notify("c1", 1)
+        self.client.flush()
+
+        wait_for(self.counter_value("c1", 11))
+        nt.assert_is(metrics.metric("c1"), counter)
+
+    def test_several_clients(self):
+        other = mm.AggregatorClient(self.path, batch_size=1, flush_interval=0)
+        try:
+            other.new_counter("c2")
+            self.client.new_counter("c1")
+            self.client.new_counter("c2")
+
+            other.notify("c2", 1)
+            self.client.notify("c2", 2)
+            self.client.flush()
+
+            wait_for(self.counter_value("c2", 3))
+        finally:
+            other.close()
+
+    def test_reconnect(self):
+        self.client.new_counter("c1")
+        self.client.notify("c1", 1)
+        self.client.flush()
+        wait_for(self.counter_value("c1", 1))
+
+        self.server.stop()
+
+        # discarded
+        self.client.notify("c1", 1)
+        self.client.flush()
+
+        self.server = mm.AggregatorServer(self.path)
+        self.server.start(0.01)
+
+        self.client.notify("c1", 1)
+        self.client.flush()
+        wait_for(self.counter_value("c1", 2))
+
+    def test_no_server(self):
+        client = mm.AggregatorClient(os.path.join(self.tmpdir, "xxx"), batch_size=1, flush_interval=0)
+        client.new_counter("c1")
+        client.notify("c1", 1)
+        client.close()
+
+    @mock.patch('appmetrics.aggregator.log')
+    def test_aggregator_not_reading(self, log):
+        path = os.path.join(self.tmpdir, "stalled.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        client = mm.AggregatorClient(path, batch_size=1000, flush_interval=0)
+        try:
+            client.new_counter("c1")
+
+            slowest = 0
+            for i in range(50000):
+                start = time.time()
+                client.notify("c1", 1)
+                slowest = max(slowest, time.time() - start)
+
+            # the notifications are discarded without blocking the caller
+            nt.assert_less(slowest, 0.1)
+            nt.assert_true(log.debug.called)
+        finally:
+            client.close()
+            listener.close()
+
+    def test_flusher(self):
+        client = mm.AggregatorClient(self.path, flush_interval=0.01)
+        try:
+            client.new_counter("c1")
+            client.notify("c1", 5)
+
+            wait_for(self.counter_value("c1", 5))
+        finally:
+            client.close()
+
+    def test_fork(self):
+        if not hasattr(os, "fork"):
+            raise SkipTest("fork is not available")
+
+        self.client.new_counter("c1")
+        self.client.notify("c1", 1)
+
+        pid = os.fork()
+        if not pid:
+            try:
+                self.client.notify("c1", 10)
+                self.client.close()
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        self.client.flush()
+
+        wait_for(self.counter_value("c1", 11))
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_notify_undefined(self):
+        self.client.notify("xxx", 1)
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_define_invalid_kind(self):
+        self.client.define("xxx", "xxx")
+
+    @mock.patch('appmetrics.aggregator.log')
+    def test_invalid_frame(self, log):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            payload = mm.NOTIFY.pack(mm.NOTIFY_OP, 1, 1.0)
+            sock.sendall(struct.pack("!I", len(payload)) + payload)
+
+            wait_for(lambda: log.error.called)
+        finally:
+            sock.close()
+
+
+class TestProcess(object):
+    def setUp(self):
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+        self.server = mock.Mock(spec=mm.AggregatorServer)
+        self.server.get_metric = lambda name, kind: mm.AggregatorServer.get_metric(self.server, name, kind)
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+
+    def process(self, payload, defined=None):
+        defined = {} if defined is None else defined
+        mm.AggregatorServer.process(self.server, payload, defined)
+        return defined
+
+    def test_define(self):
+        defined = self.process(mm.pack_define(7, u"n\xe8", "meter"))
+
+        nt.assert_equal(list(defined), [7])
+        nt.assert_is(defined[7], metrics.metric(u"n\xe8"))
+
+    @nt.raises(ValueError)
+    def test_invalid_kind(self):
+        self.process(mm.pack_define(7, "name", "xxx"))
+
+    @nt.raises(ValueError)
+    def test_invalid_operation(self):
+        self.process(b"X")
+
+    @nt.raises(struct.error)
+    def test_truncated(self):
+        self.process(mm.NOTIFY.pack(mm.NOTIFY_OP, 1, 1.0)[:-1])
+
+    @mock.patch('appmetrics.aggregator.log')
+    def test_notify_error(self, log):
+        metric = mock.Mock()
+        metric.notify.side_effect = ValueError()
+
+        self.process(mm.NOTIFY.pack(mm.NOTIFY_OP, 1, 1.0) * 2, {1: metric})
+
+        nt.assert_equal(metric.notify.call_count, 2)
+        nt.assert_equal(log.exception.call_count, 2)
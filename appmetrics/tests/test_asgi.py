@@ -0,0 +1,235 @@
+import json
+
+import mock
+from nose.tools import assert_equal, assert_is_none, assert_false, assert_true
+from nose import SkipTest
+
+from .. import metrics, profiling
+
+try:
+    import asyncio
+    from .. import asgi
+except (ImportError, SyntaxError):
+    # python < 3.5
+    asgi = None
+
+
+def done(result=None):
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+def scope(path, method="GET", query_string=b"", headers=()):
+    return dict(type="http", method=method, path=path, query_string=query_string, headers=list(headers))
+
+
+class ASGITestCase(object):
+    def setUp(self):
+        if asgi is None:
+            raise SkipTest("asgi needs python >= 3.5")
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.app = mock.Mock(return_value=done())
+        self.mw = asgi.AppMetricsMiddleware(self.app)
+
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+        self.original_tags = metrics.TAGS.copy()
+        metrics.TAGS.clear()
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+        metrics.TAGS.clear()
+        metrics.TAGS.update(self.original_tags)
+
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def call(self, scope_, *bodies, **kwargs):
+        """Return (status, headers, body)"""
+
+        mw = kwargs.get('mw', self.mw)
+
+        messages = [dict(type="http.request", body=b, more_body=i < len(bodies) - 1) for i, b in enumerate(bodies)]
+        sent = []
+
+        def receive():
+            return done(messages.pop(0) if messages else dict(type="http.disconnect"))
+
+        def send(message):
+            sent.append(message)
+            return done()
+
+        self.loop.run_until_complete(mw(scope_, receive, send))
+
+        if not sent:
+            return None
+
+        assert_equal([x['type'] for x in sent], ["http.response.start", "http.response.body"])
+        headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in sent[0]['headers']]
+        return sent[0]['status'], headers, sent[1]['body']
+
+    def json_call(self, path, method, body):
+        return self.call(
+            scope(path, method, headers=[(b"content-type", b"application/json")]), json.dumps(body).encode("utf8"))
+
+
+class TestMiddleware(ASGITestCase):
+    def test_not_matching(self):
+        for path in ("/", "/test", "/_app-metrics", "/_app-metricsX/metrics", "/_app-metrics/test/sub"):
+            s = scope(path)
+            assert_is_none(self.call(s))
+            assert_equal(self.app.call_args[0][0], s)
+
+        assert_equal(self.app.call_count, 5)
+
+    def test_not_http(self):
+        assert_is_none(self.call(dict(type="lifespan")))
+        assert_true(self.app.called)
+
+    def test_method_not_allowed(self):
+        status, headers, body = self.call(scope("/_app-metrics/metrics", "POST"))
+
+        assert_equal(status, 405)
+        assert_equal(dict(headers)['Allow'], "GET")
+        assert_false(self.app.called)
+
+    def test_list(self):
+        metrics.new_counter("c1")
+        metrics.new_counter("c2").notify(2)
+
+        status, headers, body = self.call(scope("/_app-metrics/metrics"))
+        assert_equal(status, 200)
+        assert_equal(headers, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        assert_equal(json.loads(body.decode("utf8")), ["c1", "c2"])
+
+        status, _, body = self.call(scope("/_app-metrics/metrics", query_string=b"names=c2,xxx"))
+        assert_equal(json.loads(body.decode("utf8")), dict(c2=dict(kind="counter", value=2)))
+
+        status, _, body = self.call(scope("/_app-metrics/metrics", query_string=b"all=true"))
+        assert_equal(sorted(json.loads(body.decode("utf8"))), ["c1", "c2"])
+
+    def test_executor(self):
+        executor = mock.Mock()
+        mw = asgi.AppMetricsMiddleware(self.app, executor=executor)
+
+        with mock.patch.object(self.loop, 'run_in_executor', return_value=done(json.dumps("x"))) as run:
+            status, _, body = self.call(scope("/_app-metrics/metrics"), mw=mw)
+
+        assert_equal(run.call_args[0][0], executor)
+        assert_equal(body, b'"x"')
+
+    def test_metric(self):
+        status, _, body = self.json_call("/_app-metrics/metrics/h", "PUT", dict(type="histogram"))
+        assert_equal((status, body), (200, b""))
+
+        status, _, body = self.json_call("/_app-metrics/metrics/h", "POST", dict(value=3))
+        assert_equal((status, body), (200, b""))
+
+        status, _, body = self.call(scope("/_app-metrics/metrics/h"))
+        assert_equal(json.loads(body.decode("utf8"))['n'], 1)
+
+        status, _, body = self.call(scope("/_app-metrics/metrics/h", "DELETE"))
+        assert_equal((status, body), (200, b"deleted"))
+
+        status, _, body = self.call(scope("/_app-metrics/metrics/h"))
+        assert_equal((status, json.loads(body.decode("utf8"))), (404, "No such metric: 'h'"))
+
+    def test_chunked_body(self):
+        metrics.new_counter("c")
+        headers = [(b"content-type", b"application/json; charset=utf-8")]
+
+        status, _, _ = self.call(scope("/_app-metrics/metrics/c", "POST", headers=headers), b'{"val', b'ue": 3}')
+
+        assert_equal(status, 200)
+        assert_equal(metrics.get("c")['value'], 3)
+
+    def test_bad_requests(self):
+        status, _, body = self.json_call("/_app-metrics/metrics/h", "PUT", dict(type="xxx"))
+        assert_equal((status, json.loads(body.decode("utf8"))), (400, "invalid metric type: 'xxx'"))
+
+        status, _, body = self.json_call("/_app-metrics/metrics/h", "POST", dict(value=1))
+        assert_equal(status, 404)
+
+        status, _, body = self.call(scope("/_app-metrics/metrics/h", "POST"), b"{}")
+        assert_equal(status, 415)
+
+        status, _, body = self.call(
+            scope("/_app-metrics/metrics/h", "POST", headers=[(b"content-type", b"application/json")]), b"{")
+        assert_equal((status, json.loads(body.decode("utf8"))), (400, "invalid json"))
+
+    @mock.patch('appmetrics.asgi.handle_tags_list')
+    def test_internal_error(self, handler):
+        handler.side_effect = ValueError()
+        mw = asgi.AppMetricsMiddleware(self.app, extra_headers={'X-Extra': "1"})
+
+        status, headers, body = self.call(scope("/_app-metrics/tags"), mw=mw)
+
+        assert_equal((status, body), (500, b"Internal Server Error"))
+        assert_equal(dict(headers)['X-Extra'], "1")
+
+    def test_tags(self):
+        metrics.new_counter("c").notify(1)
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1/c", "PUT"))
+        assert_equal(status, 200)
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1/xxx", "PUT"))
+        assert_equal(status, 400)
+
+        status, _, body = self.call(scope("/_app-metrics/tags"))
+        assert_equal(json.loads(body.decode("utf8")), ["t1"])
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1"))
+        assert_equal(json.loads(body.decode("utf8")), ["c"])
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1", query_string=b"expand=true"))
+        assert_equal(json.loads(body.decode("utf8")), dict(c=dict(kind="counter", value=1)))
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1/c", "DELETE"))
+        assert_equal(body, b"deleted")
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1"))
+        assert_equal(status, 404)
+
+    @mock.patch('appmetrics.profiling.PROFILERS', {})
+    def test_metric_name_with_slashes(self):
+        metrics.new_counter("request:/users/<id>:2xx").notify(1)
+
+        status, _, body = self.call(scope("/_app-metrics/metrics/request:/users/<id>:2xx"))
+        assert_equal((status, json.loads(body.decode("utf8"))), (200, dict(kind="counter", value=1)))
+
+        status, _, body = self.call(scope("/_app-metrics/tags/t1/request:/users/<id>:2xx", "PUT"))
+        assert_equal(status, 200)
+        assert_equal(metrics.tags(), dict(t1=set(["request:/users/<id>:2xx"])))
+
+    def test_profiles(self):
+        profiling.get_or_create_profiler("h", mock.Mock(), 99).captures.append(dict(duration=1.5))
+
+        status, _, body = self.call(scope("/_app-metrics/profiles"))
+        assert_equal(json.loads(body.decode("utf8")), ["h"])
+
+        status, _, body = self.call(scope("/_app-metrics/profiles/h"))
+        assert_equal(json.loads(body.decode("utf8")), [dict(duration=1.5)])
+
+        status, _, body = self.call(scope("/_app-metrics/profiles/xxx"))
+        assert_equal((status, json.loads(body.decode("utf8"))), (404, "No profiles for metric: 'xxx'"))
+
+    def test_prometheus(self):
+        with mock.patch('appmetrics.asgi.prometheus.Renderer.__call__', return_value=iter(["a 1\n", "b 2\n"])):
+            status, headers, body = self.call(scope("/_app-metrics/prometheus"))
+
+        assert_equal(body, b"a 1\nb 2\n")
+        assert_equal(dict(headers)['Content-Type'], "text/plain; version=0.0.4; charset=utf-8")
+
+    def test_empty_root(self):
+        mw = asgi.AppMetricsMiddleware(self.app, "")
+
+        status, _, body = self.call(scope("/metrics"), mw=mw)
+        assert_equal((status, body), (200, b"[]"))
+
+        assert_is_none(self.call(scope("/test"), mw=mw))
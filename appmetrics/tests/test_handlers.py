@@ -0,0 +1,48 @@
+from nose.tools import assert_equal, assert_raises, assert_is_none
+
+from .. import handlers, metrics
+
+
+class TestHandlers(object):
+    def setUp(self):
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+        self.original_tags = metrics.TAGS.copy()
+        metrics.TAGS.clear()
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+        metrics.TAGS.clear()
+        metrics.TAGS.update(self.original_tags)
+
+    def test_metric_show_not_found(self):
+        with assert_raises(handlers.HTTPError) as exc:
+            handlers.metric_show("test")
+        assert_equal(exc.exception.status, 404)
+        assert_equal(exc.exception.description, "No such metric: 'test'")
+
+    def test_metric_update_not_found(self):
+        with assert_raises(handlers.HTTPError) as exc:
+            handlers.metric_update("test", dict(value=1))
+        assert_equal(exc.exception.status, 404)
+        # the middleware's default description
+        assert_is_none(exc.exception.description)
+
+    def test_metric_new_and_update(self):
+        assert_equal(handlers.metric_new("test", dict(type="counter")), "")
+        assert_equal(handlers.metric_update("test", dict(value=3)), "")
+
+        assert_equal(metrics.get("test")['value'], 3)
+
+    def test_tag_metrics(self):
+        metrics.new_counter("b")
+        metrics.new_counter("a")
+        handlers.tag_add("t1", "b")
+        handlers.tag_add("t1", "a")
+
+        assert_equal(handlers.tag_metrics("t1"), ["a", "b"])
+
+        with assert_raises(handlers.HTTPError) as exc:
+            handlers.tag_metrics("t2")
+        assert_equal(exc.exception.status, 404)
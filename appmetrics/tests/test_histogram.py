@@ -1,4 +1,5 @@
 import random
+import sys
 
 from nose import tools as nt
 import mock
@@ -88,6 +89,24 @@ class TestUniformReservoir(object):
             self.ur.add(i)
         nt.assert_equal(len(self.ur.values), self.ur.count)
 
+    def test_version(self):
+        nt.assert_equal(self.ur.version, 0)
+
+        for i in range(5):
+            self.ur.add(i + 1.5)
+        nt.assert_equal(self.ur.version, 5)
+
+        # replaces a value
+        self.ur.add(10)
+        nt.assert_equal(self.ur.version, 6)
+
+        # discarded values don't change the version
+        self.ur.add(11)
+        self.ur.add(12)
+        self.ur.add(13)
+        self.ur.add(14)
+        nt.assert_equal(self.ur.version, 9)
+
     def test_values_greater_count(self):
         for i in range(6):
             self.ur.add(i)
@@ -156,6 +175,13 @@ class TestSlidingWindowReservoir(object):
         self.swr.add(11)
         nt.assert_equal(self.swr.values, [3.5, 4.5, 5.5, 10.0, 11.0])
 
+    def test_version(self):
+        nt.assert_equal(self.swr.version, 0)
+
+        for i in range(7):
+            self.swr.add(i)
+        nt.assert_equal(self.swr.version, 7)
+
     def test_sorted_values(self):
         for i in range(5):
             self.swr.add(random.randint(1, 10))
@@ -241,6 +267,21 @@ class TestSlidingTimeWindowReservoir(object):
         self.rr.add(9)
         nt.assert_equal(list(self.rr._values), [(10, 9)])
 
+    def test_version(self):
+        self.time.return_value = 1
+        self.rr.add(1)
+        self.rr.add(2)
+        nt.assert_equal(self.rr.version, 2)
+
+        # nothing expired
+        self.time.return_value = 3.5
+        nt.assert_equal(self.rr.version, 2)
+
+        # the first values expire
+        self.time.return_value = 4.5
+        nt.assert_equal(self.rr.version, 3)
+        nt.assert_equal(self.rr.values, [])
+
     def test_values(self):
         self.rr._values = [(1, 10), (1.5, 1.5), (2, 2), (3, 3)]
         self.time.return_value = 3.0
@@ -268,6 +309,20 @@ class TestSlidingTimeWindowReservoir(object):
         other = mm.SlidingTimeWindowReservoir(10)
         nt.assert_false(self.rr.same_kind(other))
 
+    def test_sizeof(self):
+        self.time.return_value = 1
+        empty = self.rr.sizeof()
+
+        for i in range(100):
+            self.rr.add(i)
+        full = self.rr.sizeof()
+        nt.assert_greater(full - empty, 100 * 3 * sys.getsizeof(1.0))
+
+        # the expired values are released on the next tick
+        self.time.return_value = 10
+        self.rr.add(1)
+        nt.assert_less(self.rr.sizeof(), full)
+
 
 class TestExponentialDecayingReservoir(object):
     def setUp(self):
@@ -308,6 +363,18 @@ class TestExponentialDecayingReservoir(object):
         nt.assert_equal(self._add_after(20, 1), [1.5, 10.0, 3.5, 4.5, 2.5])
         nt.assert_equal(self._add_after(30, 1), [10.0, 3.5, 4.5, 30.0,  2.5])
 
+    def test_version(self):
+        for i in range(1, 6):
+            self._add_after(0.5+i, 1)
+        nt.assert_equal(self.rr.version, 5)
+
+        self._add_after(10, 1)
+        nt.assert_equal(self.rr.version, 6)
+
+        # discarded value
+        self._add_after(20, 1)
+        nt.assert_equal(self.rr.version, 6)
+
     def test_rescaling(self):
         for i in range(1, 6):
             self._add_after(0.5+i, 1)
@@ -348,12 +415,72 @@ class TestExponentialDecayingReservoir(object):
         nt.assert_false(self.rr.same_kind(other))
 
 
+def test_reservoirs_sizeof():
+    reservoirs = [
+        mm.UniformReservoir(100), mm.SlidingWindowReservoir(100),
+        mm.SlidingTimeWindowReservoir(), mm.ExponentialDecayingReservoir(100)]
+
+    for reservoir in reservoirs:
+        empty = reservoir.sizeof()
+        for i in range(50):
+            reservoir.add(i)
+
+        nt.assert_greater_equal(reservoir.sizeof(), empty + 50 * sys.getsizeof(1.0))
+        nt.assert_greater(mm.ReservoirBase.sizeof(reservoir), empty)
+
+
+def test_reservoirs_totals():
+    reservoirs = [
+        mm.UniformReservoir(10), mm.SlidingWindowReservoir(10),
+        mm.SlidingTimeWindowReservoir(), mm.ExponentialDecayingReservoir(10)]
+
+    for reservoir in reservoirs:
+        nt.assert_equal(reservoir.totals(), (0, 0.0))
+
+        # beyond the reservoirs' size
+        for i in range(100):
+            reservoir.add(i)
+
+        nt.assert_equal(reservoir.totals(), (100, 4950.0))
+
+
+class TestIntervalRecorder(object):
+    def setUp(self):
+        self.state = random.getstate()
+        random.seed(42)
+
+        self.recorder = mm.IntervalRecorder(3)
+
+    def tearDown(self):
+        random.setstate(self.state)
+
+    def test_swap(self):
+        self.recorder.add(1.0)
+        self.recorder.add(2.0)
+
+        nt.assert_equal(self.recorder.swap(), [1.0, 2.0])
+        nt.assert_equal(self.recorder.swap(), [])
+
+        self.recorder.add(3.0)
+        nt.assert_equal(self.recorder.swap(), [3.0])
+
+    def test_add_overflow(self):
+        for i in range(10):
+            self.recorder.add(float(i))
+
+        nt.assert_equal(len(self.recorder.swap()), 3)
+        nt.assert_equal(self.recorder.count, 0)
+
+
 class TestHistogram(object):
     def setUp(self):
         self.reservoir = mock.Mock()
 
         self.histogram = mm.Histogram(self.reservoir)
 
+    def test_version(self):
+        nt.assert_equal(self.histogram.version, self.reservoir.version)
+
     def test_notify(self):
         result = self.histogram.notify(1.2)
         nt.assert_equal(
@@ -361,6 +488,9 @@ class TestHistogram(object):
             [mock.call(1.2)])
         nt.assert_equal(result, self.reservoir.add.return_value)
 
+    def test_totals(self):
+        nt.assert_equal(self.histogram.totals(), self.reservoir.totals.return_value)
+
     def test_raw_data(self):
         result = self.histogram.raw_data()
         nt.assert_equal(result, self.reservoir.values)
@@ -413,3 +543,132 @@ class TestHistogram(object):
         nt.assert_equal(res['histogram'], [(3.5, 6), (5.5, 1), (7.5, 0)])
         nt.assert_equal(res['n'], len(self.reservoir.sorted_values))
 
+
+    def test_get_with_fields(self):
+        self.histogram = mm.Histogram(self.reservoir, fields=['min', 'max', 'percentile'], percentiles=[50, 99])
+        self.reservoir.sorted_values = [1.5, 2.5, 2.5, 2.75, 3.25, 3.26, 4.75]
+
+        expected = dict(
+            kind="histogram",
+            min=1.5,
+            max=4.75,
+            percentile=[(50, 2.75), (99, 4.75)],
+            n=7)
+
+        nt.assert_equal(self.histogram.get(), expected)
+
+    @nt.raises(mm.exceptions.InvalidMetricError)
+    def test_bad_fields(self):
+        mm.Histogram(self.reservoir, fields=['min', 'xxx'])
+
+    @nt.raises(mm.exceptions.InvalidMetricError)
+    def test_bad_percentiles(self):
+        mm.Histogram(self.reservoir, percentiles=[50, 101])
+
+    def test_get_cached(self):
+        self.reservoir.version = 1
+        self.reservoir.sorted_values = [1.5, 2.5]
+
+        res = self.histogram.get()
+        self.reservoir.sorted_values = [1.5, 2.5, 3.5]
+
+        # same version, same values
+        nt.assert_equal(self.histogram.get(), res)
+
+        self.reservoir.version = 2
+        nt.assert_equal(self.histogram.get()['n'], 3)
+
+    def test_get_cached_is_a_copy(self):
+        self.reservoir.version = 1
+        self.reservoir.sorted_values = [1.5, 2.5]
+
+        self.histogram.get().pop('histogram')
+
+        nt.assert_in('histogram', self.histogram.get())
+
+    def test_get_cached_lists_are_copies(self):
+        self.reservoir.version = 1
+        self.reservoir.sorted_values = [1.5, 2.5]
+
+        res = self.histogram.get()
+        res['percentile'].append((100, 0))
+        res['histogram'][:] = []
+
+        res = self.histogram.get()
+        nt.assert_equal(len(res['percentile']), len(mm.DEFAULT_PERCENTILES))
+        nt.assert_not_equal(res['histogram'], [])
+
+    def test_get_without_version(self):
+        class Reservoir(mm.ReservoirBase):
+            def __init__(self):
+                self.data = []
+
+            def _do_add(self, value):
+                self.data.append(value)
+
+            def _get_values(self):
+                return list(self.data)
+
+            def _same_parameters(self, other):
+                return True
+
+        self.histogram = mm.Histogram(Reservoir(), fields=['max'])
+        nt.assert_is_none(self.histogram.version)
+
+        self.histogram.notify(1)
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=1, max=1))
+
+        # not cached
+        self.histogram.notify(2)
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=2, max=2))
+
+        nt.assert_is_none(self.histogram.totals())
+
+    def test_get_with_real_reservoir(self):
+        self.histogram = mm.Histogram(mm.SlidingWindowReservoir(3), fields=['max'])
+
+        self.histogram.notify(1)
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=1, max=1))
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=1, max=1))
+
+        self.histogram.notify(2)
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=2, max=2))
+
+    def test_get_interval(self):
+        self.histogram = mm.Histogram(mm.UniformReservoir(), fields=['min', 'max'])
+
+        self.histogram.notify(1)
+        nt.assert_equal(self.histogram.get_interval("a"), dict(kind="histogram", n=0, min=0, max=0))
+
+        self.histogram.notify(3)
+        self.histogram.notify(2)
+        nt.assert_equal(self.histogram.get_interval("a"), dict(kind="histogram", n=2, min=2, max=3))
+        nt.assert_equal(self.histogram.get_interval("b"), dict(kind="histogram", n=0, min=0, max=0))
+
+        self.histogram.notify(5)
+        nt.assert_equal(self.histogram.get_interval("a"), dict(kind="histogram", n=1, min=5, max=5))
+        nt.assert_equal(self.histogram.get_interval("b"), dict(kind="histogram", n=1, min=5, max=5))
+
+        # the cumulative values are not affected
+        nt.assert_equal(self.histogram.get(), dict(kind="histogram", n=4, min=1, max=5))
+
+    def test_release_interval(self):
+        self.histogram.get_interval("a")
+        nt.assert_in("a", self.histogram._recorders)
+
+        self.histogram.release_interval("a")
+        nt.assert_not_in("a", self.histogram._recorders)
+
+        # no errors
+        self.histogram.release_interval("a")
+
+    def test_sizeof(self):
+        self.reservoir.sizeof.return_value = 1000
+        self.reservoir.sorted_values = [1.0, 2.0]
+
+        size = self.histogram.sizeof()
+        nt.assert_greater(size, 1000)
+
+        self.histogram.get_interval("a")
+        self.histogram.get()
+        nt.assert_greater(self.histogram.sizeof(), size)
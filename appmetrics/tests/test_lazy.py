@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+from nose import tools as nt
+import mock
+
+from .. import lazy
+
+
+class TestLazyModule(object):
+    def setUp(self):
+        self.module = lazy.LazyModule("json", ["decoder"])
+
+    def test_not_loaded(self):
+        with mock.patch('appmetrics.lazy.importlib.import_module') as import_module:
+            lazy.LazyModule("json")
+            nt.assert_false(import_module.called)
+
+    def test_attribute(self):
+        import json, json.decoder
+
+        nt.assert_is(self.module.dumps, json.dumps)
+        nt.assert_is(self.module.decoder, json.decoder)
+        nt.assert_is(self.module._lazy_module, json)
+
+    @nt.raises(AttributeError)
+    def test_missing_attribute(self):
+        self.module.xxx
+
+    @nt.raises(ImportError)
+    def test_missing_module(self):
+        lazy.LazyModule("appmetrics.xxx").yyy
+
+    def test_patch(self):
+        with mock.patch.object(self.module, 'dumps', return_value="x"):
+            nt.assert_equal(self.module.dumps(1), "x")
+
+        nt.assert_equal(self.module.dumps(1), "1")
+
+
+def test_startup_imports():
+    script = "import sys, appmetrics.metrics, appmetrics.wsgi; print(sorted(set(sys.argv[1:]) & set(sys.modules)))"
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    output = subprocess.check_output(
+        [sys.executable, "-c", script, "werkzeug", "fractions", "decimal", "csv", "uuid"], cwd=root)
+
+    nt.assert_equal(output.decode("ascii").strip(), "[]")
@@ -0,0 +1,73 @@
+from nose.tools import assert_equal, assert_false, assert_is, assert_is_not, assert_is_instance
+import mock
+
+from .. import locks as mm, simple_metrics, meter, histogram
+
+
+def test_striped_lock():
+    first = mm.striped_lock()
+    others = [mm.striped_lock() for _ in range(mm.STRIPES - 1)]
+
+    assert_equal(len(set(id(x) for x in [first] + others)), mm.STRIPES)
+    assert_is(mm.striped_lock(), first)
+    assert_is_not(mm.striped_lock(), first)
+
+
+def test_striped_lock_timed():
+    # no observer: the timed locks are plain locks
+    assert_false(isinstance(mm.striped_lock(timed=True), mm.TimedLock))
+
+    with mock.patch('appmetrics.locks.WAIT_OBSERVER') as observer:
+        lock = mm.striped_lock(timed=True)
+        assert_is_instance(lock, mm.TimedLock)
+        assert_is(lock.observer, observer)
+
+        assert_false(isinstance(mm.striped_lock(), mm.TimedLock))
+
+
+class TestTimedLock(object):
+    def setUp(self):
+        self.manager = mock.Mock()
+        self.lock = mm.TimedLock(self.manager.lock, self.manager.observer)
+
+    def test_not_contended(self):
+        self.manager.lock.acquire.return_value = True
+
+        with self.lock:
+            pass
+
+        assert_equal(self.manager.mock_calls, [mock.call.lock.acquire(False), mock.call.lock.release()])
+
+    @mock.patch('appmetrics.locks.time.time')
+    def test_contended(self, time_):
+        time_.side_effect = [1.0, 3.5]
+        self.manager.lock.acquire.side_effect = [False, True]
+
+        with self.lock:
+            pass
+
+        # the observer is called after the release
+        assert_equal(
+            self.manager.mock_calls,
+            [mock.call.lock.acquire(False), mock.call.lock.acquire(), mock.call.lock.release(),
+             mock.call.observer(2.5)])
+
+        self.manager.reset_mock()
+        self.manager.lock.acquire.side_effect = None
+        self.manager.lock.acquire.return_value = True
+
+        with self.lock:
+            pass
+
+        assert_equal(self.manager.mock_calls, [mock.call.lock.acquire(False), mock.call.lock.release()])
+
+
+def test_slotted_metrics():
+    objects = [
+        simple_metrics.Counter(), simple_metrics.Gauge(), meter.Meter(), meter.EWMA(1, 5),
+        histogram.Histogram(histogram.UniformReservoir()), histogram.UniformReservoir(),
+        histogram.SlidingWindowReservoir(), histogram.SlidingTimeWindowReservoir(),
+        histogram.ExponentialDecayingReservoir(), histogram.IntervalRecorder()]
+
+    for obj in objects:
+        assert_false(hasattr(obj, '__dict__'), obj)
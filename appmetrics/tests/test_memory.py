@@ -0,0 +1,28 @@
+import collections
+import sys
+
+from nose import tools as nt
+
+from .. import memory as mm
+
+
+def test_sizeof_item():
+    nt.assert_equal(mm.sizeof_item(1.0), sys.getsizeof(1.0))
+    nt.assert_equal(mm.sizeof_item((1.0, 2.0)), sys.getsizeof((1.0, 2.0)) + 2 * sys.getsizeof(1.0))
+
+
+def test_sizeof_items():
+    values = [1.0, 2.0, 3.0]
+    nt.assert_equal(mm.sizeof_items(values), sys.getsizeof(values) + 3 * sys.getsizeof(1.0))
+    nt.assert_equal(mm.sizeof_items(values, 1), sys.getsizeof(values) + sys.getsizeof(1.0))
+    nt.assert_equal(mm.sizeof_items([]), sys.getsizeof([]))
+
+    values = collections.deque([(1.0, 2.0)])
+    nt.assert_equal(mm.sizeof_items(values), sys.getsizeof(values) + mm.sizeof_item((1.0, 2.0)))
+
+
+def test_sizeof_dict():
+    nt.assert_equal(mm.sizeof_dict(None), 0)
+
+    data = {"a": 1.0}
+    nt.assert_equal(mm.sizeof_dict(data), sys.getsizeof(data) + sys.getsizeof("a") + sys.getsizeof(1.0))
@@ -1,6 +1,6 @@
 import logging
 
-from nose.tools import assert_equal, assert_almost_equal, raises
+from nose.tools import assert_equal, assert_not_equal, assert_almost_equal, assert_greater, raises
 import mock
 
 from .. import meter as mm
@@ -52,8 +52,22 @@ class TestMeter(object):
         self.meter = mm.Meter()
         self.started_on = self.meter.started_on
 
-    def test_notify(self):
-        self.meter.tick = mock.Mock()
+    @mock.patch('appmetrics.meter.time.time')
+    def test_version(self, time_):
+        time_.return_value = self.started_on + 1
+        version = self.meter.version
+        assert_equal(version, self.meter.version)
+
+        self.meter.notify(1)
+        assert_not_equal(version, self.meter.version)
+
+        # the rates decay at each tick
+        version = self.meter.version
+        time_.return_value = self.started_on + mm.DEFAULT_TICK_INTERVAL
+        assert_not_equal(version, self.meter.version)
+
+    @mock.patch.object(mm.Meter, 'tick')
+    def test_notify(self, tick):
 
         self.meter.notify(1)
         assert_equal(self.meter.count, 1)
@@ -77,9 +91,9 @@ class TestMeter(object):
         assert_equal(self.meter.m15.tick.call_args_list, [[], [], []])
         assert_equal(self.meter.day.tick.call_args_list, [[], [], []])
 
+    @mock.patch.object(mm.Meter, 'tick_all')
     @mock.patch('appmetrics.meter.time')
-    def test_tick(self, time_mod):
-        self.meter.tick_all = mock.Mock()
+    def test_tick(self, time_mod, tick_all):
 
         time_mod.time.return_value = self.started_on + 2.0
         self.meter.tick()
@@ -96,8 +110,8 @@ class TestMeter(object):
         self.meter.count = 5
         assert_equal(self.meter.raw_data(), 5)
 
-    def test_get(self):
-        self.meter.tick = mock.Mock()
+    @mock.patch.object(mm.Meter, 'tick')
+    def test_get(self, tick):
 
         expected = dict(
             kind="meter",
@@ -112,6 +126,32 @@ class TestMeter(object):
         assert_equal(self.meter.get(), expected)
         assert_equal(self.meter.tick.call_args_list, [[]])
 
+    @mock.patch('appmetrics.meter.time')
+    def test_get_interval(self, time_mod):
+        time_mod.time.return_value = self.started_on + 1.0
+        self.meter.notify(4)
+
+        time_mod.time.return_value = self.started_on + 2.0
+        data = self.meter.get_interval("a")
+        assert_equal(data['count'], 4)
+        assert_almost_equal(data['mean'], 2.0)
+
+        self.meter.notify(3)
+
+        time_mod.time.return_value = self.started_on + 4.0
+        data = self.meter.get_interval("a")
+        assert_equal(data['count'], 3)
+        assert_almost_equal(data['mean'], 1.5)
+
+        data = self.meter.get_interval("b")
+        assert_equal(data['count'], 7)
+
+        # the cumulative values are not affected
+        assert_equal(self.meter.get()['count'], 7)
+
+        self.meter.release_interval("a")
+        assert_equal(self.meter.get_interval("a")['count'], 7)
+
     @mock.patch('appmetrics.meter.time')
     def test_functional(self, time_mod):
         # almost functional test, except for the time module patch trick, needed
@@ -141,6 +181,13 @@ class TestMeter(object):
             24, 24.0 / 300.1, 0.004392333437481882, 0.1037308440614258,
             0.16256923530491085, 0.19958359810087625)
 
+    def test_sizeof(self):
+        size = self.meter.sizeof()
+        assert_greater(size, 4 * self.meter.m1.sizeof())
+
+        self.meter.get_interval("a")
+        assert_greater(self.meter.sizeof(), size)
+
     def check(self, count, mean, one, five, fifteen, day):
         data = self.meter.get()
 
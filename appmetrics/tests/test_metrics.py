@@ -1,5 +1,8 @@
+import sys
+
 import mock
-from nose.tools import assert_equal, assert_in, raises, assert_is, assert_is_instance, assert_false, assert_true
+from nose.tools import assert_equal, assert_in, raises, assert_is, assert_is_instance, assert_false, assert_true, \
+    assert_greater
 
 from .. import metrics as mm, exceptions, histogram, simple_metrics as simple, meter
 
@@ -74,6 +77,30 @@ class TestMetricsModule(object):
             [mock.call(123)]
         )
 
+    def test_notify_many(self):
+        mm.REGISTRY = dict(test1=mock.Mock(), test2=mock.Mock())
+        mm.REGISTRY["test2"].notify.side_effect = ValueError("bad value")
+
+        errors = mm.notify_many([("test1", 1), ("test2", 2), ("test3", 3), ("test1", 4)])
+
+        assert_equal(
+            mm.REGISTRY["test1"].notify.call_args_list,
+            [mock.call(1), mock.call(4)])
+        assert_equal(errors, [(1, "ValueError: bad value"), (2, "Metric test3 not found!")])
+
+    def test_memory_report(self):
+        mm.REGISTRY = dict(test1=mock.Mock(), test2=mock.Mock(), test3=mock.Mock(), test4=object())
+        mm.REGISTRY["test1"].sizeof.return_value = 10
+        mm.REGISTRY["test2"].sizeof.return_value = 1000
+        mm.REGISTRY["test3"].sizeof.return_value = 10
+
+        report = mm.memory_report()
+
+        # the objects without sizeof() are measured by sys.getsizeof()
+        other = sys.getsizeof(mm.REGISTRY["test4"])
+        assert_greater(other, 10)
+        assert_equal(report, [("test2", 1000), ("test4", other), ("test1", 10), ("test3", 10)])
+
     @raises(exceptions.InvalidMetricError)
     def test_notify_not_existing(self):
         mm.REGISTRY = dict(test1=mock.Mock(), test2=mock.Mock())
@@ -126,6 +153,12 @@ class TestMetricsModule(object):
         assert_is_instance(metric.reservoir, histogram.UniformReservoir)
         assert_equal(metric.reservoir.size, 10)
 
+    def test_new_histogram_with_fields(self):
+        metric = mm.new_histogram("test", fields=['min'], percentiles=[90])
+
+        assert_equal(metric.fields, ('min',))
+        assert_equal(metric.percentiles, (90,))
+
     def test_new_counter(self):
         metric = mm.new_counter("test")
 
@@ -171,6 +204,13 @@ class TestMetricsModule(object):
         assert_is_instance(metric.reservoir, histogram.SlidingWindowReservoir)
         assert_equal(metric.reservoir.size, 5)
 
+    def test_new_histogram_with_implicit_reservoir_and_fields(self):
+        metric = mm.new_histogram_with_implicit_reservoir(
+            'test', 'sliding_window', 5, fields=['max', 'percentile'], percentiles=[99.9])
+        assert_equal(metric.reservoir.size, 5)
+        assert_equal(metric.fields, ('max', 'percentile'))
+        assert_equal(metric.percentiles, (99.9,))
+
     @mock.patch('appmetrics.metrics.time')
     def test_with_histogram(self, time):
         # emulate the time spent in the function by patching time.time() and returning
@@ -487,3 +527,37 @@ class TestMetricsModule(object):
 
         assert_equal(out, expected)
 
+    def test_iter_metrics_by_name_list(self):
+        mm.REGISTRY = dict(test1=mock.Mock(), test2=mock.Mock())
+        out = mm.iter_metrics_by_name_list(["test1", "xxx", "test2"])
+
+        # lazy
+        assert_false(mm.REGISTRY["test1"].get.called)
+        assert_equal(next(out), ("test1", mm.REGISTRY["test1"].get.return_value))
+        assert_false(mm.REGISTRY["test2"].get.called)
+        assert_equal(list(out), [("test2", mm.REGISTRY["test2"].get.return_value)])
+
+    def test_metrics_by_name_list_with_interval_key(self):
+        mm.REGISTRY = dict(test1=mock.Mock(), test2=mock.Mock(), test3=mock.Mock())
+        out = mm.metrics_by_name_list(["test1", "test3"], "key")
+        expected = {'test1': mm.REGISTRY["test1"].get_interval.return_value,
+                    'test3': mm.REGISTRY["test3"].get_interval.return_value}
+
+        assert_equal(out, expected)
+        assert_equal(mm.REGISTRY["test1"].get_interval.call_args_list, [mock.call("key")])
+
+    def test_get_interval(self):
+        mm.new_counter("test")
+        mm.notify("test", 2)
+
+        assert_equal(mm.get_interval("test", "key"), dict(kind="counter", value=2))
+        assert_equal(mm.get_interval("test", "key"), dict(kind="counter", value=0))
+
+    def test_release_interval(self):
+        m1, m2 = mock.Mock(), mock.Mock()
+        mm.REGISTRY = dict(test1=m1, test2=m2)
+
+        mm.release_interval("key")
+
+        assert_equal(m1.release_interval.call_args_list, [mock.call("key")])
+        assert_equal(m2.release_interval.call_args_list, [mock.call("key")])
@@ -0,0 +1,349 @@
+import os
+import shutil
+import tempfile
+
+from nose import tools as nt
+from nose import SkipTest
+import mock
+
+from .. import multiprocess as mm, metrics, exceptions
+
+
+class MultiProcessTestCase(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_directory = mm.DIRECTORY
+        mm.enable(self.tmpdir)
+
+        # scan the directory at each read
+        self.refresh_interval_patcher = mock.patch('appmetrics.multiprocess.REFRESH_INTERVAL', 0)
+        self.refresh_interval_patcher.start()
+
+        self.pid = 100
+        self.getpid_patcher = mock.patch('appmetrics.multiprocess.os.getpid', lambda: self.pid)
+        self.getpid_patcher.start()
+
+    def tearDown(self):
+        self.getpid_patcher.stop()
+        self.refresh_interval_patcher.stop()
+
+        for values in mm.FILES.values():
+            values.close()
+        mm.FILES, mm.FILES_PID = {}, None
+        mm.COLLECTOR = None
+        mm.DIRECTORY = self.old_directory
+
+        shutil.rmtree(self.tmpdir)
+
+
+class TestEnable(MultiProcessTestCase):
+    @nt.raises(ValueError)
+    def test_missing_directory(self):
+        mm.enable(os.path.join(self.tmpdir, "xxx"))
+
+    @mock.patch.dict(os.environ, clear=True)
+    @nt.raises(ValueError)
+    def test_no_directory(self):
+        mm.enable()
+
+    def test_environment(self):
+        with mock.patch.dict(os.environ, {mm.DIRECTORY_ENV: self.tmpdir}):
+            mm.DIRECTORY = None
+            nt.assert_equal(mm.get_directory(), self.tmpdir)
+
+
+class TestValuesFile(MultiProcessTestCase):
+    def test_read_write(self):
+        values = mm.ValuesFile(os.path.join(self.tmpdir, "values_1.db"))
+
+        nt.assert_equal(values.read("a"), 0.0)
+        values.write("a", 1.5)
+        nt.assert_equal(values.add("a", 2), 3.5)
+        nt.assert_equal(values.add(u"\xe8", 1), 1.0)
+        values.close()
+
+        reader = mm.ValuesReader(os.path.join(self.tmpdir, "values_1.db"))
+        reader.refresh()
+        nt.assert_equal(reader.get("a"), 3.5)
+        nt.assert_equal(reader.get(u"\xe8"), 1.0)
+        nt.assert_is_none(reader.get("b"))
+        reader.close()
+
+    def test_reopen(self):
+        file_name = os.path.join(self.tmpdir, "values_1.db")
+        values = mm.ValuesFile(file_name)
+        values.write("a", 1.0)
+        values.close()
+
+        values = mm.ValuesFile(file_name)
+        nt.assert_equal(values.add("a", 1), 2.0)
+        values.close()
+
+    def test_grow(self):
+        file_name = os.path.join(self.tmpdir, "values_1.db")
+        values = mm.ValuesFile(file_name)
+        reader = mm.ValuesReader(file_name)
+        reader.refresh()
+
+        for i in range(5000):
+            values.write("key_{}".format(i), i)
+
+        nt.assert_true(os.path.getsize(file_name) > mm.INITIAL_FILE_SIZE)
+
+        reader.refresh()
+        nt.assert_equal(reader.get("key_0"), 0)
+        nt.assert_equal(reader.get("key_4999"), 4999)
+
+        values.close()
+        reader.close()
+
+
+class TestCollector(MultiProcessTestCase):
+    @mock.patch('appmetrics.multiprocess.time.time')
+    def test_refresh_interval(self, time_):
+        time_.return_value = 1000
+        collector = mm.Collector(self.tmpdir, refresh_interval=1)
+
+        mm.values_file(mm.VALUES).add("a", 1)
+        nt.assert_equal(collector.values(mm.VALUES, ["a", "b"]), {100: dict(a=1.0, b=None)})
+
+        # the known values are read live, the new ones wait for the next scan
+        mm.values_file(mm.VALUES).add("a", 1)
+        mm.values_file(mm.VALUES).add("b", 1)
+        self.pid = 101
+        mm.values_file(mm.VALUES).add("a", 5)
+
+        with mock.patch('appmetrics.multiprocess.os.listdir', wraps=os.listdir) as listdir:
+            time_.return_value = 1000.5
+            nt.assert_equal(collector.values(mm.VALUES, ["a", "b"]), {100: dict(a=2.0, b=None)})
+            nt.assert_equal(listdir.call_count, 0)
+
+            time_.return_value = 1001
+            nt.assert_equal(
+                collector.values(mm.VALUES, ["a", "b"]),
+                {100: dict(a=2.0, b=1.0), 101: dict(a=5.0, b=None)})
+            nt.assert_equal(listdir.call_count, 1)
+
+
+class TestMultiProcessCounter(MultiProcessTestCase):
+    def setUp(self):
+        super(TestMultiProcessCounter, self).setUp()
+        self.counter = mm.MultiProcessCounter("test")
+
+    def test_notify(self):
+        self.counter.notify(2)
+        self.pid = 101
+        self.counter.notify(3)
+        self.counter.notify(-1)
+
+        nt.assert_equal(self.counter.get(), dict(kind="counter", value=4))
+        nt.assert_equal(sorted(os.listdir(self.tmpdir)), ["values_100.db", "values_101.db"])
+
+    def test_empty(self):
+        nt.assert_equal(self.counter.get(), dict(kind="counter", value=0))
+
+    def test_interval(self):
+        self.counter.notify(2)
+        nt.assert_equal(self.counter.get_interval("k")['value'], 2)
+
+        self.pid = 101
+        self.counter.notify(3)
+        nt.assert_equal(self.counter.get_interval("k")['value'], 3)
+
+        self.counter.release_interval("k")
+        nt.assert_equal(self.counter.get_interval("k")['value'], 5)
+
+    def test_dead_process(self):
+        self.counter.notify(2)
+        mm.mark_process_dead(100)
+
+        nt.assert_equal(self.counter.get()['value'], 2)
+
+    def test_fork(self):
+        if not hasattr(os, "fork"):
+            raise SkipTest("fork is not available")
+
+        self.getpid_patcher.stop()
+        try:
+            self.counter.notify(1)
+
+            pid = os.fork()
+            if not pid:
+                try:
+                    self.counter.notify(10)
+                finally:
+                    os._exit(0)
+
+            os.waitpid(pid, 0)
+            self.counter.notify(1)
+
+            nt.assert_equal(self.counter.get()['value'], 12)
+        finally:
+            self.getpid_patcher.start()
+
+
+class TestMultiProcessGauge(MultiProcessTestCase):
+    @mock.patch('appmetrics.multiprocess.time.time')
+    def test_modes(self, time_):
+        gauges = dict((x, mm.MultiProcessGauge("test_{}".format(x), x)) for x in mm.GAUGE_MODES)
+
+        for pid, value in ((100, 3), (101, 1), (102, 2)):
+            self.pid = pid
+            time_.return_value = pid
+            for gauge in gauges.values():
+                gauge.notify(value)
+
+        nt.assert_equal(
+            dict((k, v.get()['value']) for k, v in gauges.items()),
+            dict(last=2, sum=6, min=1, max=3))
+
+    def test_empty(self):
+        nt.assert_equal(mm.MultiProcessGauge("test").get(), dict(kind="gauge", value=None))
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_invalid_mode(self):
+        mm.MultiProcessGauge("test", "xxx")
+
+    @nt.raises(ValueError)
+    def test_not_numeric(self):
+        mm.MultiProcessGauge("test").notify("xxx")
+
+    def test_dead_process(self):
+        gauge = mm.MultiProcessGauge("test", "sum")
+        gauge.notify(1)
+        self.pid = 101
+        gauge.notify(2)
+
+        mm.mark_process_dead(101)
+        nt.assert_equal(gauge.get()['value'], 1)
+
+        # no error for unknown processes
+        mm.mark_process_dead(101)
+
+
+class TestMultiProcessMeter(MultiProcessTestCase):
+    @mock.patch('appmetrics.multiprocess.time.time')
+    def test_notify(self, time_):
+        time_.return_value = 1000
+        meter = mm.MultiProcessMeter("test")
+
+        meter.notify(3)
+        self.pid = 101
+        meter.notify(2)
+
+        time_.return_value = 1010
+        meter.notify(1)
+
+        data = meter.get()
+        nt.assert_equal(data['count'], 6)
+        nt.assert_is_instance(data['count'], int)
+        nt.assert_almost_equal(data['mean'], 0.6)
+
+        # only the process 101 ticked, twice
+        nt.assert_almost_equal(data['one'], 0.4 * mm.math.exp(-5 / 60.0))
+
+    @mock.patch('appmetrics.multiprocess.time.time')
+    def test_decay(self, time_):
+        time_.return_value = 1000
+        meter = mm.MultiProcessMeter("test")
+
+        meter.notify(5)
+        time_.return_value = 1005.5
+        meter.notify(1)
+        nt.assert_almost_equal(meter.get()['one'], 1.0)
+
+        time_.return_value = 1065.5
+        nt.assert_almost_equal(meter.get()['one'], 1.0 * mm.math.exp(-1))
+
+    def test_interval(self):
+        meter = mm.MultiProcessMeter("test")
+        meter.notify(3)
+        nt.assert_equal(meter.get_interval("k")['count'], 3)
+
+        self.pid = 101
+        meter.notify(1)
+        nt.assert_equal(meter.get_interval("k")['count'], 1)
+
+        meter.release_interval("k")
+        nt.assert_equal(meter.get_interval("k")['count'], 4)
+
+
+class TestMultiProcessHistogram(MultiProcessTestCase):
+    def setUp(self):
+        super(TestMultiProcessHistogram, self).setUp()
+        self.histogram = mm.MultiProcessHistogram("test", [1, 2, 5], percentiles=[50, 100])
+
+    def test_notify(self):
+        for value in (0.5, 1.5, 1.5):
+            self.histogram.notify(value)
+        self.pid = 101
+        for value in (3, 10):
+            self.histogram.notify(value)
+
+        data = self.histogram.get()
+        nt.assert_equal(data['kind'], "histogram")
+        nt.assert_equal(data['n'], 5)
+        nt.assert_equal(data['min'], 0.5)
+        nt.assert_equal(data['max'], 10)
+        nt.assert_almost_equal(data['arithmetic_mean'], 16.5 / 5)
+        nt.assert_equal(data['histogram'], [(1, 1), (2, 2), (5, 1), (10, 1)])
+        nt.assert_equal(data['percentile'], [(50, 1.75), (100, 10)])
+
+    def test_empty(self):
+        data = self.histogram.get()
+        nt.assert_equal(data['n'], 0)
+        nt.assert_equal(data['percentile'], [(50, 0.0), (100, 0.0)])
+        nt.assert_equal(data['histogram'], [(0, 0)])
+
+    def test_buckets(self):
+        nt.assert_equal(self.histogram.buckets, (1, 2, 5, float("inf")))
+        nt.assert_equal(mm.MultiProcessHistogram("test", mm.DEFAULT_BUCKETS).buckets, mm.DEFAULT_BUCKETS)
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_unsorted_buckets(self):
+        mm.MultiProcessHistogram("test", [2, 1])
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_invalid_percentiles(self):
+        mm.MultiProcessHistogram("test", percentiles=[0])
+
+    def test_interval(self):
+        self.histogram.notify(1.5)
+        nt.assert_equal(self.histogram.get_interval("k")['n'], 1)
+
+        self.pid = 101
+        self.histogram.notify(3)
+        self.histogram.notify(4)
+        data = self.histogram.get_interval("k")
+        nt.assert_equal(data['n'], 2)
+        nt.assert_equal(data['arithmetic_mean'], 3.5)
+        nt.assert_equal(data['histogram'], [(4, 2)])
+
+        self.histogram.release_interval("k")
+        nt.assert_equal(self.histogram.get_interval("k")['n'], 3)
+
+
+class TestRegistry(MultiProcessTestCase):
+    def setUp(self):
+        super(TestRegistry, self).setUp()
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+        super(TestRegistry, self).tearDown()
+
+    def test_new_metrics(self):
+        nt.assert_is_instance(mm.new_counter("c"), mm.MultiProcessCounter)
+        nt.assert_is_instance(mm.new_gauge("g", "sum"), mm.MultiProcessGauge)
+        nt.assert_is_instance(mm.new_meter("m"), mm.MultiProcessMeter)
+        nt.assert_is_instance(mm.new_histogram("h", [1]), mm.MultiProcessHistogram)
+
+        metrics.notify("c", 2)
+        nt.assert_equal(metrics.get("c")['value'], 2)
+
+    @nt.raises(exceptions.DuplicateMetricError)
+    def test_duplicate(self):
+        mm.new_counter("c")
+        mm.new_counter("c")
@@ -0,0 +1,232 @@
+import collections
+import sys
+import threading
+import time
+
+from nose import tools as nt
+import mock
+
+from .. import profiling as mm, metrics, histogram, exceptions
+
+
+class TestProfilers(object):
+    def setUp(self):
+        self.patch = mock.patch('appmetrics.profiling.PROFILERS', {})
+        self.patch.start()
+
+        self.histogram = mock.Mock()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_get_or_create_profiler(self):
+        profiler = mm.get_or_create_profiler("test", self.histogram, 99)
+
+        nt.assert_is(profiler.histogram, self.histogram)
+        nt.assert_equal(profiler.percentile, 99)
+        nt.assert_is(mm.get_or_create_profiler("test", self.histogram, 99), profiler)
+        nt.assert_equal(mm.profiled(), ["test"])
+
+    def test_get_or_create_profiler_new_histogram(self):
+        profiler = mm.get_or_create_profiler("test", self.histogram, 99)
+
+        nt.assert_is_not(mm.get_or_create_profiler("test", mock.Mock(), 90), profiler)
+
+    @nt.raises(exceptions.DuplicateMetricError)
+    def test_get_or_create_profiler_different_percentile(self):
+        mm.get_or_create_profiler("test", self.histogram, 99)
+        mm.get_or_create_profiler("test", self.histogram, 90)
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_get_or_create_profiler_bad_percentile(self):
+        mm.get_or_create_profiler("test", self.histogram, 0)
+
+    def test_profiles(self):
+        profiler = mm.get_or_create_profiler("test", self.histogram, 99)
+        profiler.captures.extend([1, 2])
+
+        nt.assert_equal(mm.profiles("test"), [2, 1])
+
+    @nt.raises(exceptions.InvalidMetricError)
+    def test_profiles_not_found(self):
+        mm.profiles("test")
+
+    def test_remove(self):
+        profiler = mm.get_or_create_profiler("test", self.histogram, 99)
+
+        nt.assert_is(mm.remove("test"), profiler)
+        nt.assert_is_none(mm.remove("test"))
+        nt.assert_equal(mm.profiled(), [])
+
+
+class TestProfiler(object):
+    def setUp(self):
+        self.reservoir = histogram.UniformReservoir()
+        self.profiler = mm.Profiler(histogram.Histogram(self.reservoir), 90, capacity=2)
+
+        self.sampler = mock.Mock()
+        self.patch = mock.patch('appmetrics.profiling.SAMPLER', self.sampler)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_threshold(self):
+        for i in range(mm.MIN_VALUES - 1):
+            self.reservoir.add(i)
+
+        nt.assert_is_none(self.profiler.get_threshold(1))
+        nt.assert_is_none(self.profiler.start())
+
+        self.reservoir.add(100)
+        nt.assert_equal(self.profiler.get_threshold(1), 89)
+
+        # cached
+        for i in range(100):
+            self.reservoir.add(1000)
+        nt.assert_equal(self.profiler.get_threshold(1 + mm.THRESHOLD_TTL / 2), 89)
+        nt.assert_equal(self.profiler.get_threshold(1 + mm.THRESHOLD_TTL), 1000)
+
+    @mock.patch('appmetrics.profiling.time.time')
+    def test_start(self, time_):
+        time_.return_value = 10
+        for i in range(mm.MIN_VALUES):
+            self.reservoir.add(i)
+
+        call = self.profiler.start()
+
+        nt.assert_equal(self.sampler.add.call_args_list, [mock.call(call)])
+        nt.assert_equal((call.start, call.deadline), (10, 99))
+        nt.assert_equal(call.thread_id, threading.current_thread().ident)
+        nt.assert_equal(call.frame.f_code.co_name, "test_start")
+
+    def test_finish_not_sampled(self):
+        call = mm.Call(1, sys._getframe(), 10, 11)
+
+        self.profiler.finish(call, 2)
+
+        nt.assert_equal(self.sampler.discard.call_args_list, [mock.call(call)])
+        nt.assert_is_none(call.frame)
+        nt.assert_equal(self.profiler.get(), [])
+
+    def test_finish(self):
+        for i in range(3):
+            call = mm.Call(1, None, 10 + i, 11 + i)
+            call.samples = collections.Counter({(("a.py", 1, "f"), ("b.py", 2, "g")): 3, (("a.py", 1, "f"),): 1})
+            self.profiler.finish(call, 2 + i)
+
+        # bounded, the latest first
+        profiles = self.profiler.get()
+        nt.assert_equal([x['time'] for x in profiles], [12, 11])
+        nt.assert_equal(profiles[0], dict(
+            time=12, duration=4, threshold=1, samples=4,
+            stacks=[
+                dict(count=3, frames=["f (a.py:1)", "g (b.py:2)"]),
+                dict(count=1, frames=["f (a.py:1)"])]))
+
+
+def outer(call):
+    return inner(call)
+
+
+def inner(call):
+    for _ in range(2):
+        call.sample(sys._getframe())
+
+
+class TestCall(object):
+    def test_sample(self):
+        call = mm.Call(1, sys._getframe(), 0, 0)
+        outer(call)
+
+        nt.assert_equal(list(call.samples.values()), [2])
+
+        stack = list(call.samples)[0]
+        nt.assert_equal([x[2] for x in stack], ["outer", "inner"])
+        nt.assert_equal(stack[0][0], __file__.replace(".pyc", ".py"))
+
+    def test_sample_call_over(self):
+        call = mm.Call(1, mock.Mock(), 0, 0)
+        call.sample(sys._getframe())
+
+        nt.assert_is_none(call.samples)
+
+
+class TestSampler(object):
+    def setUp(self):
+        self.sampler = mm.Sampler(interval=0.5)
+
+    def test_sample_no_calls(self):
+        nt.assert_is_none(self.sampler.sample(10))
+
+    def test_sample(self):
+        calls = [mock.Mock(deadline=5, thread_id=1), mock.Mock(deadline=12, thread_id=2)]
+        for call in calls:
+            self.sampler.add(call)
+
+        # the first deadline is waited for
+        nt.assert_equal(self.sampler.sample(4), 1)
+        nt.assert_false(calls[0].sample.called)
+
+        nt.assert_equal(self.sampler.sample(10), 0.5)
+        nt.assert_equal(calls[0].sample.call_count, 1)
+        nt.assert_false(calls[1].sample.called)
+
+        nt.assert_equal(self.sampler.sample(12), 0.5)
+        nt.assert_equal(calls[1].sample.call_count, 1)
+
+        for call in calls:
+            self.sampler.discard(call)
+        nt.assert_is_none(self.sampler.sample(12))
+
+    def test_wakeup(self):
+        self.sampler._wakeup.clear()
+        self.sampler.add(mock.Mock(deadline=5))
+        nt.assert_true(self.sampler._wakeup.is_set())
+
+        self.sampler._wakeup.clear()
+        self.sampler.add(mock.Mock(deadline=5))
+        nt.assert_false(self.sampler._wakeup.is_set())
+
+
+class TestWithHistogram(object):
+    def setUp(self):
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+
+        self.patch = mock.patch('appmetrics.profiling.PROFILERS', {})
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+
+    @mock.patch('appmetrics.profiling.MIN_VALUES', 10)
+    def test_profile(self):
+        @metrics.with_histogram("test", profile=50)
+        def work(seconds):
+            time.sleep(seconds)
+
+        for i in range(10):
+            work(0)
+        work(0.2)
+
+        profiles = mm.profiles("test")
+        nt.assert_equal(len(profiles), 1)
+        nt.assert_greater(profiles[0]['samples'], 0)
+        nt.assert_equal(profiles[0]['stacks'][0]['frames'][0].split()[0], "work")
+        nt.assert_equal(metrics.get("test")['n'], 11)
+
+    def test_profile_error(self):
+        @metrics.with_histogram("test", profile=50)
+        def work():
+            raise ValueError()
+
+        with mock.patch.object(mm.Profiler, 'finish') as finish:
+            with mock.patch.object(mm.Profiler, 'start') as start:
+                nt.assert_raises(ValueError, work)
+
+        nt.assert_equal(finish.call_args[0][0], start.return_value)
+        nt.assert_equal(metrics.get("test")['n'], 0)
@@ -0,0 +1,138 @@
+import mock
+from nose import tools as nt
+
+from .. import prometheus as mm, metrics, histogram
+
+
+class TestRenderMetric(object):
+    def test_metric_name(self):
+        nt.assert_equal(mm.metric_name("a.b-c:d_e"), "a_b_c:d_e")
+        nt.assert_equal(mm.metric_name("1abc"), "_1abc")
+        nt.assert_equal(mm.metric_name(""), "_")
+
+    def test_format_value(self):
+        nt.assert_equal(mm.format_value(3), "3")
+        nt.assert_equal(mm.format_value(True), "1")
+        nt.assert_equal(mm.format_value(1.5), "1.5")
+        nt.assert_equal(mm.format_value(float("nan")), "NaN")
+        nt.assert_equal(mm.format_value(float("-inf")), "-Inf")
+        nt.assert_is_none(mm.format_value("xxx"))
+        nt.assert_is_none(mm.format_value(None))
+
+    def test_counter(self):
+        nt.assert_equal(
+            mm.render_metric("c.1", dict(kind="counter", value=-2)),
+            "# HELP c_1 appmetrics counter c.1\n"
+            "# TYPE c_1 gauge\n"
+            "c_1 -2\n")
+
+    def test_gauge_not_numeric(self):
+        nt.assert_equal(mm.render_metric("g1", dict(kind="gauge", value="xxx")), "")
+
+    def test_meter(self):
+        text = mm.render_metric("m1", dict(kind="meter", count=3, mean=1.0, one=0.5, five=0.25, fifteen=0, day=0))
+
+        nt.assert_equal(text.splitlines(), [
+            "# HELP m1_total appmetrics meter m1",
+            "# TYPE m1_total counter",
+            "m1_total 3",
+            "# HELP m1_rate appmetrics meter m1",
+            "# TYPE m1_rate gauge",
+            'm1_rate{window="mean"} 1.0',
+            'm1_rate{window="1m"} 0.5',
+            'm1_rate{window="5m"} 0.25',
+            'm1_rate{window="15m"} 0',
+            'm1_rate{window="1d"} 0'])
+
+    def test_histogram(self):
+        text = mm.render_metric("h1", dict(
+            kind="histogram", n=4, min=1, max=4, arithmetic_mean=2.5, histogram=[(4, 4)],
+            percentile=[(50, 2), (99.9, 4)]))
+
+        nt.assert_equal(text.splitlines(), [
+            "# HELP h1 appmetrics histogram h1",
+            "# TYPE h1 summary",
+            'h1{quantile="0.5"} 2',
+            'h1{quantile="0.999"} 4',
+            "h1_sum 10.0",
+            "h1_count 4",
+            "# HELP h1_min appmetrics histogram h1",
+            "# TYPE h1_min gauge",
+            "h1_min 1",
+            "# HELP h1_max appmetrics histogram h1",
+            "# TYPE h1_max gauge",
+            "h1_max 4"])
+
+    def test_histogram_fields(self):
+        text = mm.render_metric("h1", dict(kind="histogram", n=0))
+        nt.assert_equal(text.splitlines()[2:], ["h1_count 0"])
+
+    def test_histogram_totals(self):
+        text = mm.render_metric("h1", dict(kind="histogram", n=2, arithmetic_mean=1.5), (10, 12.5))
+        nt.assert_equal(text.splitlines()[2:], ["h1_sum 12.5", "h1_count 10"])
+
+    def test_unknown(self):
+        nt.assert_equal(mm.render_metric("x", dict(kind="xxx")), "")
+
+    def test_escape(self):
+        nt.assert_equal(mm.escape("a\\b\nc"), "a\\\\b\\nc")
+
+
+class TestRenderer(object):
+    def setUp(self):
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+
+    def test_render(self):
+        metrics.new_counter("b").notify(1)
+        metrics.new_gauge("a").notify(2)
+        metrics.new_gauge("a.b")
+        metrics.new_gauge("a_b").notify(3)
+
+        nt.assert_equal("".join(mm.Renderer()()).splitlines(), [
+            "# HELP a appmetrics gauge a", "# TYPE a gauge", "a 2",
+            "# HELP b appmetrics counter b", "# TYPE b gauge", "b 1"])
+
+    def test_render_histogram_totals(self):
+        h1 = metrics.new_histogram("h1", histogram.UniformReservoir(10))
+        for i in range(1000):
+            h1.notify(1)
+
+        lines = "".join(mm.Renderer()()).splitlines()
+        nt.assert_in("h1_count 1000", lines)
+        nt.assert_in("h1_sum 1000.0", lines)
+
+    @mock.patch('appmetrics.prometheus.log')
+    def test_render_error(self, log):
+        metrics.new_counter("b")
+        metrics.REGISTRY["a"] = mock.Mock(**{'get.side_effect': ValueError()})
+
+        nt.assert_equal(len(list(mm.Renderer()())), 1)
+        nt.assert_equal(log.debug.call_count, 1)
+
+    @mock.patch('appmetrics.prometheus.time.time')
+    def test_cache(self, time_):
+        time_.return_value = 1000
+        counter = metrics.new_counter("c")
+        renderer = mm.Renderer(ttl=5)
+
+        first = "".join(renderer())
+        counter.notify(1)
+
+        time_.return_value = 1004.9
+        nt.assert_equal("".join(renderer()), first)
+
+        time_.return_value = 1005
+        nt.assert_not_equal("".join(renderer()), first)
+
+    def test_no_cache(self):
+        counter = metrics.new_counter("c")
+        renderer = mm.Renderer(ttl=0)
+
+        first = "".join(renderer())
+        counter.notify(1)
+        nt.assert_not_equal("".join(renderer()), first)
@@ -1,13 +1,19 @@
 import csv
+import io
+import collections
+import errno
 import os
 import time
 import tempfile
 import shutil
+import socket
+import threading
 
 from nose import tools as nt
+from nose import SkipTest
 import mock
 
-from .. import reporter as mm, metrics, py3comp
+from .. import reporter as mm, metrics, py3comp, selfmetrics
 
 
 class TestReporter(object):
@@ -27,8 +33,9 @@ class TestReporter(object):
     def test_register_invalid_callback(self):
         mm.register(None, [1])
 
+    @mock.patch('appmetrics.reporter.get_scheduler')
     @mock.patch('appmetrics.reporter.Timer')
-    def test_register(self, timer):
+    def test_register(self, timer, get_scheduler):
         callback = mock.Mock()
         schedule = mock.MagicMock()
         tag = mock.Mock()
@@ -39,13 +46,14 @@ class TestReporter(object):
         nt.assert_equal(list(mm.REGISTRY.values())[0], timer.return_value)
         nt.assert_equal(
             timer.call_args_list,
-            [mock.call(schedule, callback, tag)])
+            [mock.call(schedule, callback, tag, None)])
         nt.assert_equal(
-            timer.return_value.start.call_args_list,
-            [mock.call()])
+            get_scheduler.return_value.add.call_args_list,
+            [mock.call(timer.return_value)])
 
+    @mock.patch('appmetrics.reporter.get_scheduler')
     @mock.patch('appmetrics.reporter.Timer')
-    def test_register_with_default_tag(self, timer):
+    def test_register_with_default_tag(self, timer, get_scheduler):
         callback = mock.Mock()
         schedule = mock.MagicMock()
 
@@ -55,10 +63,33 @@ class TestReporter(object):
         nt.assert_equal(list(mm.REGISTRY.values())[0], timer.return_value)
         nt.assert_equal(
             timer.call_args_list,
-            [mock.call(schedule, callback, None)])
+            [mock.call(schedule, callback, None, None)])
         nt.assert_equal(
-            timer.return_value.start.call_args_list,
-            [mock.call()])
+            get_scheduler.return_value.add.call_args_list,
+            [mock.call(timer.return_value)])
+
+    @mock.patch('appmetrics.reporter.get_scheduler')
+    @mock.patch('appmetrics.reporter.Timer')
+    def test_register_interval(self, timer, get_scheduler):
+        callback = mock.Mock()
+        schedule = mock.MagicMock()
+
+        id_ = mm.register(callback, schedule, interval=True)
+
+        nt.assert_equal(
+            timer.call_args_list,
+            [mock.call(schedule, callback, None, id_)])
+
+    @mock.patch('appmetrics.reporter.metrics.release_interval')
+    def test_remove_interval(self, release_interval):
+        m1 = mock.Mock(interval_key='m1')
+        mm.REGISTRY = {'m1': m1}
+
+        mm.remove('m1')
+
+        nt.assert_equal(
+            release_interval.call_args_list,
+            [mock.call('m1')])
 
     def test_get(self):
         mm.REGISTRY = {'m1': mock.Mock(), 'm2': mock.Mock()}
@@ -79,6 +110,14 @@ class TestReporter(object):
             m1.cancel.call_args_list,
             [mock.call()])
 
+    @mock.patch('appmetrics.reporter.SCHEDULER')
+    def test_remove_snapshot(self, scheduler):
+        mm.REGISTRY = {'m1': mock.Mock(tag="tag1")}
+
+        mm.remove('m1')
+
+        nt.assert_equal(scheduler.snapshots.discard.call_args_list, [mock.call("tag1")])
+
     def test_remove_not_found(self):
         m1 = mock.Mock()
         m2 = mock.Mock()
@@ -97,7 +136,8 @@ class TestReporter(object):
         nt.assert_almost_equal(next(sched), now+20, 0)
         nt.assert_almost_equal(next(sched), now+30, 0)
 
-    def test_cleanup(self):
+    @mock.patch('appmetrics.reporter.SCHEDULER')
+    def test_cleanup(self, scheduler):
         m1 = mock.Mock()
         m2 = mock.Mock()
 
@@ -105,6 +145,10 @@ class TestReporter(object):
 
         mm.cleanup()
 
+        nt.assert_equal(
+            scheduler.stop.call_args_list,
+            [mock.call()])
+
         nt.assert_equal(
             m1.cancel.call_args_list,
             [mock.call()])
@@ -114,49 +158,57 @@ class TestReporter(object):
             [mock.call()])
 
 
-class TimeMachine(object):
-    """
-    Helper class to "emulate" the time
-    """
-    def __init__(self):
-        self.current_time = 0
-        self.sleeps = []
+class TestTimer(object):
+    def setUp(self):
+        self.callback = mock.Mock()
 
-    def time(self):
-        self.current_time += 1
-        return self.current_time - 1
+    def test_next_tick(self):
+        tt = mm.Timer([3, 5, 8, 13], self.callback)
 
-    def sleep(self, how_much):
-        self.current_time += how_much
-        self.sleeps.append(how_much)
+        nt.assert_equal(tt.next_tick(0), 3)
+        # skip the already passed ticks
+        nt.assert_equal(tt.next_tick(6), 8)
+        nt.assert_equal(tt.next_tick(8), 13)
+        nt.assert_is_none(tt.next_tick(8))
 
+    def test_cancel(self):
+        tt = mm.Timer([3], self.callback)
+        tt.scheduler = mock.Mock()
 
-class TestTimer(object):
-    def setUp(self):
-        self.time_patch = mock.patch('appmetrics.reporter.time', TimeMachine())
-        self.time = self.time_patch.start()
+        nt.assert_true(tt.is_running)
+
+        tt.cancel()
 
+        nt.assert_false(tt.is_running)
+        nt.assert_equal(tt.scheduler.wakeup.call_args_list, [mock.call()])
+
+
+class TestScheduler(object):
+    def setUp(self):
         self.get_metrics_patch = mock.patch('appmetrics.reporter.get_metrics')
         self.get_metrics = self.get_metrics_patch.start()
 
+        self.get_metrics.return_value = {'m1': {'kind': 'counter', 'value': 1}}
+
         self.callback = mock.Mock()
 
         self.tag = "test"
 
+        self.scheduler = mm.Scheduler(snapshots=mm.SnapshotCoordinator())
+
     def tearDown(self):
-        self.time_patch.stop()
         self.get_metrics_patch.stop()
 
     def test_finite_scheduler(self):
-        def scheduler():
-            yield 3
-            yield 5
-            yield 8
-
-        tt = mm.Timer(scheduler(), self.callback, self.tag)
-        tt.start()
+        tt = mm.Timer([3, 5, 8], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
 
-        tt.join()
+        nt.assert_equal(self.scheduler.run_pending(1), 2)
+        nt.assert_equal(self.scheduler.run_pending(3), 0)
+        nt.assert_equal(self.scheduler.run_pending(3), 2)
+        nt.assert_equal(self.scheduler.run_pending(5), 0)
+        nt.assert_equal(self.scheduler.run_pending(8), 0)
+        nt.assert_is_none(self.scheduler.run_pending(8))
 
         nt.assert_false(tt.is_running)
 
@@ -169,42 +221,311 @@ class TestTimer(object):
             ]
         )
 
-        nt.assert_equal(self.time.current_time, 10)
-        nt.assert_equal(self.time.sleeps, [3, 1, 2])
+    def test_read_only_snapshot(self):
+        tt = mm.Timer([3], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
+        self.scheduler.run_pending(3)
 
-    def test_infinite_scheduler(self):
+        data = self.callback.call_args[0][0]
+        nt.assert_raises(TypeError, data.pop, 'm1')
+        nt.assert_raises(TypeError, data['m1'].pop, 'kind')
+
+    def test_skip_passed_ticks(self):
         tt = mm.Timer(mm.fixed_interval_scheduler(10), self.callback, self.tag)
+        now = next(tt.schedule)
+        self.scheduler.add(tt, now)
 
-        # trick: when the time is >= 1000 call tt.cancel(), else it would run forever
-        self.callback.side_effect = lambda x: None if self.time.current_time < 1000 else tt.cancel()
+        # very late: the callback is called once
+        nt.assert_equal(self.scheduler.run_pending(now + 35), 0)
+        nt.assert_almost_equal(self.scheduler.run_pending(now + 35), 5)
 
-        tt.start()
+        nt.assert_equal(self.callback.call_count, 1)
 
-        tt.join()
+    def test_no_metrics(self):
+        self.get_metrics.return_value = {}
 
-        nt.assert_false(tt.is_running)
-        # one run every 10 seconds, for 1000 seconds total
-        nt.assert_equal(self.callback.call_count, 1000/10)
+        tt = mm.Timer([3, 5, 8], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
 
-        nt.assert_equal(self.time.sleeps, [11, 8] + [9]*98)
+        for now in (3, 5, 8):
+            self.scheduler.run_pending(now)
 
-    def test_no_metrics(self):
-        self.get_metrics.return_value = {}
+        nt.assert_false(tt.is_running)
+        nt.assert_equal(self.callback.call_count, 0)
 
-        def scheduler():
+    def test_schedule_error(self):
+        def schedule():
             yield 3
-            yield 5
-            yield 8
+            raise ValueError()
 
-        tt = mm.Timer(scheduler(), self.callback, self.tag)
-        tt.start()
+        broken = mm.Timer(schedule(), mock.Mock(), self.tag)
+        tt = mm.Timer([3, 5], self.callback, self.tag)
+        for timer in (broken, tt):
+            self.scheduler.add(timer, 0)
 
-        tt.join()
+        # the broken timer is cancelled, the other one goes on
+        self.scheduler.run_pending(3)
+        nt.assert_false(broken.is_running)
+        nt.assert_true(tt.is_running)
 
-        nt.assert_false(tt.is_running)
+        self.scheduler.run_pending(5)
+        nt.assert_equal(broken.callback.call_count, 1)
+        nt.assert_equal(self.callback.call_count, 2)
+
+    def test_cancelled(self):
+        tt = mm.Timer([3, 5, 8], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
+
+        tt.cancel()
+
+        nt.assert_is_none(self.scheduler.run_pending(3))
+        nt.assert_equal(self.callback.call_count, 0)
+
+    def test_shared_snapshot(self):
+        other = mm.Timer([3], mock.Mock(), self.tag)
+        another_tag = mm.Timer([3], mock.Mock(), "other")
+        interval = mm.Timer([3], mock.Mock(), self.tag, "key")
+
+        for tt in (mm.Timer([3], self.callback, self.tag), other, another_tag, interval):
+            self.scheduler.add(tt, 0)
+
+        self.scheduler.run_pending(3)
+
+        nt.assert_equal(
+            self.get_metrics.call_args_list,
+            [mock.call(self.tag), mock.call("other"), mock.call(self.tag, "key")])
+
+        nt.assert_equal(self.callback.call_count, 1)
+        nt.assert_equal(other.callback.call_count, 1)
+        nt.assert_equal(another_tag.callback.call_count, 1)
+        nt.assert_equal(interval.callback.call_count, 1)
+
+    def test_callback_error(self):
+        self.callback.side_effect = ValueError()
+        tt = mm.Timer([3, 5], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
+
+        self.scheduler.run_pending(3)
+        self.scheduler.run_pending(5)
+
+        nt.assert_equal(self.callback.call_count, 2)
+
+    @mock.patch('appmetrics.selfmetrics.record')
+    @mock.patch('appmetrics.selfmetrics.ENABLED', True)
+    def test_self_instrumentation(self, record):
+        tt = mm.Timer([3], self.callback, self.tag)
+        self.scheduler.add(tt, 0)
+
+        self.scheduler.run_pending(4.5)
+
+        nt.assert_equal(
+            [x[0][:2] for x in record.call_args_list[:2]],
+            [(selfmetrics.REPORTER_LAG, 1.5), (selfmetrics.SNAPSHOT_SIZE, 1)])
+        nt.assert_equal(record.call_args_list[2][0][0], selfmetrics.REPORTER_CALLBACK)
+        nt.assert_equal(len(record.call_args_list), 3)
 
+    def test_thread(self):
+        called = threading.Event()
+        self.callback.side_effect = lambda data: called.set()
+
+        self.scheduler.start()
+        try:
+            tt = mm.Timer(mm.fixed_interval_scheduler(0.01), self.callback, self.tag)
+            self.scheduler.add(tt)
+
+            nt.assert_true(called.wait(5))
+
+            tt.cancel()
+        finally:
+            self.scheduler.stop()
+            self.scheduler.join(5)
+
+        nt.assert_false(self.scheduler.is_alive())
+
+    def test_stop_wakes_up(self):
+        tt = mm.Timer(mm.fixed_interval_scheduler(3600), self.callback, self.tag)
+        self.scheduler.add(tt)
+
+        self.scheduler.start()
+        self.scheduler.stop()
+        self.scheduler.join(5)
+
+        nt.assert_false(self.scheduler.is_alive())
         nt.assert_equal(self.callback.call_count, 0)
-        nt.assert_equal(self.time.sleeps, [3, 1, 2])
+
+
+class TestAsyncTimer(object):
+    def setUp(self):
+        try:
+            import asyncio
+        except ImportError:
+            raise SkipTest("asyncio not available")
+
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+
+        self.old_registry = mm.REGISTRY.copy()
+
+        self.get_metrics_patch = mock.patch('appmetrics.reporter.get_metrics')
+        self.get_metrics = self.get_metrics_patch.start()
+        self.get_metrics.return_value = {'m1': {'kind': 'counter', 'value': 1}}
+
+        self.snapshots_patch = mock.patch('appmetrics.reporter.SNAPSHOTS', mm.SnapshotCoordinator(0))
+        self.snapshots_patch.start()
+
+        self.calls = []
+
+    def tearDown(self):
+        self.get_metrics_patch.stop()
+        self.snapshots_patch.stop()
+        self.loop.close()
+
+        mm.REGISTRY.clear()
+        mm.REGISTRY.update(self.old_registry)
+
+    def callback(self, data):
+        # a plain function returning an awaitable, like a coroutine function does
+        self.calls.append(data)
+
+        if len(self.calls) == 3:
+            self.loop.stop()
+
+        future = self.asyncio.Future(loop=self.loop)
+        future.set_result(None)
+        return future
+
+    def run(self):
+        # safety net
+        self.loop.call_later(5, self.loop.stop)
+        self.loop.run_forever()
+
+    @nt.raises(TypeError)
+    def test_register_invalid_schedule(self):
+        mm.register_async(self.callback, None, loop=self.loop)
+
+    def test_register(self):
+        id_ = mm.register_async(self.callback, mm.fixed_interval_scheduler(0.01), loop=self.loop)
+
+        nt.assert_is_instance(mm.get(id_), mm.AsyncTimer)
+
+        self.run()
+
+        nt.assert_equal(self.calls, [self.get_metrics.return_value] * 3)
+        nt.assert_equal(self.get_metrics.call_args_list, [mock.call(None)] * 3)
+
+        mm.remove(id_)
+        nt.assert_false(mm.get(id_))
+
+    def test_register_interval(self):
+        id_ = mm.register_async(self.callback, mm.fixed_interval_scheduler(0.01), interval=True, loop=self.loop)
+
+        self.run()
+
+        nt.assert_equal(self.get_metrics.call_args_list, [mock.call(None, id_)] * 3)
+
+    def test_cancel(self):
+        id_ = mm.register_async(self.callback, mm.fixed_interval_scheduler(0.05), loop=self.loop)
+        timer = mm.get(id_)
+
+        self.loop.call_later(0.07, timer.cancel)
+        self.loop.call_later(0.2, self.loop.stop)
+        self.loop.run_forever()
+
+        nt.assert_false(timer.is_running)
+        nt.assert_is_none(timer._handle)
+        nt.assert_less(len(self.calls), 3)
+
+    def test_callback_error(self):
+        def callback(data):
+            self.calls.append(data)
+            if len(self.calls) == 3:
+                self.loop.stop()
+            raise ValueError()
+
+        mm.register_async(callback, mm.fixed_interval_scheduler(0.01), loop=self.loop)
+
+        self.run()
+
+        nt.assert_equal(len(self.calls), 3)
+
+    def test_finite_schedule(self):
+        now = time.time()
+        id_ = mm.register_async(self.callback, [now + 0.01, now + 0.02], loop=self.loop)
+
+        self.loop.call_later(0.1, self.loop.stop)
+        self.loop.run_forever()
+
+        nt.assert_equal(len(self.calls), 2)
+        nt.assert_false(mm.get(id_).is_running)
+
+
+class TestSnapshotCoordinator(object):
+    def setUp(self):
+        self.get_metrics_patch = mock.patch('appmetrics.reporter.get_metrics')
+        self.get_metrics = self.get_metrics_patch.start()
+        self.get_metrics.side_effect = lambda tag: {'m1': {'kind': 'counter', 'value': tag}}
+
+        self.coordinator = mm.SnapshotCoordinator(1)
+
+    def tearDown(self):
+        self.get_metrics_patch.stop()
+
+    def test_get(self):
+        res = self.coordinator.get("tag", 10)
+        nt.assert_equal(res, {'m1': {'kind': 'counter', 'value': "tag"}})
+        nt.assert_is_instance(res, mm.ReadOnlyDict)
+        nt.assert_is_instance(res['m1'], mm.ReadOnlyDict)
+
+    def test_get_shared(self):
+        res = self.coordinator.get("tag", 10)
+
+        nt.assert_is(self.coordinator.get("tag", 10.5), res)
+        nt.assert_is_not(self.coordinator.get("other", 10.5), res)
+        nt.assert_equal(
+            self.get_metrics.call_args_list,
+            [mock.call("tag"), mock.call("other")])
+
+    def test_get_expired(self):
+        res = self.coordinator.get("tag", 10)
+
+        nt.assert_is_not(self.coordinator.get("tag", 11), res)
+        nt.assert_equal(self.get_metrics.call_count, 2)
+
+    def test_stale_snapshots_dropped(self):
+        self.coordinator.get("tag", 10)
+        self.coordinator.get("other", 10.5)
+
+        self.coordinator.get("new", 11)
+        nt.assert_equal(sorted(self.coordinator._snapshots), ["new", "other"])
+
+    def test_discard(self):
+        self.coordinator.get("tag", 10)
+
+        self.coordinator.discard("tag")
+        self.coordinator.discard("xxx")
+        nt.assert_equal(self.coordinator._snapshots, {})
+
+
+class TestReadOnlyDict(object):
+    def setUp(self):
+        self.obj = mm.ReadOnlyDict(a=1, b=2)
+
+    def test_readonly(self):
+        for method, args in [
+                ("__setitem__", ("a", 2)), ("__delitem__", ("a",)), ("pop", ("a",)), ("popitem", ()),
+                ("clear", ()), ("setdefault", ("c", 3)), ("update", ({"c": 3},))]:
+            nt.assert_raises(TypeError, getattr(self.obj, method), *args)
+
+        nt.assert_equal(self.obj, dict(a=1, b=2))
+
+    def test_copy(self):
+        res = self.obj.copy()
+        res['c'] = 3
+        nt.assert_equal(res, dict(a=1, b=2, c=3))
+
+    def test_copy_module(self):
+        import copy
+        nt.assert_equal(copy.deepcopy(self.obj), self.obj)
 
 
 class TestGetMetrics(object):
@@ -238,6 +559,11 @@ class TestGetMetrics(object):
         res = mm.get_metrics("xxx")
         nt.assert_equal(res, {})
 
+    def test_with_interval_key(self):
+        res = mm.get_metrics("tag", "key")
+        expected = dict(m1=self.m1.get_interval("key"), m3=self.m3.get_interval("key"))
+        nt.assert_equal(res, expected)
+
 
 class TestCSVReporter(object):
     def setUp(self):
@@ -259,6 +585,7 @@ class TestCSVReporter(object):
         )
 
     def tearDown(self):
+        self.reporter.close()
         shutil.rmtree(self.tmpdir)
         for name in ("h1", "h2", "m1", "m2", "g1"):
             metrics.delete_metric(name)
@@ -314,3 +641,731 @@ class TestCSVReporter(object):
 
         self.check_file("m1_meter.csv", mm.CSVReporter.meter_header, md)
         self.check_file("m2_meter.csv", mm.CSVReporter.meter_header, md)
+
+    def test_files_kept_open(self):
+        self.reporter(self.data)
+
+        files = dict(self.reporter._files)
+        nt.assert_equal(len(files), 4)
+
+        with mock.patch('appmetrics.reporter.open', create=True) as open_:
+            self.reporter(self.data)
+            nt.assert_false(open_.called)
+
+        nt.assert_equal(self.reporter._files, files)
+
+    @mock.patch('appmetrics.reporter.time.time', mock.Mock(return_value=1234.5))
+    def test_flush_interval(self):
+        self.reporter.close()
+        self.reporter = mm.CSVReporter(self.tmpdir, flush_interval=10)
+        self.reporter.latest_flush = 1230
+
+        self.reporter(self.data)
+
+        # still buffered
+        with open(os.path.join(self.tmpdir, "m1_meter.csv")) as ff:
+            nt.assert_equal(ff.read(), "")
+
+        self.reporter.latest_flush = 1220
+        self.reporter(self.data)
+
+        self.check_file("m1_meter.csv", mm.CSVReporter.meter_header, [self.meter_data("1234.5")] * 2)
+        nt.assert_equal(self.reporter.latest_flush, 1234.5)
+
+    @mock.patch('appmetrics.reporter.time.time', mock.Mock(return_value=1234.5))
+    def test_close(self):
+        self.reporter.close()
+        self.reporter = mm.CSVReporter(self.tmpdir, flush_interval=3600)
+        self.reporter(self.data)
+
+        self.reporter.close()
+
+        nt.assert_equal(self.reporter._files, {})
+        self.check_file("m1_meter.csv", mm.CSVReporter.meter_header, [self.meter_data("1234.5")])
+
+    @mock.patch('appmetrics.reporter.time.time', mock.Mock(return_value=1234.5))
+    def test_max_open_files(self):
+        self.reporter.close()
+        self.reporter = mm.CSVReporter(self.tmpdir, max_open_files=2)
+
+        self.reporter(self.data)
+        nt.assert_equal(len(self.reporter._files), 2)
+
+        self.reporter(self.data)
+
+        # reopened files don't get the header again
+        self.check_file("m1_meter.csv", mm.CSVReporter.meter_header, [self.meter_data("1234.5")] * 2)
+        self.check_file("h1_histogram.csv", mm.CSVReporter.histogram_header, [self.histogram_data("1234.5")] * 2)
+
+    def test_many_files_not_reopened(self):
+        self.reporter.close()
+        self.reporter = mm.CSVReporter(self.tmpdir)
+        nt.assert_greater(self.reporter.max_open_files, 600)
+
+        data = collections.OrderedDict(
+            ("m%d" % i, self.data['m1']) for i in range(600))
+        with mock.patch.object(self.reporter, 'open_file', wraps=self.reporter.open_file) as open_file:
+            for _ in range(3):
+                self.reporter(data)
+
+        nt.assert_equal(open_file.call_count, 600)
+
+    def test_more_files_than_the_limit(self):
+        self.reporter.close()
+        self.reporter = mm.CSVReporter(self.tmpdir, max_open_files=10)
+
+        data = collections.OrderedDict(
+            ("m%d" % i, self.data['m1']) for i in range(30))
+        with mock.patch.object(self.reporter, 'open_file', wraps=self.reporter.open_file) as open_file:
+            for _ in range(3):
+                self.reporter(data)
+
+        # most of the files kept open are not reopened at each report
+        nt.assert_equal(open_file.call_count, 30 + 2 * 20)
+        nt.assert_equal(len(self.reporter._files), 10)
+
+    def test_default_max_open_files(self):
+        resource = mock.Mock()
+        with mock.patch.dict('sys.modules', resource=resource):
+            resource.RLIM_INFINITY = -1
+            resource.getrlimit.return_value = (1024, 4096)
+            nt.assert_equal(mm.default_max_open_files(), 512)
+
+            resource.getrlimit.return_value = (-1, -1)
+            nt.assert_equal(mm.default_max_open_files(), 0)
+
+    @mock.patch('appmetrics.reporter.time.time', mock.Mock(return_value=1234.5))
+    def test_histogram_with_custom_fields(self):
+        metrics.new_histogram("h3", fields=['min', 'max', 'percentile'], percentiles=[50, 99.99])
+        try:
+            self.reporter(dict(h3=metrics.get("h3")))
+        finally:
+            metrics.delete_metric("h3")
+
+        header = mm.CSVReporter.histogram_header + ('percentile_99.99',)
+        data = ["1234.5", "0", "0", "0"] + [""] * 6 + ["0.0"] + [""] * 7 + ["0.0"]
+        self.check_file("h3_histogram.csv", header, [data])
+
+    def test_cleanup(self):
+        self.reporter(self.data)
+
+        mm.cleanup()
+
+        nt.assert_equal(self.reporter._files, {})
+
+
+class TestCSVRotation(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmpdir, "m1_meter.csv")
+        self.data = dict(m1=dict(kind="meter", count=0, mean=0.0, one=0.0, five=0.0, fifteen=0.0, day=0.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def report(self, reporter, times):
+        for i in range(times):
+            reporter(self.data)
+
+        mm.get_compressor().wait()
+        reporter.close()
+
+    def test_no_rotation(self):
+        reporter = mm.CSVReporter(self.tmpdir)
+        self.report(reporter, 3)
+
+        nt.assert_equal(os.listdir(self.tmpdir), ["m1_meter.csv"])
+
+    @mock.patch('appmetrics.reporter.log', mock.Mock())
+    def check_columns_changed(self, reopen):
+        reporter = mm.CSVReporter(self.tmpdir)
+        file_name = os.path.join(self.tmpdir, "h1_histogram.csv")
+
+        reporter(dict(h1=dict(kind="histogram", n=1, percentile=[(50, 1.0)])))
+        if reopen:
+            reporter.close()
+        reporter(dict(h1=dict(kind="histogram", n=2, percentile=[(50, 1.0), (99.99, 2.0)])))
+        reporter(dict(h1=dict(kind="histogram", n=3, percentile=[(50, 1.0), (99.99, 2.0)])))
+        self.report(reporter, 0)
+
+        rotated = mm.rotated_files(file_name)
+        nt.assert_equal(len(rotated), 1)
+        with open(rotated[0]) as ff:
+            rows = list(csv.reader(ff))
+        nt.assert_equal(rows[0], list(mm.CSVReporter.histogram_header))
+        nt.assert_equal([len(x) for x in rows], [18, 18])
+
+        with open(file_name) as ff:
+            rows = list(csv.reader(ff))
+        nt.assert_equal(rows[0], list(mm.CSVReporter.histogram_header) + ['percentile_99.99'])
+        nt.assert_equal([x[1] for x in rows[1:]], ["2", "3"])
+        nt.assert_equal([len(x) for x in rows], [19, 19, 19])
+
+    def test_columns_changed(self):
+        self.check_columns_changed(reopen=True)
+
+    def test_columns_changed_open_file(self):
+        self.check_columns_changed(reopen=False)
+
+    def test_rotate_by_size(self):
+        reporter = mm.CSVReporter(self.tmpdir, max_bytes=1)
+        self.report(reporter, 3)
+
+        rotated = mm.rotated_files(self.file_name)
+        nt.assert_equal(len(rotated), 3)
+        nt.assert_equal(sorted(os.listdir(self.tmpdir)), sorted(os.path.basename(x) for x in rotated))
+
+        # each file has its own header
+        for name in rotated:
+            with open(name) as ff:
+                nt.assert_equal(len(list(csv.reader(ff))), 2)
+
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_rotate_by_time(self, time_):
+        time_.return_value = 1000
+        reporter = mm.CSVReporter(self.tmpdir, rotate_interval=60)
+
+        reporter(self.data)
+        time_.return_value = 1059
+        reporter(self.data)
+        nt.assert_equal(mm.rotated_files(self.file_name), [])
+
+        time_.return_value = 1060
+        reporter(self.data)
+        reporter(self.data)
+        self.report(reporter, 0)
+
+        rotated = mm.rotated_files(self.file_name)
+        nt.assert_equal(len(rotated), 1)
+        with open(rotated[0]) as ff:
+            nt.assert_equal(len(list(csv.reader(ff))), 4)
+        with open(self.file_name) as ff:
+            nt.assert_equal(len(list(csv.reader(ff))), 2)
+
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_rotate_by_time_closed_files(self, time_):
+        time_.return_value = 1000
+        reporter = mm.CSVReporter(self.tmpdir, rotate_interval=60, max_open_files=2)
+        data = collections.OrderedDict(
+            ("m%d" % i, self.data['m1']) for i in range(5))
+
+        reporter(data)
+        time_.return_value = 1030
+        reporter(data)
+        nt.assert_equal(mm.rotated_files(self.file_name), [])
+
+        # the reopened files keep their segment start time
+        time_.return_value = 1060
+        reporter(data)
+        self.report(reporter, 0)
+
+        for i in range(5):
+            file_name = os.path.join(self.tmpdir, "m%d_meter.csv" % i)
+            rotated = mm.rotated_files(file_name)
+            nt.assert_equal(len(rotated), 1)
+            with open(rotated[0]) as ff:
+                nt.assert_equal(len(list(csv.reader(ff))), 4)
+
+    def test_rotate_by_size_closed_files(self):
+        reporter = mm.CSVReporter(self.tmpdir, max_bytes=1, max_open_files=1)
+        data = collections.OrderedDict(
+            ("m%d" % i, self.data['m1']) for i in range(2))
+
+        for _ in range(3):
+            reporter(data)
+        mm.get_compressor().wait()
+        reporter.close()
+
+        # m0 is closed after each write, and rotated when reopened
+        nt.assert_equal(len(mm.rotated_files(os.path.join(self.tmpdir, "m0_meter.csv"))), 2)
+        nt.assert_equal(len(mm.rotated_files(os.path.join(self.tmpdir, "m1_meter.csv"))), 3)
+
+    def test_compression(self):
+        import gzip
+
+        reporter = mm.CSVReporter(self.tmpdir, max_bytes=1, compression="gzip")
+        self.report(reporter, 2)
+
+        rotated = mm.rotated_files(self.file_name)
+        nt.assert_equal(len(rotated), 2)
+        nt.assert_equal(len(os.listdir(self.tmpdir)), 2)
+
+        for name in rotated:
+            nt.assert_true(name.endswith(".gz"))
+            with gzip.open(name, "rb") as ff:
+                nt.assert_equal(len(ff.read().splitlines()), 2)
+
+    def test_bz2_compression(self):
+        reporter = mm.CSVReporter(self.tmpdir, max_bytes=1, compression="bz2")
+        self.report(reporter, 1)
+
+        rotated = mm.rotated_files(self.file_name)
+        nt.assert_equal(len(rotated), 1)
+        nt.assert_true(rotated[0].endswith(".bz2"))
+
+    @nt.raises(ValueError)
+    def test_bad_compression(self):
+        mm.CSVReporter(self.tmpdir, compression="xxx")
+
+    def test_retention(self):
+        reporter = mm.CSVReporter(self.tmpdir, max_bytes=1, compression="gzip", backup_count=2)
+        self.report(reporter, 4)
+
+        rotated = mm.rotated_files(self.file_name)
+        nt.assert_equal(len(rotated), 2)
+        nt.assert_equal(len(os.listdir(self.tmpdir)), 2)
+
+    def test_rotated_files_order(self):
+        names = [
+            "m1_meter.csv.20140101-101010.2.gz", "m1_meter.csv.20140101-101010", "m1_meter.csv.20140101-101010.10",
+            "m1_meter.csv.20130101-101010.gz", "m1_meter.csv", "m1_meter.csv.20140101-101010.2.gz.tmp",
+            "m2_meter.csv.20120101-101010.gz"]
+        for name in names:
+            open(os.path.join(self.tmpdir, name), "w").close()
+
+        nt.assert_equal(
+            [os.path.basename(x) for x in mm.rotated_files(self.file_name)],
+            ["m1_meter.csv.20130101-101010.gz", "m1_meter.csv.20140101-101010",
+             "m1_meter.csv.20140101-101010.2.gz", "m1_meter.csv.20140101-101010.10"])
+
+
+class TestBinaryReporter(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.reporter = mm.BinaryReporter(self.tmpdir)
+
+    def tearDown(self):
+        self.reporter.close()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_histogram(self, time_):
+        time_.return_value = 1000
+        data = dict(kind="histogram", n=2, min=1.0, max=3.0, arithmetic_mean=2.0, histogram=[(3, 2)],
+                    percentile=[(50, 1.0), (99.9, 3.0)])
+
+        self.reporter(dict(h1=data))
+        data['n'] = 5
+        self.reporter(dict(h1=data))
+        self.reporter.close()
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "h1_histogram.bin")) as reader:
+            nt.assert_equal(
+                reader.columns,
+                ['time', 'n', 'min', 'max', 'arithmetic_mean', 'percentile_50', 'percentile_99.9'])
+            nt.assert_equal(reader.rows, 2)
+            nt.assert_equal(list(reader['n']), [2.0, 5.0])
+            nt.assert_equal(list(reader['time']), [1000.0, 1000.0])
+            nt.assert_equal(list(reader['percentile_99.9']), [3.0, 3.0])
+
+    def test_meter_counter_gauge(self):
+        self.reporter(dict(
+            m1=dict(kind="meter", count=1, mean=0.5, one=0.1, five=0.2, fifteen=0.3, day=0.4),
+            c1=dict(kind="counter", value=10),
+            g1=dict(kind="gauge", value=1.5),
+            g2=dict(kind="gauge", value="not a number")))
+        self.reporter.close()
+
+        nt.assert_equal(sorted(os.listdir(self.tmpdir)), ["c1_counter.bin", "g1_gauge.bin", "m1_meter.bin"])
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "m1_meter.bin")) as reader:
+            values = reader.as_dict()
+            nt.assert_equal(list(values['count']), [1.0])
+            nt.assert_equal(list(values['day']), [0.4])
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "c1_counter.bin")) as reader:
+            nt.assert_equal(list(reader['value']), [10.0])
+
+    def test_missing_values(self):
+        self.reporter(dict(m1=dict(kind="meter", count=1)))
+        self.reporter.close()
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "m1_meter.bin")) as reader:
+            mean = reader['mean'][0]
+            nt.assert_not_equal(mean, mean)
+
+    def test_partial_record(self):
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        self.reporter.close()
+
+        file_name = os.path.join(self.tmpdir, "c1_counter.bin")
+        with open(file_name, "ab") as of:
+            of.write(b"\0" * 3)
+
+        with mm.ColumnReader(file_name) as reader:
+            nt.assert_equal(reader.rows, 1)
+
+    @nt.raises(KeyError)
+    def test_unknown_column(self):
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        self.reporter.close()
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "c1_counter.bin")) as reader:
+            reader['xxx']
+
+    def test_columns_changed(self):
+        self.reporter(dict(h1=dict(kind="histogram", n=1, min=1.0)))
+        self.reporter.close()
+
+        self.reporter(dict(h1=dict(kind="histogram", n=2, max=1.0), c1=dict(kind="counter", value=1)))
+        self.reporter.close()
+        mm.get_compressor().wait()
+
+        file_name = os.path.join(self.tmpdir, "h1_histogram.bin")
+        rotated = mm.rotated_files(file_name)
+        nt.assert_equal(len(rotated), 1)
+        with mm.ColumnReader(rotated[0]) as reader:
+            nt.assert_equal(reader.columns, ['time', 'n', 'min'])
+            nt.assert_equal(list(reader['n']), [1.0])
+        with mm.ColumnReader(file_name) as reader:
+            nt.assert_equal(reader.columns, ['time', 'n', 'max'])
+            nt.assert_equal(list(reader['n']), [2.0])
+
+        # the other metrics are not affected
+        with mm.ColumnReader(os.path.join(self.tmpdir, "c1_counter.bin")) as reader:
+            nt.assert_equal(list(reader['value']), [1.0])
+
+    @mock.patch('appmetrics.reporter.BinaryReporter.dump_counter')
+    def test_failing_metric(self, dump_counter):
+        dump_counter.side_effect = ValueError()
+
+        self.reporter(collections.OrderedDict([
+            ('c1', dict(kind="counter", value=1)), ('g1', dict(kind="gauge", value=2))]))
+        self.reporter.close()
+
+        nt.assert_equal(os.listdir(self.tmpdir), ["g1_gauge.bin"])
+
+    @mock.patch('appmetrics.reporter.py3comp.PY3', False)
+    def test_reader_python2(self):
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        self.reporter(dict(c1=dict(kind="counter", value=2)))
+        self.reporter.close()
+
+        with mm.ColumnReader(os.path.join(self.tmpdir, "c1_counter.bin")) as reader:
+            values = reader['value']
+            nt.assert_equal(values.typecode, "d")
+            nt.assert_equal(list(values), [1.0, 2.0])
+
+    @nt.raises(ValueError)
+    def test_not_a_column_file(self):
+        file_name = os.path.join(self.tmpdir, "xxx.bin")
+        with open(file_name, "wb") as of:
+            of.write(b"x" * 100)
+
+        mm.ColumnReader(file_name)
+
+    def test_header_alignment(self):
+        for columns in (['a'], ['time', 'value'], ['time', 'count', 'mean']):
+            header = mm.pack_column_header(columns)
+            nt.assert_equal(len(header) % 8, 0)
+            nt.assert_equal(mm.read_column_header(io.BytesIO(header))[:2], (columns, len(header)))
+
+
+class TestStatsDReporter(object):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(1)
+
+        self.reporter = mm.StatsDReporter("127.0.0.1", self.listener.getsockname()[1], prefix="app")
+
+    def tearDown(self):
+        self.reporter.close()
+        self.listener.close()
+
+    def receive(self):
+        return self.listener.recv(65536).decode("utf8").split("\n")
+
+    def test_counter(self):
+        self.reporter(dict(c1=dict(kind="counter", value=5)))
+        self.reporter(dict(c1=dict(kind="counter", value=3)))
+
+        nt.assert_equal(self.receive(), ["app.c1:5|c"])
+        nt.assert_equal(self.receive(), ["app.c1:-2|c"])
+
+    def test_interval(self):
+        reporter = mm.StatsDReporter("127.0.0.1", self.listener.getsockname()[1], interval=True)
+        try:
+            for count in (5, 3):
+                reporter(dict(c1=dict(kind="counter", value=count), m1=dict(kind="meter", count=count)))
+        finally:
+            reporter.close()
+
+        # the interval values are sent as they are
+        nt.assert_equal(self.receive(), ["c1:5|c", "m1.count:5|c"])
+        nt.assert_equal(self.receive(), ["c1:3|c", "m1.count:3|c"])
+
+    def test_gauge(self):
+        self.reporter(dict(
+            g1=dict(kind="gauge", value=1.5), g2=dict(kind="gauge", value=-3),
+            g3=dict(kind="gauge", value="xxx"), g4=dict(kind="gauge", value=float("nan"))))
+
+        nt.assert_equal(self.receive(), ["app.g1:1.5|g", "app.g2:0|g", "app.g2:-3|g"])
+
+    def test_meter(self):
+        data = dict(kind="meter", count=10, mean=1.0, one=2.0, five=3.0, fifteen=4.0, day=5.0)
+        self.reporter(dict(m1=data))
+
+        nt.assert_equal(self.receive(), [
+            "app.m1.count:10|c", "app.m1.mean:1.0|g", "app.m1.one:2.0|g", "app.m1.five:3.0|g",
+            "app.m1.fifteen:4.0|g", "app.m1.day:5.0|g"])
+
+    def test_histogram(self):
+        data = dict(kind="histogram", n=2, min=1, max=3.5, histogram=[(3.5, 2)], percentile=[(50, 1), (99.9, 3.5)])
+        self.reporter({"h 1": data})
+
+        nt.assert_equal(self.receive(), [
+            "app.h_1.max:3.5|g", "app.h_1.min:1|g", "app.h_1.n:2|g",
+            "app.h_1.percentile_50:1|g", "app.h_1.percentile_99.9:3.5|g"])
+
+        # the original object is not modified
+        nt.assert_in('percentile', data)
+
+    def test_mtu(self):
+        self.reporter.mtu = 40
+        self.reporter(dict(("c{}".format(i), dict(kind="counter", value=i)) for i in range(6)))
+
+        nt.assert_equal(self.receive(), ["app.c0:0|c", "app.c1:1|c", "app.c2:2|c"])
+        nt.assert_equal(self.receive(), ["app.c3:3|c", "app.c4:4|c", "app.c5:5|c"])
+
+    def test_packets(self):
+        self.reporter.mtu = 10
+        nt.assert_equal(
+            list(self.reporter.packets(["a" * 4, "b" * 5, "c" * 20, "d"])),
+            [b"aaaa\nbbbbb", b"c" * 20, b"d"])
+
+    def test_send_error(self):
+        self.reporter.socket = mock.Mock()
+        self.reporter.socket.sendto.side_effect = socket.error()
+
+        self.reporter(dict(c1=dict(kind="counter", value=5)))
+
+        nt.assert_equal(self.reporter.socket.sendto.call_count, 1)
+
+    def test_no_prefix(self):
+        reporter = mm.StatsDReporter("127.0.0.1", self.listener.getsockname()[1])
+        try:
+            reporter(dict(c1=dict(kind="counter", value=5)))
+        finally:
+            reporter.close()
+
+        nt.assert_equal(self.receive(), ["c1:5|c"])
+
+
+class TestGraphiteReporter(object):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.listener.settimeout(1)
+        self.port = self.listener.getsockname()[1]
+
+        self.reporter = mm.GraphiteReporter("127.0.0.1", self.port, prefix="app")
+        self.connections = []
+
+    def tearDown(self):
+        self.reporter.close()
+        for connection in self.connections:
+            connection.close()
+        self.listener.close()
+
+    def receive(self, size):
+        if not self.connections:
+            connection = self.listener.accept()[0]
+            connection.settimeout(1)
+            self.connections.append(connection)
+
+        data = b""
+        while len(data) < size:
+            data += self.connections[-1].recv(size - len(data))
+        return data
+
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_plaintext(self, time_):
+        time_.return_value = 1000.5
+
+        self.reporter(dict(
+            c1=dict(kind="counter", value=5), g1=dict(kind="gauge", value="xxx"),
+            h1=dict(kind="histogram", n=2, min=1.5, histogram=[(3.5, 2)], percentile=[(99.9, 3.5)])))
+
+        expected = (
+            b"app.c1.value 5 1000\n"
+            b"app.h1.histogram.3_5 2 1000\n"
+            b"app.h1.min 1.5 1000\n"
+            b"app.h1.n 2 1000\n"
+            b"app.h1.percentile.99_9 3.5 1000\n")
+        nt.assert_equal(self.receive(len(expected)), expected)
+
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_pickle(self, time_):
+        import pickle
+        import struct
+
+        time_.return_value = 1000
+        reporter = mm.GraphiteReporter("127.0.0.1", self.port, protocol="pickle")
+        try:
+            reporter(dict(m1=dict(kind="meter", count=3, one=0.5)))
+
+            size = struct.unpack("!L", self.receive(4))[0]
+            nt.assert_equal(
+                pickle.loads(self.receive(size)),
+                [("m1.count", (1000, 3.0)), ("m1.one", (1000, 0.5))])
+        finally:
+            reporter.close()
+
+    @nt.raises(ValueError)
+    def test_invalid_protocol(self):
+        mm.GraphiteReporter(protocol="xxx")
+
+    def test_persistent_connection(self):
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        self.reporter(dict(c1=dict(kind="counter", value=2)))
+
+        data = self.receive(2 * len("app.c1.value 1 1000000000\n"))
+        nt.assert_equal(len(data.splitlines()), 2)
+
+    @mock.patch('appmetrics.reporter.log')
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_backoff(self, time_, log):
+        time_.return_value = 1000
+        reporter = mm.GraphiteReporter(
+            "127.0.0.1", self.port, max_queued=2, min_backoff=1, max_backoff=3)
+        reporter.connect = mock.Mock(wraps=reporter.connect)
+
+        with mock.patch.object(socket.socket, 'connect_ex', return_value=errno.ECONNREFUSED):
+            for i in range(3):
+                reporter(dict(c1=dict(kind="counter", value=i)))
+            nt.assert_equal((reporter.backoff, reporter.next_attempt), (1, 1001))
+
+            time_.return_value = 1001
+            reporter(dict(c1=dict(kind="counter", value=3)))
+            nt.assert_equal((reporter.backoff, reporter.next_attempt), (2, 1003))
+
+            time_.return_value = 1003
+            reporter(dict(c1=dict(kind="counter", value=4)))
+            time_.return_value = 1005
+            reporter(dict(c1=dict(kind="counter", value=5)))
+            nt.assert_equal((reporter.backoff, reporter.next_attempt), (3, 1006))
+
+        # the oldest reports were discarded
+        nt.assert_equal(len(reporter.queue), 2)
+
+        time_.return_value = 1008
+        reporter(dict(c1=dict(kind="counter", value=6)))
+        try:
+            nt.assert_equal(reporter.backoff, 0)
+            nt.assert_equal(len(reporter.queue), 0)
+
+            expected = b"c1.value 5 1005\nc1.value 6 1008\n"
+            nt.assert_equal(self.receive(len(expected)), expected)
+        finally:
+            reporter.close()
+
+    @mock.patch('appmetrics.reporter.log')
+    @mock.patch('appmetrics.reporter.select.select')
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_connect_pending(self, time_, select_, log):
+        time_.return_value = 1000
+        select_.return_value = ([], [], [])
+
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        nt.assert_is_not_none(self.reporter.socket)
+        nt.assert_equal(self.reporter.connecting_since, 1000)
+        nt.assert_equal(len(self.reporter.queue), 1)
+
+        # the connection completes at the next report, which sends the queued ones too
+        select_.return_value = ([], [self.reporter.socket], [])
+        time_.return_value = 1000.5
+        self.reporter(dict(c1=dict(kind="counter", value=2)))
+
+        nt.assert_is_none(self.reporter.connecting_since)
+        expected = b"app.c1.value 1 1000\napp.c1.value 2 1000\n"
+        nt.assert_equal(self.receive(len(expected)), expected)
+
+    @mock.patch('appmetrics.reporter.log')
+    @mock.patch('appmetrics.reporter.select.select', mock.Mock(return_value=([], [], [])))
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_connect_timeout(self, time_, log):
+        time_.return_value = 1000
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+
+        time_.return_value = 1001
+        self.reporter({})
+
+        nt.assert_is_none(self.reporter.socket)
+        nt.assert_is_none(self.reporter.connecting_since)
+        nt.assert_equal((self.reporter.backoff, self.reporter.next_attempt), (1, 1002))
+        nt.assert_equal(len(self.reporter.queue), 1)
+
+    @mock.patch('appmetrics.reporter.log')
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_resolve_once(self, time_, log):
+        time_.return_value = 1000
+
+        with mock.patch('appmetrics.reporter.socket.getaddrinfo', wraps=socket.getaddrinfo) as getaddrinfo:
+            self.reporter(dict(c1=dict(kind="counter", value=1)))
+            self.reporter.disconnected(1000, "test")
+
+            time_.return_value = 1001
+            self.reporter(dict(c1=dict(kind="counter", value=2)))
+
+        nt.assert_equal(getaddrinfo.call_count, 1)
+        nt.assert_is_not_none(self.reporter.socket)
+        nt.assert_is_none(self.reporter.connecting_since)
+
+    @mock.patch('appmetrics.reporter.log')
+    def test_send_error(self, log):
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+
+        self.reporter.socket.close()
+        self.reporter.socket = mock.Mock()
+        self.reporter.socket.send.side_effect = socket.error()
+
+        self.reporter(dict(c1=dict(kind="counter", value=2)))
+
+        nt.assert_is_none(self.reporter.socket)
+        nt.assert_equal(len(self.reporter.queue), 1)
+        nt.assert_equal(self.reporter.backoff, 1.0)
+
+    @mock.patch('appmetrics.reporter.time.time', mock.Mock(return_value=1000))
+    def test_partial_send(self):
+        self.reporter.connect = mock.Mock(return_value=True)
+        self.reporter.socket = mock.Mock()
+        self.reporter.socket.send.side_effect = [5, socket.error(errno.EAGAIN, "blocked")]
+
+        self.reporter(dict(c1=dict(kind="counter", value=1)))
+        nt.assert_equal(self.reporter.pending, (b"app.c1.value 1 1000\n", 5))
+        nt.assert_equal(self.reporter.blocked_since, 1000)
+
+        # the next report sends the rest first
+        self.reporter.socket.send.side_effect = lambda data: len(data)
+        self.reporter(dict(c1=dict(kind="counter", value=2)))
+
+        sent = [bytes(x[0][0]) for x in self.reporter.socket.send.call_args_list]
+        nt.assert_equal(sent[2:], [b"1.value 1 1000\n", b"app.c1.value 2 1000\n"])
+        nt.assert_is_none(self.reporter.pending)
+        nt.assert_is_none(self.reporter.blocked_since)
+
+    @mock.patch('appmetrics.reporter.log')
+    @mock.patch('appmetrics.reporter.time.time')
+    def test_server_not_reading(self, time_, log):
+        time_.return_value = 1000
+        report = b"app.c1.value 1 1000\napp.c2.value 2 1000\n"
+
+        self.reporter.connect = mock.Mock(return_value=True)
+        self.reporter.socket = sock = mock.Mock()
+        sock.send.side_effect = [25] + [socket.error(errno.EAGAIN, "blocked")] * 3
+
+        self.reporter(dict(c1=dict(kind="counter", value=1), c2=dict(kind="counter", value=2)))
+        time_.return_value = 1000.5
+        self.reporter({})
+        nt.assert_is_not_none(self.reporter.socket)
+
+        time_.return_value = 1001
+        self.reporter({})
+
+        # the connection is reset, and the incomplete line will be sent again
+        nt.assert_is_none(self.reporter.socket)
+        nt.assert_equal(sock.close.call_count, 1)
+        nt.assert_is_none(self.reporter.pending)
+        nt.assert_equal(list(self.reporter.queue), [report[report.index(b"\n") + 1:]])
@@ -0,0 +1,90 @@
+from nose import tools as nt
+
+from .. import selfmetrics as mm, metrics, histogram, locks
+
+
+class TestSelfMetrics(object):
+    def setUp(self):
+        self.original_registy = metrics.REGISTRY.copy()
+        self.original_tags = metrics.TAGS.copy()
+
+        metrics.REGISTRY.clear()
+        metrics.TAGS.clear()
+
+    def tearDown(self):
+        mm.disable()
+
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registy)
+
+        metrics.TAGS.clear()
+        metrics.TAGS.update(self.original_tags)
+
+    def test_enable(self):
+        mm.enable()
+
+        nt.assert_true(mm.ENABLED)
+        nt.assert_equal(metrics.TAGS[mm.TAG], set(mm.METRICS))
+        for name in mm.METRICS:
+            nt.assert_is_instance(metrics.metric(name).reservoir, histogram.ExponentialDecayingReservoir)
+
+        # no errors
+        mm.enable()
+
+    def test_disable(self):
+        mm.enable()
+        mm.disable()
+
+        nt.assert_false(mm.ENABLED)
+        nt.assert_is_none(locks.WAIT_OBSERVER)
+
+        # the values are kept
+        nt.assert_equal(metrics.TAGS[mm.TAG], set(mm.METRICS))
+
+    def test_histogram_get(self):
+        test = metrics.new_histogram("test")
+        mm.enable()
+
+        test.get()
+        test.get()
+        nt.assert_equal(metrics.get(mm.HISTOGRAM_GET)['n'], 2)
+
+        mm.disable()
+        test.get()
+
+        # the get() above was recorded too
+        nt.assert_equal(len(metrics.metric(mm.HISTOGRAM_GET).raw_data()), 3)
+
+    def test_timed_locks(self):
+        before = metrics.new_histogram("before")
+        before.get_interval("a")
+        mm.enable()
+        after = metrics.new_histogram("after")
+
+        for item in (before.reservoir, before._recorders["a"], after.reservoir):
+            nt.assert_is_instance(item.lock, locks.TimedLock)
+
+        # the internal histograms are not timed
+        nt.assert_false(isinstance(metrics.metric(mm.RESERVOIR_LOCK_WAIT).reservoir.lock, locks.TimedLock))
+
+        mm.disable()
+
+        for item in (before.reservoir, before._recorders["a"], after.reservoir):
+            nt.assert_false(isinstance(item.lock, locks.TimedLock))
+
+    def test_lock_wait(self):
+        mm.enable()
+
+        mm.record_lock_wait(0.5)
+        nt.assert_equal(metrics.metric(mm.RESERVOIR_LOCK_WAIT).raw_data(), [0.5])
+
+        mm.disable()
+        mm.record_lock_wait(0.5)
+        nt.assert_equal(metrics.metric(mm.RESERVOIR_LOCK_WAIT).raw_data(), [0.5])
+
+    def test_record_deleted(self):
+        mm.enable()
+        metrics.delete_metric(mm.REPORTER_LAG)
+
+        # no errors
+        mm.record(mm.REPORTER_LAG, 1.0)
@@ -1,4 +1,4 @@
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_greater
 
 from .. import simple_metrics as mm
 
@@ -7,6 +7,12 @@ class TestCounter(object):
     def setUp(self):
         self.obj = mm.Counter()
 
+    def test_version(self):
+        assert_equal(self.obj.version, 0)
+        self.obj.notify(1)
+        self.obj.notify(-1)
+        assert_equal(self.obj.version, 2)
+
     def test_notify(self):
         self.obj.notify(5)
         assert_equal(self.obj.value, 5)
@@ -29,11 +35,45 @@ class TestCounter(object):
         self.obj.value = 3
         assert_equal(self.obj.raw_data(), 3)
 
+    def test_get_interval(self):
+        self.obj.notify(3)
+        assert_equal(self.obj.get_interval("a"), dict(kind="counter", value=3))
+
+        self.obj.notify(2)
+        assert_equal(self.obj.get_interval("a"), dict(kind="counter", value=2))
+        assert_equal(self.obj.get_interval("b"), dict(kind="counter", value=5))
+
+        self.obj.notify(-1)
+        assert_equal(self.obj.get_interval("a"), dict(kind="counter", value=-1))
+        assert_equal(self.obj.get_interval("a"), dict(kind="counter", value=0))
+
+        assert_equal(self.obj.get(), dict(kind="counter", value=4))
+
+    def test_release_interval(self):
+        self.obj.notify(3)
+        self.obj.get_interval("a")
+
+        self.obj.release_interval("a")
+        assert_equal(self.obj.get_interval("a"), dict(kind="counter", value=3))
+
+    def test_sizeof(self):
+        size = self.obj.sizeof()
+
+        # the interval state is counted
+        self.obj.get_interval("a")
+        assert_greater(self.obj.sizeof(), size)
+
 
 class TestGauge(object):
     def setUp(self):
         self.obj = mm.Gauge()
 
+    def test_version(self):
+        assert_equal(self.obj.version, 0)
+        self.obj.notify(1)
+        self.obj.notify(1)
+        assert_equal(self.obj.version, 2)
+
     def test_notify(self):
         assert_equal(self.obj.value, None)
         self.obj.notify("version 1.0")
@@ -46,6 +86,11 @@ class TestGauge(object):
         self.obj.value = "test"
         assert_equal(self.obj.get(), dict(kind="gauge", value="test"))
 
+    def test_get_interval(self):
+        self.obj.value = "test"
+        assert_equal(self.obj.get_interval("a"), dict(kind="gauge", value="test"))
+        assert_equal(self.obj.get_interval("a"), dict(kind="gauge", value="test"))
+
     def test_raw_data(self):
         self.obj.value = "test"
         assert_equal(self.obj.raw_data(), "test")
@@ -7,7 +7,7 @@ from nose.tools import (
     assert_regexp_matches)
 import werkzeug, werkzeug.test
 
-from .. import wsgi, metrics, py3comp
+from .. import wsgi, metrics, py3comp, profiling
 
 
 def env(path, **kwargs):
@@ -20,6 +20,11 @@ def req(body):
     return data.get_request(cls=werkzeug.wrappers.Request)
 
 
+def get_req(environ_overrides=None, **args):
+    data = werkzeug.test.EnvironBuilder(query_string=args, environ_overrides=environ_overrides)
+    return data.get_request(cls=werkzeug.wrappers.Request)
+
+
 def check_dispatching(mw, url, method, expected):
     urls = mw.url_map.bind_to_environ(env(url, REQUEST_METHOD=method))
     try:
@@ -42,7 +47,12 @@ def test_dispatching():
         ("/_app-metrics/metrics/test", 'POST', wsgi.handle_metric_update),
         ("/_app-metrics/metrics/test", 'DELETE', wsgi.handle_metric_delete),
         ("/_app-metrics/metrics/test", 'OPTIONS', werkzeug.exceptions.MethodNotAllowed),
-        ("/_app-metrics/metrics/test/sub", 'GET', werkzeug.routing.NotFound),
+        ("/_app-metrics/metrics/test/sub", 'GET', wsgi.handle_metric_show),
+        ("/_app-metrics/tags/tag/test/sub", 'PUT', wsgi.handle_tag_add),
+        ("/_app-metrics/tags/tag/test/sub", 'DELETE', wsgi.handle_untag),
+        ("/_app-metrics/profiles", 'GET', wsgi.handle_profiles_list),
+        ("/_app-metrics/profiles/test", 'GET', wsgi.handle_profiles_show),
+        ("/_app-metrics/profiles/test", 'DELETE', werkzeug.exceptions.MethodNotAllowed),
     ]
 
     mw = wsgi.AppMetricsMiddleware(None)
@@ -60,7 +70,7 @@ def test_dispatching_root():
         ("/metrics/test", 'POST', wsgi.handle_metric_update),
         ("/metrics/test", 'DELETE', wsgi.handle_metric_delete),
         ("/metrics/test", 'OPTIONS', werkzeug.exceptions.MethodNotAllowed),
-        ("/metrics/test/sub", 'GET', werkzeug.routing.NotFound),
+        ("/metrics/test/sub", 'GET', wsgi.handle_metric_show),
         ]
 
     mw = wsgi.AppMetricsMiddleware(None, "")
@@ -105,6 +115,22 @@ class TestAppMetricsMiddleware(object):
             self.app.call_args_list,
             [mock.call(env("/_app-metrics/test/sub"), self.start_response)])
 
+    def test_call_not_matching_fast_path(self):
+        for path in ("/", "/test", "/_app-metrics", "/_app-metricsX/metrics"):
+            res = self.mw(env(path), self.start_response)
+            assert_equal(res, self.app.return_value)
+
+        # the routes are not even built
+        assert_equal(self.mw._url_map, None)
+        assert_false(self.start_response.called)
+
+    def test_call_not_matching_empty_root(self):
+        mw = wsgi.AppMetricsMiddleware(self.app, "")
+
+        res = mw(env("/test"), self.start_response)
+        assert_equal(res, self.app.return_value)
+        assert_is_instance(mw._url_map, werkzeug.routing.Map)
+
     def test_call_with_invalid_status(self):
         self.handler.side_effect = ValueError()
 
@@ -210,6 +236,19 @@ class TestAppMetricsMiddleware(object):
         )
 
 
+    def test_call_prometheus(self):
+        mw = wsgi.AppMetricsMiddleware(self.app, extra_headers={'X-Extra': "1"})
+
+        with mock.patch('appmetrics.wsgi.prometheus.Renderer.__call__', return_value=iter(["a 1\n", "b 2\n"])):
+            body = mw(env("/_app-metrics/prometheus", REQUEST_METHOD='GET'), self.start_response)
+            assert_equal(b"".join(body), b"a 1\nb 2\n")
+
+        assert_equal(
+            self.start_response.call_args_list,
+            [mock.call("200 OK", [
+                ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('X-Extra', "1")])])
+
+
 class TestWSGIHandlers(object):
     def setUp(self):
         self.original_registry = metrics.REGISTRY
@@ -229,7 +268,81 @@ class TestWSGIHandlers(object):
     def test_handle_metrics_list(self, metrics):
         metrics.return_value = ["test1", "test2"]
 
-        assert_equal(wsgi.handle_metrics_list(mock.Mock()), '["test1", "test2"]')
+        assert_equal(wsgi.handle_metrics_list(get_req()), '["test1", "test2"]')
+
+    def test_handle_metrics_list_all(self):
+        metrics.new_counter("test1").notify(1)
+        metrics.new_gauge("test2").notify(2)
+
+        response = wsgi.handle_metrics_list(get_req(all="true"))
+
+        assert_equal(response.status_code, 200)
+        assert_equal(response.mimetype, "application/json")
+        assert_equal(json.loads(response.get_data(as_text=True)), {
+            'test1': dict(kind="counter", value=1), 'test2': dict(kind="gauge", value=2)})
+
+    def test_handle_metrics_list_names(self):
+        metrics.new_counter("test1").notify(1)
+        metrics.new_gauge("test2").notify(2)
+
+        response = wsgi.handle_metrics_list(get_req(names="test1,xxx,"))
+
+        assert_equal(json.loads(response.get_data(as_text=True)), {'test1': dict(kind="counter", value=1)})
+
+    def test_handle_metrics_list_not_modified(self):
+        counter = metrics.new_counter("test1")
+
+        etag = wsgi.handle_metrics_list(get_req(all="true")).get_etag()
+        assert_equal(etag[1], True)
+
+        response = wsgi.handle_metrics_list(get_req(dict(HTTP_IF_NONE_MATCH='W/"{}"'.format(etag[0])), all="true"))
+        assert_equal(response.status_code, 304)
+        assert_equal(response.get_etag(), etag)
+
+        counter.notify(1)
+        response = wsgi.handle_metrics_list(get_req(dict(HTTP_IF_NONE_MATCH='W/"{}"'.format(etag[0])), all="true"))
+        assert_equal(response.status_code, 200)
+        assert_false(response.get_etag() == etag)
+
+    def test_metrics_etag(self):
+        counter = metrics.new_counter("test1")
+        metrics.new_histogram("test2")
+        metrics.new_meter("test3")
+
+        etag = wsgi.metrics_etag(["test1", "test2", "test3"])
+        assert_equal(etag, wsgi.metrics_etag(["test1", "test2", "test3"]))
+
+        counter.notify(1)
+        assert_false(etag == wsgi.metrics_etag(["test1", "test2", "test3"]))
+
+        # recreated metric
+        etag = wsgi.metrics_etag(["test1"])
+        metrics.delete_metric("test1")
+        assert_false(etag == wsgi.metrics_etag(["test1"]))
+        metrics.new_counter("test1")
+        assert_false(etag == wsgi.metrics_etag(["test1"]))
+
+    def test_metrics_etag_no_version(self):
+        metrics.REGISTRY["test1"] = mock.Mock(spec=["get"])
+
+        assert_equal(wsgi.metrics_etag(["test1"]), None)
+
+    @mock.patch('appmetrics.profiling.PROFILERS', {})
+    def test_handle_profiles(self):
+        assert_equal(wsgi.handle_profiles_list(mock.Mock()), '[]')
+
+        profiler = profiling.get_or_create_profiler("test1", mock.Mock(), 99)
+        profiler.captures.append(dict(duration=1.5))
+
+        assert_equal(wsgi.handle_profiles_list(mock.Mock()), '["test1"]')
+        assert_equal(json.loads(wsgi.handle_profiles_show(mock.Mock(), "test1")), [dict(duration=1.5)])
+
+    @mock.patch('appmetrics.profiling.PROFILERS', {})
+    def test_handle_profiles_show_not_found(self):
+        with assert_raises(werkzeug.exceptions.NotFound) as exc:
+            wsgi.handle_profiles_show(mock.Mock(), "test1")
+
+        assert_equal(exc.exception.description, "No profiles for metric: 'test1'")
 
     @mock.patch('appmetrics.wsgi.metrics.metric')
     def test_handle_metric_show(self, metric):
@@ -309,14 +422,25 @@ class TestWSGIHandlers(object):
         res = wsgi.handle_tag_show(mock.Mock(args={"expand": 'false'}), "tag1")
         assert_equal(res, '["test1"]')
 
-    @mock.patch('appmetrics.metrics.metrics_by_tag')
-    def test_handle_tag_show_no_expand(self, mbt):
-        mbt.return_value = "this is a test"
-        metrics.new_histogram("test1")
+    def test_handle_tag_show_expand(self):
+        metrics.new_counter("test1").notify(1)
+        metrics.new_gauge("test2").notify(2)
+        metrics.new_counter("test3")
         metrics.tag("test1", "tag1")
+        metrics.tag("test2", "tag1")
 
         res = wsgi.handle_tag_show(mock.Mock(args={"expand": 'true'}), "tag1")
-        assert_equal(res, '"this is a test"')
+
+        assert_equal(res.mimetype, "application/json")
+        assert_equal(json.loads(res.get_data(as_text=True)), {
+            'test1': dict(kind="counter", value=1), 'test2': dict(kind="gauge", value=2)})
+
+    def test_json_object_chunks(self):
+        chunks = list(wsgi.json_object_chunks([("a", 1), (u"\xe8", [1, 2])]))
+
+        assert_equal(chunks, ['{"a": 1', ', "\\u00e8": [1, 2]', '}'])
+        assert_equal(json.loads("".join(chunks)), {"a": 1, u"\xe8": [1, 2]})
+        assert_equal(list(wsgi.json_object_chunks([])), ["{}"])
 
     @raises(werkzeug.exceptions.UnsupportedMediaType)
     def test_get_body_no_content_type(self):
@@ -344,6 +468,11 @@ class TestWSGIHandlers(object):
 
         assert_equal(wsgi.get_body(request), 'test')
 
+    def test_handle_metric_new_invalid_body(self):
+        with assert_raises(werkzeug.exceptions.BadRequest) as exc:
+            wsgi.handle_metric_new(req([1, 2]), "test")
+        assert_equal(exc.exception.description, "invalid body")
+
     def test_handle_metric_new_missing_type(self):
         with assert_raises(werkzeug.exceptions.BadRequest) as exc:
             wsgi.handle_metric_new(req(dict()), "test")
@@ -394,3 +523,228 @@ class TestWSGIHandlers(object):
 
         assert_equal(metric.get(), dict(kind="gauge", value=1.5))
 
+    def batch(self, body, content_type="application/json"):
+        data = werkzeug.test.EnvironBuilder(data=body, content_type=content_type)
+        response = wsgi.handle_batch(data.get_request(cls=werkzeug.wrappers.Request))
+
+        return response.status_code, json.loads(response.get_data(as_text=True))
+
+    def test_handle_batch_array(self):
+        counter = metrics.new_counter("c1")
+        gauge = metrics.new_gauge("g1")
+
+        body = json.dumps([dict(name="c1", value=1), dict(name="g1", value=2.5), dict(name="c1", value=3)])
+        assert_equal(self.batch(body), (200, dict(processed=3, failed=0, errors=[])))
+
+        assert_equal(counter.get()['value'], 4)
+        assert_equal(gauge.get()['value'], 2.5)
+
+    def test_handle_batch_ndjson(self):
+        counter = metrics.new_counter("c1")
+
+        body = '{"name": "c1", "value": 1}\n{"name": "c1", "value": 2}\n\n'
+        assert_equal(self.batch(body, "application/x-ndjson"), (200, dict(processed=2, failed=0, errors=[])))
+        assert_equal(counter.get()['value'], 3)
+
+    def test_handle_batch_empty(self):
+        assert_equal(self.batch(" [ ] "), (200, dict(processed=0, failed=0, errors=[])))
+        assert_equal(self.batch(""), (200, dict(processed=0, failed=0, errors=[])))
+
+    def test_handle_batch_errors(self):
+        metrics.new_counter("c1")
+
+        body = json.dumps([
+            dict(name="c1", value=1), dict(name="xxx", value=1), dict(name="c1"), [1],
+            dict(name="c1", value="a")])
+        status, result = self.batch(body)
+
+        assert_equal(status, 200)
+        assert_equal(result['processed'], 5)
+        assert_equal(result['failed'], 4)
+        assert_equal([x[0] for x in result['errors']], [1, 2, 3, 4])
+        assert_equal(result['errors'][2], [3, "invalid record"])
+        assert_equal(metrics.get("c1")['value'], 1)
+
+    @mock.patch('appmetrics.wsgi.BATCH_MAX_ERRORS', 2)
+    def test_handle_batch_max_errors(self):
+        body = json.dumps([dict(name="xxx", value=1)] * 5)
+
+        assert_equal(self.batch(body)[1]['failed'], 5)
+        assert_equal(len(self.batch(body)[1]['errors']), 2)
+
+    def test_handle_batch_invalid_json(self):
+        counter = metrics.new_counter("c1")
+
+        status, result = self.batch('[{"name": "c1", "value": 1}, {"name": "c1", xxx]')
+
+        assert_equal(status, 400)
+        assert_equal(result, dict(processed=1, failed=1, errors=[[1, "invalid json"]]))
+        assert_equal(counter.get()['value'], 1)
+
+    @mock.patch('appmetrics.wsgi.BATCH_SIZE', 2)
+    def test_handle_batch_size(self):
+        counter = metrics.new_counter("c1")
+
+        with mock.patch('appmetrics.wsgi.metrics.notify_many', wraps=metrics.notify_many) as notify_many:
+            body = json.dumps([dict(name="c1", value=1)] * 5)
+            assert_equal(self.batch(body)[1]['processed'], 5)
+
+        assert_equal(notify_many.call_count, 3)
+        assert_equal(counter.get()['value'], 5)
+
+    @raises(werkzeug.exceptions.UnsupportedMediaType)
+    def test_handle_batch_bad_content_type(self):
+        self.batch("[]", "text/plain")
+
+
+class TestJSONRecordsReader(object):
+    def read(self, text, chunk_size=3):
+        return list(wsgi.JSONRecordsReader(io.BytesIO(text.encode("utf8")), chunk_size=chunk_size))
+
+    def test_array(self):
+        assert_equal(self.read('[1, 22, {"a": [1, 2]}, "x\\u00e8y", 12345]'), [1, 22, {"a": [1, 2]}, u"x\xe8y", 12345])
+
+    def test_sequence(self):
+        assert_equal(self.read('{"a": 1}\n{"b": 2}  123456\n'), [{"a": 1}, {"b": 2}, 123456])
+
+    def test_unicode_chunks(self):
+        assert_equal(self.read(u'["\xe8\xe8\xe8"]', chunk_size=1), [u"\xe8\xe8\xe8"])
+
+    def test_number_chunks(self):
+        text = '[1.5, 1.5e3, 10, 2.25, -0.5E-2]'
+        expected = [1.5, 1500.0, 10, 2.25, -0.005]
+
+        for chunk_size in (1, 2, 3, 4):
+            assert_equal(self.read(text, chunk_size=chunk_size), expected)
+        assert_equal(self.read('1.5\n2e2 10', chunk_size=1), [1.5, 200.0, 10])
+
+    @raises(ValueError)
+    def test_missing_comma(self):
+        self.read('[1 2]')
+
+    @raises(ValueError)
+    def test_unterminated(self):
+        self.read('[1, 2')
+
+    @raises(ValueError)
+    def test_extra_data(self):
+        self.read('[1, 2] 3')
+
+    @raises(ValueError)
+    def test_invalid(self):
+        self.read('{"a": }')
+
+
+
+class TestInstrumentation(object):
+    def setUp(self):
+        self.original_registry = metrics.REGISTRY.copy()
+        metrics.REGISTRY.clear()
+        self.original_tags = metrics.TAGS.copy()
+        metrics.TAGS.clear()
+
+        self.url_map = werkzeug.routing.Map([
+            werkzeug.routing.Rule("/users/<int:id>", endpoint="user"),
+            werkzeug.routing.Rule("/stream", endpoint="stream"),
+        ])
+
+        self.status = "200 OK"
+        self.body = [b"a", b"b"]
+        self.start_response = mock.Mock()
+        self.mw = wsgi.AppMetricsMiddleware(self.app, route_resolver=wsgi.werkzeug_route_resolver(self.url_map))
+
+    def tearDown(self):
+        metrics.REGISTRY.clear()
+        metrics.REGISTRY.update(self.original_registry)
+        metrics.TAGS.clear()
+        metrics.TAGS.update(self.original_tags)
+
+    def app(self, environ, start_response):
+        start_response(self.status, [])
+        return self.body
+
+    def request(self, path):
+        response = self.mw(env(path), self.start_response)
+        body = b"".join(response)
+        if hasattr(response, 'close'):
+            response.close()
+        return body
+
+    @mock.patch('appmetrics.wsgi.time')
+    def test_record(self, time_):
+        time_.time.side_effect = [10, 10.5, 20, 20.25]
+
+        assert_equal(self.request("/users/1"), b"ab")
+        self.status = "404 NOT FOUND"
+        self.request("/users/2")
+
+        assert_equal(self.start_response.call_args_list, [mock.call("200 OK", [], None), mock.call(self.status, [], None)])
+        assert_equal(metrics.get("request:/users/<int:id>:latency")['n'], 2)
+        assert_equal(metrics.get("request:/users/<int:id>:latency")['max'], 0.5)
+        assert_equal(metrics.get("request:/users/<int:id>:throughput")['count'], 2)
+        assert_equal(metrics.get("request:/users/<int:id>:2xx")['value'], 1)
+        assert_equal(metrics.get("request:/users/<int:id>:4xx")['value'], 1)
+        assert_equal(metrics.get("request:/users/<int:id>:5xx")['value'], 0)
+        assert_equal(len(metrics.tags()["requests"]), 7)
+
+    def test_read_route_metric(self):
+        self.request("/users/1")
+
+        for path in ("/_app-metrics/metrics/request:/users/<int:id>:2xx",
+                     "/_app-metrics/metrics/request:%2Fusers%2F%3Cint:id%3E:2xx"):
+            self.start_response.reset_mock()
+            body = self.request(path)
+
+            assert_equal(self.start_response.call_args[0][0], "200 OK")
+            assert_equal(json.loads(body.decode("utf8")), dict(kind="counter", value=1))
+
+    def test_not_resolved(self):
+        response = self.mw(env("/other"), self.start_response)
+
+        assert_equal(response, self.body)
+        assert_equal(metrics.metrics(), [])
+
+    @mock.patch('appmetrics.wsgi.time')
+    def test_streaming(self, time_):
+        time_.time.side_effect = [10, 11, 13]
+
+        closed = []
+
+        def stream():
+            try:
+                yield b"a"
+                time_.time()
+                yield b"b"
+            finally:
+                closed.append(True)
+
+        self.body = stream()
+        assert_equal(self.request("/stream"), b"ab")
+
+        # timed until the response is closed
+        assert_equal(closed, [True])
+        assert_equal(metrics.get("request:/stream:latency")['max'], 3)
+
+    def test_app_error(self):
+        self.app = mock.Mock(side_effect=ValueError())
+        self.mw.app = self.app
+
+        assert_raises(ValueError, self.mw, env("/stream"), self.start_response)
+
+        assert_equal(metrics.get("request:/stream:5xx")['value'], 1)
+
+    def test_route_metrics_cached(self):
+        self.request("/users/1")
+        routes = dict(self.mw.routes)
+
+        with mock.patch('appmetrics.wsgi.RouteMetrics') as route_metrics:
+            self.request("/users/2")
+            assert_false(route_metrics.called)
+
+        assert_equal(self.mw.routes, routes)
+
+    def test_resolver_error(self):
+        self.mw.route_resolver = mock.Mock(side_effect=ValueError())
+
+        assert_equal(self.request("/users/1"), b"ab")
+        assert_equal(metrics.metrics(), [])
@@ -19,16 +19,32 @@
 WSGI middleware
 """
 
-import logging, logging.config
+import logging
 import json
+import functools
+import hashlib
+import codecs
+import threading
+import time
 
-import werkzeug
+from . import metrics, exceptions, prometheus, py3comp, meter, simple_metrics, handlers
+from .lazy import LazyModule
 
-from . import metrics, exceptions, py3comp
+# imported on the first request for the metrics
+werkzeug = LazyModule("werkzeug", ["exceptions", "routing", "wrappers"])
 
 
 log = logging.getLogger("appmetrics.wsgi")
 
+# POST /batch: records notified at once, size of the body reads, errors returned
+BATCH_SIZE = 1000
+BATCH_CHUNK_SIZE = 64 * 1024
+BATCH_MAX_ERRORS = 100
+
+# request instrumentation: prefix of the metrics' names and their tag
+DEFAULT_ROUTE_PREFIX = "request:"
+DEFAULT_ROUTE_TAG = "requests"
+
 
 class AppMetricsMiddleware(object):
     """
@@ -40,7 +56,11 @@ class AppMetricsMiddleware(object):
     with "/_app-metrics": if not found, the wrapped application is called. The following resources are defined:
 
     ``/_app-metrics/metrics``
-      - **GET**: return the list of the registered metrics
+      - **GET**: return the list of the registered metrics. If the ``GET`` parameter ``"all"`` is ``"true"``,
+        a JSON object is returned instead, with the name of each metric as keys and corresponding values;
+        the ``"names"`` parameter (a comma-separated list of names) restricts it to the given metrics.
+        The response has an ``ETag`` computed from the metrics' versions: a ``304`` is returned if
+        it matches the request's ``If-None-Match`` header.
     ``/_app-metrics/metrics/<name>``
       - **GET**: return the value of the given metric or ``404``.
       - **PUT**: create a new metric with the given name. The body must be a ``JSON`` object with a
@@ -58,6 +78,7 @@ class AppMetricsMiddleware(object):
     ``/_app-metrics/tags/<name>``
       - **GET**: return the metrics tagged with the given tag. If the value of the ``GET`` parameter ``"expand"``
         is ``"true"``, a JSON object is returned, with the name of each tagged metric as keys and corresponding values.
+        The object is streamed, computing the values one metric at a time (as for ``/metrics``).
         If it is ``"false"`` or not provided, the list of metric names is returned.
         Return a ``404`` if the tag does not exist
     ``/_app-metrics/tags/<tag_name>/<metric_name>``
@@ -65,34 +86,92 @@ class AppMetricsMiddleware(object):
         does not exist.
       - **DELETE**: remove the tag ``<tag_name>`` from ``<metric_name>``. Return "deleted" or "not deleted". If
         ``<tag_name>`` is no longer used, it gets implicitly removed.
+    ``/_app-metrics/batch``
+      - **POST**: notify several values at once. The body must be either a ``JSON`` array or a sequence
+        of newline-delimited ``JSON`` objects, each one with the ``"name"`` and ``"value"`` attributes.
+        The body is parsed while it's read, the values are notified in batches.
+        Return a ``JSON`` object with the number of ``"processed"`` and ``"failed"`` records, and
+        the first errors as ``[record index, message]``. Return a ``400`` (with the same
+        object) if the body is not valid ``JSON``: the records before the invalid one are notified anyway.
+        Request's ``content-type`` must be ``"application/json"`` or ``"application/x-ndjson"``.
+    ``/_app-metrics/prometheus``
+      - **GET**: return all the metrics in the Prometheus text exposition format. The output is cached
+        for ``prometheus_ttl`` seconds.
+    ``/_app-metrics/profiles``
+      - **GET**: return the list of the profiled metrics (see ``metrics.with_histogram``)
+    ``/_app-metrics/profiles/<name>``
+      - **GET**: return the profiles of the latest slow calls of the given metric, the latest first,
+        or ``404`` if it's not profiled
 
 
     The root can be different from "/_app-metrics", you can set it on middleware constructor.
+
+    If a ``route_resolver`` is given, the wrapped application's requests are instrumented: the
+    resolver is called with the WSGI environment and returns the request's route template (e.g.
+    ``"/users/<int:id>"``), or None for the requests not to be measured. Each route gets
+    the ``"<route_prefix><route>:latency"`` histogram (seconds, until the response is closed),
+    the ``":throughput"`` meter and the ``":1xx"``-``":5xx"`` counters, tagged with ``route_tag``.
     """
 
-    def __init__(self, app, root="_app-metrics", extra_headers=None, mimetype="application/json"):
+    def __init__(self, app, root="_app-metrics", extra_headers=None, mimetype="application/json",
+                 prometheus_ttl=prometheus.DEFAULT_TTL, route_resolver=None,
+                 route_prefix=DEFAULT_ROUTE_PREFIX, route_tag=DEFAULT_ROUTE_TAG):
         """
         parameters:
         - app: wrapped WSGI application
         - root: path root to look for
         - extra_headers: extra headers that will be appended to the return headers
+        - prometheus_ttl: seconds the Prometheus output is cached for
+        - route_resolver: function returning the route template of a request, to instrument the app
+        - route_prefix: prefix of the routes' metrics names
+        - route_tag: tag of the routes' metrics
         """
         self.app = app
         self.root = "/" + root.strip("/").strip()
         self.extra_headers = extra_headers or {}
         self.mimetype = mimetype
+        self.prometheus = prometheus.Renderer(prometheus_ttl)
+
+        self.route_resolver = route_resolver
+        self.route_prefix = route_prefix
+        self.route_tag = route_tag
+
+        # route: RouteMetrics
+        self.routes = {}
+        self.routes_lock = threading.Lock()
+
+        # the routes are built on the first request for a metrics path
+        self._url_map = None
+
+        # prefix of the metrics paths, all the paths match on the root
+        self.prefix = self.root + "/" if self.root != "/" else ""
+
+    @property
+    def url_map(self):
+        if self._url_map is None:
+            self._url_map = self.build_url_map()
+
+        return self._url_map
 
-        self.url_map = werkzeug.routing.Map([
+    def build_url_map(self):
+        # the metric names may contain slashes, e.g. the routes' ones
+        return werkzeug.routing.Map([
             werkzeug.routing.Submount(self.root, [
                 werkzeug.routing.Rule("/metrics", endpoint=handle_metrics_list, methods=['GET']),
-                werkzeug.routing.Rule("/metrics/<name>", endpoint=handle_metric_show, methods=['GET']),
-                werkzeug.routing.Rule("/metrics/<name>", endpoint=handle_metric_new, methods=['PUT']),
-                werkzeug.routing.Rule("/metrics/<name>", endpoint=handle_metric_update, methods=['POST']),
-                werkzeug.routing.Rule("/metrics/<name>", endpoint=handle_metric_delete, methods=['DELETE']),
+                werkzeug.routing.Rule("/metrics/<path:name>", endpoint=handle_metric_show, methods=['GET']),
+                werkzeug.routing.Rule("/metrics/<path:name>", endpoint=handle_metric_new, methods=['PUT']),
+                werkzeug.routing.Rule("/metrics/<path:name>", endpoint=handle_metric_update, methods=['POST']),
+                werkzeug.routing.Rule("/metrics/<path:name>", endpoint=handle_metric_delete, methods=['DELETE']),
                 werkzeug.routing.Rule("/tags", endpoint=handle_tags_list, methods=['GET']),
                 werkzeug.routing.Rule("/tags/<tag_name>", endpoint=handle_tag_show, methods=['GET']),
-                werkzeug.routing.Rule("/tags/<tag_name>/<metric_name>", endpoint=handle_tag_add, methods=['PUT']),
-                werkzeug.routing.Rule("/tags/<tag_name>/<metric_name>", endpoint=handle_untag, methods=['DELETE']),
+                werkzeug.routing.Rule("/tags/<tag_name>/<path:metric_name>", endpoint=handle_tag_add, methods=['PUT']),
+                werkzeug.routing.Rule("/tags/<tag_name>/<path:metric_name>", endpoint=handle_untag, methods=['DELETE']),
+                werkzeug.routing.Rule("/batch", endpoint=handle_batch, methods=['POST']),
+                werkzeug.routing.Rule("/profiles", endpoint=handle_profiles_list, methods=['GET']),
+                werkzeug.routing.Rule("/profiles/<path:name>", endpoint=handle_profiles_show, methods=['GET']),
+                werkzeug.routing.Rule(
+                    "/prometheus", endpoint=functools.partial(handle_prometheus, renderer=self.prometheus),
+                    methods=['GET']),
             ])
         ])
 
@@ -109,13 +188,17 @@ class AppMetricsMiddleware(object):
     def __call__(self, environ, start_response):
         """WSGI application interface"""
 
+        # don't route the application's requests
+        if not environ.get('PATH_INFO', "").startswith(self.prefix):
+            return self.call_app(environ, start_response)
+
         urls = self.url_map.bind_to_environ(environ)
 
         try:
             endpoint, args = urls.match()
         except werkzeug.exceptions.NotFound:
             # the request did not match, go on with wsgi stack
-            return self.app(environ, start_response)
+            return self.call_app(environ, start_response)
 
         except werkzeug.exceptions.HTTPException as e:
             response = self.jsonize_error(e, environ)
@@ -124,7 +207,11 @@ class AppMetricsMiddleware(object):
             request = werkzeug.wrappers.Request(environ, populate_request=False)
             try:
                 body = endpoint(request, **args)
-                response = self.get_response(body, 200)
+                if isinstance(body, werkzeug.wrappers.Response):
+                    response = body
+                    response.headers.extend(self.extra_headers.items())
+                else:
+                    response = self.get_response(body, 200)
             except werkzeug.exceptions.HTTPException as e:
                 response = self.jsonize_error(e, environ)
 
@@ -134,6 +221,144 @@ class AppMetricsMiddleware(object):
 
         return response(environ, start_response)
 
+    def route_metrics(self, route):
+        """
+        Return the RouteMetrics of the given route, creating them on its first request
+        """
+
+        try:
+            return self.routes[route]
+        except KeyError:
+            pass
+
+        with self.routes_lock:
+            if route not in self.routes:
+                self.routes[route] = RouteMetrics(self.route_prefix + route, self.route_tag)
+
+            return self.routes[route]
+
+    def call_app(self, environ, start_response):
+        """
+        Call the wrapped application, measuring the request if its route is resolved
+        """
+
+        if self.route_resolver is None:
+            return self.app(environ, start_response)
+
+        try:
+            route = self.route_resolver(environ)
+        except Exception as e:
+            log.debug("Cannot resolve the route: %s", e, exc_info=True)
+            route = None
+
+        if route is None:
+            return self.app(environ, start_response)
+
+        response = InstrumentedResponse(self.route_metrics(route))
+
+        def instrumented_start_response(status, headers, exc_info=None):
+            response.status = status
+            return start_response(status, headers, exc_info)
+
+        try:
+            response.iterable = self.app(environ, instrumented_start_response)
+        except Exception:
+            response.status = "500"
+            response.close()
+            raise
+
+        return response
+
+
+class RouteMetrics(object):
+    """
+    The metrics of a route, resolved once so that measuring a request doesn't
+    look them up in the registry
+    """
+
+    def __init__(self, name, tag=None):
+        self.latency = metrics.get_or_create_histogram(name + ":latency", "uniform")
+        self.throughput = get_or_create_metric(name + ":throughput", metrics.new_meter, meter.Meter)
+        names = [name + ":latency", name + ":throughput"]
+
+        # by the first digit of the status
+        self.statuses = {}
+        for digit in "12345":
+            names.append("{}:{}xx".format(name, digit))
+            self.statuses[digit] = get_or_create_metric(names[-1], metrics.new_counter, simple_metrics.Counter)
+
+        if tag is not None:
+            for metric_name in names:
+                metrics.tag(metric_name, tag)
+
+    def record(self, status, elapsed):
+        self.latency.notify(elapsed)
+        self.throughput.notify(1)
+
+        counter = self.statuses.get(status[:1])
+        if counter is not None:
+            counter.notify(1)
+
+
+class InstrumentedResponse(object):
+    """
+    Wrap the application's response iterable, recording the request when it's closed
+    """
+
+    def __init__(self, route_metrics):
+        self.route_metrics = route_metrics
+        self.started = time.time()
+        self.iterable = ()
+        self.status = None
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if not self.closed:
+                self.closed = True
+                # start_response not called: the server will return an error
+                self.route_metrics.record(self.status or "500", time.time() - self.started)
+
+
+def get_or_create_metric(name, factory, class_):
+    """
+    Return the named metric of the given class, creating it by the factory if needed
+    """
+
+    try:
+        return factory(name)
+    except exceptions.DuplicateMetricError:
+        metric = metrics.metric(name)
+        if not isinstance(metric, class_):
+            raise exceptions.DuplicateMetricError(
+                "Metric {!r} already exists of type {}".format(name, type(metric).__name__))
+
+        return metric
+
+
+def werkzeug_route_resolver(url_map):
+    """
+    Return a route resolver for the given werkzeug routing Map (e.g. a Flask app's ``url_map``),
+    returning the template of the matching rule
+    """
+
+    def resolver(environ):
+        try:
+            rule, _ = url_map.bind_to_environ(environ).match(return_rule=True)
+        except werkzeug.exceptions.HTTPException:
+            return None
+
+        return rule.rule
+
+    return resolver
+
 
 def get_body(request):
     # get content type
@@ -150,96 +375,298 @@ def get_body(request):
 
 
 def handle_metrics_list(request):
-    return json.dumps(metrics.metrics())
+    if request.args.get('all', 'false') == 'true':
+        names = metrics.metrics()
+    elif request.args.get('names'):
+        names = sorted(set(x for x in request.args['names'].split(",") if x))
+    else:
+        return json.dumps(metrics.metrics())
 
+    # get the versions before the values: if a metric changes in the meanwhile
+    # the next request will get the new values
+    etag = metrics_etag(names)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = werkzeug.wrappers.Response(status=304)
+    else:
+        response = werkzeug.wrappers.Response(
+            json_object_chunks(metrics.iter_metrics_by_name_list(names)), mimetype="application/json")
 
-def handle_metric_show(request, name):
-    try:
-        metric = metrics.metric(name)
-    except KeyError:
-        raise werkzeug.exceptions.NotFound(("No such metric: {!r}".format(name)))
+    if etag is not None:
+        response.set_etag(etag, weak=True)
 
-    return json.dumps(metric.get())
+    return response
 
 
-def handle_metric_delete(request, name):
-    res = metrics.delete_metric(name)
+def metrics_etag(names):
+    """
+    Return an ETag for the values of the given metrics, built from their versions.
+    Return None if some metric has no version
+    """
 
-    return "deleted" if res else "not deleted"
+    versions = []
+    for name in names:
+        try:
+            metric = metrics.metric(name)
+        except exceptions.InvalidMetricError:
+            versions.append((name, None, None))
+            continue
 
+        version = getattr(metric, 'version', None)
+        if version is None:
+            return None
 
-def handle_metric_new(request, name):
-    data = get_body(request)
+        # a new metric with the same name restarts its version
+        versions.append((name, id(metric), version))
 
-    type_ = data.pop('type', None)
-    if not type_:
-        raise werkzeug.exceptions.BadRequest(description="metric type not provided")
+    return hashlib.md5(repr(versions).encode("utf8")).hexdigest()
 
-    metric_type = metrics.METRIC_TYPES.get(type_)
 
-    if not metric_type:
-        raise werkzeug.exceptions.BadRequest("invalid metric type: {!r}".format(type_))
+def werkzeug_errors(handler):
+    """
+    Decorator translating the handlers.HTTPError raised by the given handler into the werkzeug exceptions
+    """
 
-    try:
-        metric_type(name, **data)
-    except exceptions.AppMetricsError as e:
-        raise werkzeug.exceptions.BadRequest("can't create metric {}({!r}): {}".format(type_, name, e))
-    except Exception as e:
-        log.debug(str(e), exc_info=True)
-        raise werkzeug.exceptions.BadRequest("can't create metric {}({!r})".format(type_, name))
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        except handlers.HTTPError as e:
+            werkzeug.exceptions.abort(e.status, description=e.description)
 
-    return ""
+    return wrapper
 
 
-def handle_metric_update(request, name):
-    data = get_body(request)
+@werkzeug_errors
+def handle_metric_show(request, name):
+    return handlers.metric_show(name)
 
-    value = data.pop('value', None)
-    if value is None:
-        raise werkzeug.exceptions.BadRequest("metric value not provided")
 
-    try:
-        metric = metrics.metric(name)
-    except KeyError:
-        raise werkzeug.exceptions.NotFound()
+@werkzeug_errors
+def handle_metric_delete(request, name):
+    return handlers.metric_delete(name)
 
-    metric.notify(value)
 
-    return ""
+@werkzeug_errors
+def handle_metric_new(request, name):
+    return handlers.metric_new(name, get_body(request))
+
+
+@werkzeug_errors
+def handle_metric_update(request, name):
+    return handlers.metric_update(name, get_body(request))
 
 
+@werkzeug_errors
 def handle_tags_list(request):
-    return json.dumps(sorted(metrics.tags().keys()))
+    return handlers.tags_list()
 
 
+@werkzeug_errors
 def handle_tag_show(request, tag_name):
-    all_tags = metrics.tags()
-    if tag_name not in all_tags:
-        raise werkzeug.exceptions.NotFound(description="no such tag: {!r}".format(tag_name))
+    names = handlers.tag_metrics(tag_name)
 
     if request.args.get('expand', 'false') == 'true':
-        return json.dumps(metrics.metrics_by_tag(tag_name))
+        return werkzeug.wrappers.Response(
+            json_object_chunks(metrics.iter_metrics_by_name_list(names)), mimetype="application/json")
     else:
-        return json.dumps(sorted(all_tags[tag_name]))
+        return json.dumps(names)
 
 
+def json_object_chunks(items):
+    """
+    Yield the JSON text of an object with the given (key, value) items, an item at a time,
+    so that a big object is never held in memory
+    """
+
+    separator = "{"
+    for key, value in items:
+        yield "{}{}: {}".format(separator, json.dumps(key), json.dumps(value))
+        separator = ", "
+
+    yield "{}" if separator == "{" else "}"
+
+
+@werkzeug_errors
 def handle_tag_add(request, tag_name, metric_name):
+    return handlers.tag_add(tag_name, metric_name)
+
+
+@werkzeug_errors
+def handle_untag(request, tag_name, metric_name):
+    return handlers.untag(tag_name, metric_name)
+
+
+class JSONRecordsReader(object):
+    """
+    Iterate over the JSON values in the given stream, either the items of an array or a
+    sequence of values (such as newline-delimited JSON), reading the stream by chunks.
+    Raise ValueError on invalid JSON
+    """
+
+    def __init__(self, stream, charset="utf-8", chunk_size=BATCH_CHUNK_SIZE):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder(charset)()
+        self.chunk_size = chunk_size
+
+        self.json = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read the next chunk, return False at the end of the stream"""
+
+        if self.eof:
+            return False
+
+        data = self.stream.read(self.chunk_size)
+        self.eof = not data
+
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data, self.eof)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, "" at the end of the stream"""
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ""
+
+    @staticmethod
+    def is_number(value):
+        return isinstance(value, py3comp.integer_types + (float,)) and not isinstance(value, bool)
+
+    def delimited(self, pos):
+        """Return True if a value ending at the given position can't continue"""
+
+        return pos < len(self.buffer) and (self.buffer[pos].isspace() or self.buffer[pos] in ",]")
+
+    def decode(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+
+            # a number may continue in the next chunk, e.g. "1" or "1." of "1.5e3"
+            if self.is_number(value) and not self.delimited(end) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        if self.peek() != "[":
+            while self.peek():
+                yield self.decode()
+            return
+
+        self.pos += 1
+        if self.peek() == "]":
+            self.pos += 1
+        else:
+            while True:
+                yield self.decode()
+
+                char = self.peek()
+                self.pos += 1
+                if char == "]":
+                    break
+                if char != ",":
+                    raise ValueError("Expecting ',' or ']' at position {}".format(self.pos))
+
+        if self.peek():
+            raise ValueError("Extra data after the array")
+
+
+def handle_batch(request):
+    if request.mimetype not in ("application/json", "application/x-ndjson"):
+        raise werkzeug.exceptions.UnsupportedMediaType()
+
+    result = dict(processed=0, failed=0, errors=[])
+
+    def add_error(index, message):
+        result['failed'] += 1
+        if len(result['errors']) < BATCH_MAX_ERRORS:
+            result['errors'].append([index, message])
+
+    def notify(batch):
+        errors = metrics.notify_many((name, value) for _, name, value in batch)
+        for position, message in errors:
+            add_error(batch[position][0], message)
+        result['processed'] += len(batch)
+
+    batch = []
+    status = 200
+    index = -1
+
     try:
-        metrics.tag(metric_name, tag_name)
-    except metrics.InvalidMetricError as e:
-        raise werkzeug.exceptions.BadRequest(description=str(e))
+        for index, record in enumerate(JSONRecordsReader(request.stream, request.charset)):
+            try:
+                name, value = record['name'], record['value']
+            except (TypeError, KeyError):
+                name = value = None
+
+            if not isinstance(name, py3comp.string_types) or value is None:
+                # keep the errors in order
+                if batch:
+                    notify(batch)
+                    batch = []
+
+                result['processed'] += 1
+                add_error(index, "invalid record")
+                continue
+
+            batch.append((index, name, value))
+            if len(batch) >= BATCH_SIZE:
+                notify(batch)
+                batch = []
+    except ValueError as e:
+        log.debug("Invalid body: %s", e)
+        add_error(index + 1, "invalid json")
+        status = 400
 
-    return ""
+    if batch:
+        notify(batch)
 
+    return werkzeug.wrappers.Response(json.dumps(result), status, mimetype="application/json")
+
+
+@werkzeug_errors
+def handle_profiles_list(request):
+    return handlers.profiles_list()
 
-def handle_untag(request, tag_name, metric_name):
-    res = metrics.untag(metric_name, tag_name)
 
-    return "deleted" if res else "not deleted"
+@werkzeug_errors
+def handle_profiles_show(request, name):
+    return handlers.profiles_show(name)
+
+
+def handle_prometheus(request, renderer):
+    # stream the output
+    return werkzeug.wrappers.Response(renderer(), content_type=prometheus.CONTENT_TYPE)
 
 
 # useful to run standalone with werkzeug's server:
 # $ python -m werkzeug.serving appmetrics.wsgi.standalone_app
 # * Running on http://127.0.0.1:5000/
 
-standalone_app = AppMetricsMiddleware(werkzeug.exceptions.NotFound(), "")
+def not_found(environ, start_response):
+    return werkzeug.exceptions.NotFound()(environ, start_response)
+
+
+standalone_app = AppMetricsMiddleware(not_found, "")
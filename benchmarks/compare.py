@@ -0,0 +1,91 @@
+"""
+Compare two results files written by benchmarks/suite.py:
+
+    $ python benchmarks/compare.py before.json after.json
+
+All the measures are "lower is better". The exit status is 1 if some measure
+got worse than the threshold (10% by default), so it can be used to catch regressions.
+"""
+
+import argparse
+import collections
+import json
+import sys
+
+
+def load(file_name):
+    with open(file_name) as inf:
+        data = json.load(inf)
+
+    res = collections.OrderedDict()
+    for item in data['results']:
+        params = ",".join("{}={}".format(k, v) for k, v in sorted(item['params'].items()))
+        res[(item['scenario'], item['name'], params)] = (item['value'], item['unit'])
+
+    return data['meta'], res
+
+
+def compare(before, after, threshold):
+    """
+    Return the rows of the comparison, as (scenario, name, params, before, after, unit, change, regression),
+    and the number of regressions
+    """
+
+    rows = []
+    regressions = 0
+
+    # in the order of the runs
+    for key in list(before) + [x for x in after if x not in before]:
+        old, unit = before.get(key, (None, None))
+        new, unit = after.get(key, (None, unit))
+
+        change = None
+        if old and new is not None:
+            change = (new - old) / old
+
+        regression = change is not None and change > threshold
+        regressions += regression
+
+        rows.append(key + (old, new, unit, change, regression))
+
+    return rows, regressions
+
+
+def format_value(value):
+    return "-" if value is None else "{:.2f}".format(value)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compare two appmetrics benchmark results")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=10.0,
+        help="percentage of increase reported as a regression (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    before_meta, before = load(args.before)
+    after_meta, after = load(args.after)
+
+    for label, meta in (("before", before_meta), ("after", after_meta)):
+        print("{}: {} {} on {} (scale {})".format(
+            label, meta['implementation'], meta['python'], meta['platform'], meta['scale']))
+    print("")
+
+    rows, regressions = compare(before, after, args.threshold / 100.0)
+
+    line = "{:<12} {:<32} {:<12} {:>14} {:>14} {:<6} {:>8}"
+    print(line.format("scenario", "name", "params", "before", "after", "unit", "change"))
+    for scenario, name, params, old, new, unit, change, regression in rows:
+        print(line.format(
+            scenario, name, params, format_value(old), format_value(new), unit or "",
+            "-" if change is None else "{:+.1f}%".format(change * 100)) + (" !" if regression else ""))
+
+    print("")
+    print("{} regressions over {}%".format(regressions, args.threshold))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
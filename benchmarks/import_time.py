@@ -0,0 +1,68 @@
+"""
+Benchmark of the time needed to import the library's modules.
+Each module is imported by a new interpreter, measuring the import only (not the interpreter's startup),
+and the modules which should be imported lazily are reported if found.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+
+
+log = logging.getLogger("benchmark")
+
+RUNS = 20
+
+MODULES = [
+    "appmetrics.metrics",
+    "appmetrics.reporter",
+    "appmetrics.wsgi",
+    "appmetrics.prometheus",
+    "appmetrics.aggregator",
+]
+
+# imported lazily, must not be loaded by importing the modules
+HEAVY_MODULES = ["werkzeug", "fractions", "decimal", "csv", "uuid", "socketserver", "SocketServer", "pickle"]
+
+SCRIPT = """
+import sys, time
+t1 = time.time()
+import {module}
+t2 = time.time()
+print(t2 - t1)
+print(" ".join(x for x in {heavy!r} if x in sys.modules))
+"""
+
+
+def import_time(module):
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=root)
+    elapsed, loaded = output.decode("ascii").split("\n")[:2]
+
+    return float(elapsed), loaded.split()
+
+
+def run(module, runs):
+    times = []
+    for _ in range(runs):
+        elapsed, loaded = import_time(module)
+        times.append(elapsed)
+
+    times.sort()
+
+    log.info(
+        "%s: median %.2fms, min %.2fms over %s runs - heavy modules loaded: %s",
+        module, times[len(times) // 2] * 1000, times[0] * 1000, runs, ", ".join(loaded) or "none")
+
+
+def benchmark_all():
+    for module in MODULES:
+        run(module, RUNS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    benchmark_all()
@@ -0,0 +1,303 @@
+"""
+Benchmark suite measuring the library's hot paths.
+
+Scenarios:
+- notify: ns/op of notify() for each metric and reservoir type
+- overhead: ns/op added by Histogram.notify() over its reservoir's add(), for each reservoir type
+- contention: ns/op of notify() from 1 to 64 threads, on a shared metric and on a metric per thread
+- get: latency of a histogram's get() by reservoir size, computing the statistics and from the cache
+- decorators: overhead of with_histogram, with_meter and timer, over a call doing nothing
+- memory: bytes per metric (needs tracemalloc, python >= 3.4)
+- samples: bytes per sample for each reservoir type, measured by tracemalloc and estimated by sizeof()
+- imports: time needed to import the modules (see benchmarks/import_time.py)
+
+The results are written as JSON, to be compared with benchmarks/compare.py:
+
+    $ python benchmarks/suite.py -o before.json
+    $ python benchmarks/suite.py -o after.json
+    $ python benchmarks/compare.py before.json after.json
+"""
+
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from appmetrics import metrics, histogram, meter, simple_metrics
+
+
+log = logging.getLogger("benchmark")
+
+RESERVOIRS = collections.OrderedDict([
+    ('uniform', histogram.UniformReservoir),
+    ('sliding_window', histogram.SlidingWindowReservoir),
+    ('sliding_time_window', histogram.SlidingTimeWindowReservoir),
+    ('exp_decaying', histogram.ExponentialDecayingReservoir),
+])
+
+METRICS = collections.OrderedDict([
+    ('counter', simple_metrics.Counter),
+    ('gauge', simple_metrics.Gauge),
+    ('meter', meter.Meter),
+])
+for _name, _reservoir in RESERVOIRS.items():
+    METRICS['histogram-' + _name] = (lambda r: lambda: histogram.Histogram(r()))(_reservoir)
+
+THREADS = (1, 2, 4, 8, 16, 32, 64)
+
+GET_SIZES = (128, 1028, 8192, 65536)
+
+# scenario name: function(scale), returning the results as (name, params, value, unit)
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(f):
+    SCENARIOS[f.__name__] = f
+    return f
+
+
+def ns_per_op(func, number, repeat=5):
+    """
+    Return the best time of "repeat" runs of "func" called "number" times, in ns per call
+    """
+
+    best = None
+    for _ in range(repeat):
+        t1 = timeit.default_timer()
+        for _ in range(number):
+            func()
+        elapsed = timeit.default_timer() - t1
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / number * 1e9
+
+
+@scenario
+def notify(scale):
+    for name, factory in METRICS.items():
+        metric = factory()
+        yield name, {}, ns_per_op(lambda: metric.notify(1), 20000 * scale), "ns/op"
+
+
+@scenario
+def overhead(scale):
+    number = 20000 * scale
+
+    for name, factory in RESERVOIRS.items():
+        reservoir = factory()
+        add = ns_per_op(lambda: reservoir.add(1), number)
+
+        obj = histogram.Histogram(factory())
+        yield "histogram-" + name, {}, ns_per_op(lambda: obj.notify(1), number) - add, "ns/op"
+
+
+def run_threads(count, target):
+    """
+    Run "target" in the given number of threads started together, return the elapsed time
+    """
+
+    barrier = threading.Event()
+
+    def run():
+        barrier.wait()
+        target()
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    t1 = timeit.default_timer()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+
+    return timeit.default_timer() - t1
+
+
+@scenario
+def contention(scale):
+    ops = 2000 * scale
+
+    for name in ('counter', 'histogram-uniform'):
+        factory = METRICS[name]
+
+        for threads in THREADS:
+            shared = factory()
+
+            def notify_shared():
+                for _ in range(ops):
+                    shared.notify(1)
+
+            elapsed = run_threads(threads, notify_shared)
+            yield name + "-shared", dict(threads=threads), elapsed / (ops * threads) * 1e9, "ns/op"
+
+            def notify_own():
+                own = factory()
+                for _ in range(ops):
+                    own.notify(1)
+
+            elapsed = run_threads(threads, notify_own)
+            yield name + "-per-thread", dict(threads=threads), elapsed / (ops * threads) * 1e9, "ns/op"
+
+
+@scenario
+def get(scale):
+    for size in GET_SIZES:
+        obj = histogram.Histogram(histogram.SlidingWindowReservoir(size))
+        for i in range(size):
+            obj.notify(i % 1000)
+
+        def uncached():
+            obj._snapshot = None
+            obj.get()
+
+        number = max(1, 10000 * scale // size)
+        yield "histogram", dict(size=size), ns_per_op(uncached, number, 3) / 1000.0, "us/op"
+        yield "histogram-cached", dict(size=size), ns_per_op(obj.get, 2000 * scale) / 1000.0, "us/op"
+
+
+@scenario
+def decorators(scale):
+    number = 20000 * scale
+
+    def noop():
+        pass
+
+    baseline = ns_per_op(noop, number)
+
+    try:
+        with_histogram = metrics.with_histogram("benchmark-histogram")(noop)
+        with_meter = metrics.with_meter("benchmark-meter")(noop)
+
+        def with_timer():
+            with metrics.timer("benchmark-histogram"):
+                pass
+
+        yield "with_histogram", {}, ns_per_op(with_histogram, number) - baseline, "ns/op"
+        yield "with_meter", {}, ns_per_op(with_meter, number) - baseline, "ns/op"
+        yield "timer", {}, ns_per_op(with_timer, number) - baseline, "ns/op"
+    finally:
+        metrics.delete_metric("benchmark-histogram")
+        metrics.delete_metric("benchmark-meter")
+
+
+@scenario
+def memory(scale):
+    try:
+        import tracemalloc
+    except ImportError:
+        log.info("memory: tracemalloc not available")
+        return
+
+    number = 1000 * scale
+
+    for name, factory in METRICS.items():
+        gc.collect()
+        tracemalloc.start()
+        try:
+            objects = [factory() for _ in range(number)]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        del objects
+        yield name, {}, float(size) / number, "bytes"
+
+
+@scenario
+def samples(scale):
+    try:
+        import tracemalloc
+    except ImportError:
+        log.info("samples: tracemalloc not available")
+        return
+
+    # the exponentially-decaying reservoir sorts its values at each insertion
+    number = 1000 * scale
+
+    for name, factory in RESERVOIRS.items():
+        # big enough to keep all the samples, the time window lasts 60 seconds
+        reservoir = factory() if name == 'sliding_time_window' else factory(number)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            empty = tracemalloc.get_traced_memory()[0]
+            estimated = reservoir.sizeof()
+
+            for i in range(number):
+                reservoir.add(i)
+
+            size = tracemalloc.get_traced_memory()[0] - empty
+            estimated = reservoir.sizeof() - estimated
+        finally:
+            tracemalloc.stop()
+
+        yield name, {}, float(size) / number, "bytes"
+        yield name + "-sizeof", {}, float(estimated) / number, "bytes"
+
+
+@scenario
+def imports(scale):
+    import import_time
+
+    for module in import_time.MODULES:
+        times = sorted(import_time.import_time(module)[0] for _ in range(max(3, scale)))
+        yield module, {}, times[len(times) // 2] * 1000, "ms"
+
+
+def run(names, scale):
+    results = []
+
+    for scenario_name in names:
+        log.info("running %s", scenario_name)
+
+        for name, params, value, unit in SCENARIOS[scenario_name](scale):
+            log.info("%s %s %s: %.2f %s", scenario_name, name, params or "", value, unit)
+            results.append(dict(scenario=scenario_name, name=name, params=params, value=value, unit=unit))
+
+    return dict(
+        meta=dict(
+            time=time.time(),
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            platform=platform.platform(),
+            scale=scale),
+        results=results)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the appmetrics benchmarks")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument(
+        "-s", "--scenario", action="append", choices=list(SCENARIOS),
+        help="run only the given scenario (can be repeated)")
+    parser.add_argument(
+        "--scale", type=int, default=10, help="multiplier of the number of operations (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    res = run(args.scenario or list(SCENARIOS), args.scale)
+
+    if args.output:
+        with open(args.output, "w") as of:
+            json.dump(res, of, indent=2, sort_keys=True)
+    else:
+        json.dump(res, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main()